@@ -9,39 +9,557 @@
 ##############################################################################
 # IMPORT NECESSARY MODULES
 ##############################################################################
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import json
+import multiprocessing.util
 import os
+import re
 
 import docx
 
+from docx_utils import AnalysisCache
+from docx_utils import find_word_files
+from docx_utils import instrument_from_env
+from docx_utils import iter_paragraphs
+from docx_utils import ParagraphIndex
+
+
+##############################################################################
+# GLOBAL VARIABLES
+##############################################################################
+# Parenthetical text, without nested parentheses
+PAREN = re.compile(r'\(\s*([^()]{1,200}?)\s*\)')
+
+# Parentheticals that are not abbreviations or definitions
+EXCLUDE = re.compile(r'(?:e\.\s?g\.|i\.\s?e\.|see\b|refer\b|cf\.|etc\.)',
+                     re.IGNORECASE)
+
+# Word tokens, e.g., 'U.S', 'R&D', 'CO2', 'non-linear'
+TOKEN = re.compile(r'\w+(?:[&/.\-]\w+)*')
+
+# Last word before a parenthetical, searched within a short window
+LAST_WORD = re.compile(r'(\S+)\s*$')
+
+# Characters before a parenthetical searched for a definition
+WINDOW = 250
+
+# Cache name of a file's partial index; changes with the partial's format
+PARTIAL_NAME = "abbr_finder.partial.2"
+
+# Per-process analysis cache of the corpus workers (see _init_worker)
+_CACHE = {}
+
+
+##############################################################################
+# CLASSES
+##############################################################################
+class AbbrScanner(object):
+    """
+    Name:     AbbrScanner
+    Features: Class for finding abbreviations and their definitions, in
+              either order (i.e., 'Definition (ABBR)' or 'ABBR (Definition)'),
+              in one pass over each paragraph's text
+    History:  Version 1
+    """
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Initialization
+    # ////////////////////////////////////////////////////////////////////////
+    def __init__(self):
+        """
+        Name:     AbbrScanner.__init__
+        Inputs:   None
+        Features: Initializes the AbbrScanner class
+        """
+        self.num_paras = 0         # number of paragraphs scanned
+        self.definitions = {}      # abbreviation to Counter of definitions
+        self.counts = Counter()    # word token counts
+        self.first = {}            # word token to index of first paragraph
+        self.postings = {}         # abbreviation-like token to paragraphs
+
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Function Definitions
+    # ////////////////////////////////////////////////////////////////////////
+    def add(self, abbr, definition):
+        """
+        Name:     AbbrScanner.add
+        Inputs:   - str, abbreviation (abbr)
+                  - str, its definition (definition)
+        Outputs:  None
+        """
+        definition = " ".join(definition.split())
+        if abbr not in self.definitions:
+            self.definitions[abbr] = Counter()
+        self.definitions[abbr][definition] += 1
+
+    def partial(self, name):
+        """
+        Name:     AbbrScanner.partial
+        Inputs:   str, name of the scanned file (name)
+        Outputs:  dict, partial index (see merge_partials)
+        Features: Keeps the definitions and the paragraphs where each
+                  abbreviation, or word that looks like one, is used, and
+                  how many times it is used
+        """
+        postings = {}
+        for abbr in self.definitions:
+            m = TOKEN.search(abbr)
+            key = m.group(0) if m else abbr
+            postings[key] = {name: self.postings.get(key, [])}
+        for t, idx in self.postings.items():
+            if t not in postings:
+                postings[t] = {name: idx}
+        return {
+            'files': {name: self.num_paras},
+            'errors': {},
+            'definitions': dict(
+                (abbr, dict(defs)) for abbr, defs in self.definitions.items()
+            ),
+            'postings': postings,
+            'counts': dict(
+                (t, {name: self.counts.get(t, 0)}) for t in postings
+            )
+        }
+
+    def post(self, abbr, i):
+        """
+        Name:     AbbrScanner.post
+        Inputs:   - str, abbreviation (abbr)
+                  - int, paragraph index (i)
+        Outputs:  None
+        Features: Records the paragraph of a definition in the postings
+        """
+        m = TOKEN.search(abbr)
+        key = m.group(0) if m else abbr
+        idx = self.postings.setdefault(key, [])
+        if not idx or idx[-1] != i:
+            idx.append(i)
+
+    def scan(self, texts):
+        """
+        Name:     AbbrScanner.scan
+        Inputs:   iterable, paragraph text (texts)
+        Outputs:  None
+        Depends:  scan_paragraph
+        """
+        for text in texts:
+            self.scan_paragraph(self.num_paras, text)
+
+    def scan_paragraph(self, i, text):
+        """
+        Name:     AbbrScanner.scan_paragraph
+        Inputs:   - int, paragraph index (i)
+                  - str, paragraph text (text)
+        Outputs:  None
+        Features: Counts the paragraph's words and finds the abbreviations
+                  defined in it
+        Depends:  - add
+                  - find_definition
+                  - is_abbr
+        """
+        self.num_paras = max(self.num_paras, i + 1)
+        tokens = TOKEN.findall(text)
+        for t in set(tokens).difference(self.counts):
+            self.first[t] = i
+        self.counts.update(tokens)
+        for t in set(tokens):
+            # Words with a capital letter after the first, e.g., 'WHO'
+            if not t.islower() and t != t.capitalize():
+                if t in self.postings:
+                    self.postings[t].append(i)
+                else:
+                    self.postings[t] = [i]
+
+        for m in PAREN.finditer(text):
+            inner = m.group(1)
+            if EXCLUDE.match(inner):
+                continue
+            short = re.split(r'[;,]\s', inner, maxsplit=1)[0]
+            before = text[max(0, m.start() - WINDOW):m.start()]
+            if is_abbr(short):
+                # Definition (ABBR)
+                definition = find_definition(short, before)
+                if definition:
+                    self.add(short, definition)
+                    self.post(short, i)
+            else:
+                # ABBR (Definition)
+                m_word = LAST_WORD.search(before)
+                if m_word:
+                    abbr = m_word.group(1).strip(",;:")
+                    if (is_abbr(abbr) and
+                            sum(1 for c in abbr if c.isupper()) > 1):
+                        definition = find_definition(abbr, inner)
+                        if definition:
+                            self.add(abbr, definition)
+                            self.post(abbr, i)
+
+    def table(self):
+        """
+        Name:     AbbrScanner.table
+        Inputs:   None
+        Outputs:  list, tuples of abbreviation, definition, index of its
+                  first paragraph and its number of uses, in order of first
+                  use
+        Features: Takes the most common definition of each abbreviation
+        """
+        rows = []
+        for abbr, defs in self.definitions.items():
+            m = TOKEN.search(abbr)
+            key = m.group(0) if m else abbr
+            rows.append((
+                abbr,
+                defs.most_common(1)[0][0],
+                self.first.get(key),
+                self.counts.get(key, 0)
+            ))
+        rows.sort(key=lambda x: (x[2] is None, x[2] or 0, x[0]))
+        return rows
+
 
 ##############################################################################
 # FUNCTIONS
 ##############################################################################
+def find_abbreviations(d):
+    """
+    Returns a table of abbreviations, definitions, first paragraph and counts
+    """
+    my_scanner = AbbrScanner()
+    my_scanner.scan(ParagraphIndex(d).texts())
+    return my_scanner.table()
+
+
+def empty_partial():
+    """
+    Returns a partial index with nothing in it
+    """
+    return {'files': {}, 'errors': {}, 'definitions': {}, 'postings': {},
+            'counts': {}}
+
+
+def find_definition(abbr, text):
+    """
+    Returns the shortest end of the text whose words spell out the given
+    abbreviation (Schwartz and Hearst, 2003); None if there is none
+    """
+    # Limit the candidate to the last min(|A| + 5, 2|A|) words
+    max_words = min(len(abbr) + 5, 2 * len(abbr))
+    words = text.split()[-max_words:]
+    long_form = " ".join(words)
+
+    # Match the abbreviation's characters from right to left; its first
+    # character must start a word
+    s_idx = len(abbr) - 1
+    l_idx = len(long_form) - 1
+    while s_idx >= 0:
+        c = abbr[s_idx].lower()
+        if not c.isalnum():
+            s_idx -= 1
+            continue
+        while l_idx >= 0 and (
+                long_form[l_idx].lower() != c or
+                (s_idx == 0 and l_idx > 0 and
+                 long_form[l_idx - 1].isalnum())):
+            l_idx -= 1
+        if l_idx < 0:
+            return None
+        l_idx -= 1
+        s_idx -= 1
+
+    l_idx = long_form.rfind(" ", 0, l_idx + 1) + 1
+    definition = long_form[l_idx:].strip(" ,;:")
+    if len(definition) <= len(abbr) or abbr in definition.split():
+        return None
+    return definition
+
+
+def is_abbr(s):
+    """
+    Returns True if the string looks like an abbreviation (2 to 10
+    characters, up to two words, starting with a letter or digit and having
+    at least one capital letter)
+    """
+    return (
+        1 < len(s) <= 10 and
+        len(s.split()) <= 2 and
+        s[0].isalnum() and
+        any(c.isupper() for c in s)
+    )
+
+
+def load_partial(path):
+    """
+    Returns a partial index read from a JSON file
+    """
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def merge_partials(a, b):
+    """
+    Returns a new partial index combining two others; merging is
+    associative, so partials of shards may be combined in any grouping
+    (keeping the order of the shards)
+
+    A partial index is a dictionary of:
+    - 'files', file name to its number of paragraphs, in corpus order
+    - 'errors', file name to the reason it could not be scanned
+    - 'definitions', abbreviation to each definition's count
+    - 'postings', abbreviation-like word to file name to the indices of the
+      paragraphs that use it
+    - 'counts', abbreviation-like word to file name to its number of uses
+    """
+    out = empty_partial()
+    for p in (a, b):
+        _add_partial(out, p)
+    return out
+
+
+def partial_table(partial):
+    """
+    Returns a table of abbreviation, definition, first file, first
+    paragraph, number of uses and number of files, in order of first use
+    """
+    order = dict((name, j) for j, name in enumerate(partial['files']))
+    rows = []
+    for abbr, defs in partial['definitions'].items():
+        m = TOKEN.search(abbr)
+        key = m.group(0) if m else abbr
+        files = partial['postings'].get(key, {})
+        used = [name for name in files if files[name]]
+        if used:
+            first_file = min(used, key=lambda x: order.get(x, len(order)))
+            first_para = files[first_file][0]
+        else:
+            first_file = None
+            first_para = None
+        best = max(defs.values())
+        definition = [x for x in defs if defs[x] == best][0]
+        rows.append((
+            abbr,
+            definition,
+            first_file,
+            first_para,
+            sum(partial['counts'].get(key, {}).values()),
+            len(used)
+        ))
+    rows.sort(key=lambda x: (
+        x[2] is None, order.get(x[2], 0), x[3] or 0, x[0]))
+    return rows
+
+
 def read_paragraphs(d):
     """
     Returns a dictionary of paragraph-level text information
     """
     paras = {}
-    num_paras = len(d.paragraphs)
-    for i in range(num_paras):
-        para = d.paragraphs[i]
+    my_texts = ParagraphIndex(d).texts()
+    for i in range(len(my_texts)):
         paras[i] = {
-            "text": para.text
+            "text": my_texts[i]
         }
     return paras
 
 
+def save_partial(partial, path):
+    """
+    Writes a partial index to a JSON file
+    """
+    with open(path, 'w') as f:
+        json.dump(partial, f)
+
+
+def scan_corpus(paths, workers=1, cache_path=None):
+    """
+    Returns the partial index of a list of .docx files, scanned over a pool
+    of worker processes, each file's partial being merged in order; with a
+    cache file, unchanged files are not scanned again (see AnalysisCache)
+    """
+    my_index = empty_partial()
+    hits = 0
+    misses = 0
+    if workers <= 1:
+        _init_worker(cache_path)
+        for path in paths:
+            partial, n_hits, n_misses = _scan_job(path)
+            _add_partial(my_index, partial)
+            hits += n_hits
+            misses += n_misses
+        if cache_path:
+            _CACHE['cache'].close()
+            del _CACHE['cache']
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(cache_path,)) as pool:
+            for partial, n_hits, n_misses in pool.map(_scan_job, paths):
+                _add_partial(my_index, partial)
+                hits += n_hits
+                misses += n_misses
+    if cache_path:
+        print("Cache {}: {} hits, {} misses ({:.0%} hit rate).".format(
+            cache_path, hits, misses,
+            float(hits) / (hits + misses) if hits + misses else 0.0))
+    return my_index
+
+
+def scan_file(path, cache=None):
+    """
+    Returns the partial index of one .docx file, streamed without building
+    the document (see iter_paragraphs), or taken from the cache if given; a
+    file that cannot be read is listed under 'errors'
+    """
+    try:
+        if cache is None:
+            my_index = _scan_partial(path)
+        else:
+            my_index = cache.get_or_compute(path, PARTIAL_NAME, _scan_partial)
+    except Exception as e:
+        # NOTE: a damaged package can fail in many ways (BadZipFile,
+        #       zlib.error, EOFError, ParseError, ...); none stops the scan
+        my_index = empty_partial()
+        my_index['errors'][path] = str(e) or type(e).__name__
+        return my_index
+
+    # Cached partials are stored without the file name
+    my_index['files'] = {path: my_index['files']['']}
+    for k in ('postings', 'counts'):
+        for t, files in my_index[k].items():
+            my_index[k][t] = {path: files['']}
+    return my_index
+
+
+def write_table(rows, out_file):
+    """
+    Writes a corpus table (see partial_table) to a .csv, .json or .docx file
+    """
+    header = ["abbreviation", "definition", "file", "paragraph", "count",
+              "files"]
+    ext = os.path.splitext(out_file)[1].lower()
+    if ext == ".csv":
+        with open(out_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+    elif ext == ".json":
+        with open(out_file, 'w') as f:
+            json.dump([dict(zip(header, row)) for row in rows], f, indent=2)
+    elif ext == ".docx":
+        my_doc = docx.Document()
+        my_table = my_doc.add_table(rows=1, cols=len(header))
+        if "Table Grid" in my_doc.styles:
+            my_table.style = my_doc.styles["Table Grid"]
+        for j in range(len(header)):
+            my_table.rows[0].cells[j].text = header[j]
+        for row in rows:
+            cells = my_table.add_row().cells
+            for j in range(len(header)):
+                cells[j].text = "" if row[j] is None else str(row[j])
+        my_doc.save(out_file)
+    else:
+        raise ValueError("Unknown table format '%s'" % (ext))
+
+
+def _add_partial(out, p):
+    """
+    Merges a partial index into another one, in place (see merge_partials)
+    """
+    out['files'].update(p['files'])
+    out['errors'].update(p['errors'])
+    for abbr, defs in p['definitions'].items():
+        my_defs = out['definitions'].setdefault(abbr, {})
+        for definition, n in defs.items():
+            my_defs[definition] = my_defs.get(definition, 0) + n
+    for t, files in p['postings'].items():
+        my_files = out['postings'].setdefault(t, {})
+        for name, idx in files.items():
+            if name in my_files:
+                my_files[name] = sorted(set(my_files[name]) | set(idx))
+            else:
+                my_files[name] = list(idx)
+    for t, files in p['counts'].items():
+        # A file's count is the same in every partial that has it
+        out['counts'].setdefault(t, {}).update(files)
+
+
+def _init_worker(cache_path):
+    """
+    Opens the worker's analysis cache, if any; it is closed, writing its
+    access times, when the worker exits
+    """
+    if cache_path:
+        _CACHE['cache'] = AnalysisCache(cache_path)
+        # NOTE: pool workers skip atexit, but run multiprocessing finalizers
+        multiprocessing.util.Finalize(
+            None, _CACHE['cache'].close, exitpriority=0)
+
+
+def _scan_job(path):
+    """
+    Returns the partial index of one file and the worker's cache hits and
+    misses for it
+    """
+    my_cache = _CACHE.get('cache')
+    if my_cache is None:
+        return (scan_file(path), 0, 0)
+    hits = my_cache.hits
+    misses = my_cache.misses
+    partial = scan_file(path, my_cache)
+    return (partial, my_cache.hits - hits, my_cache.misses - misses)
+
+
+def _scan_partial(path):
+    """
+    Returns the partial index of one file, under an empty file name
+    """
+    my_scanner = AbbrScanner()
+    for i, para_id, style_id, text in iter_paragraphs(path):
+        my_scanner.scan_paragraph(i, text)
+    return my_scanner.partial("")
+
+
 ##############################################################################
 # MAIN
 ##############################################################################
 if __name__ == '__main__':
-    docx_file = "example-3.docx"
-    docx_path = os.path.join("examples", docx_file)
-    my_doc = docx.Document(docx_path)
-    my_paras = read_paragraphs(my_doc)
-    my_keys = sorted(list(my_paras.keys()))
-    for k in my_keys:
-        print(k, my_paras[k]['text'])
-        # TODO: search for abbreviations
-        # exclude parentheticals starting with "e.g.", "i.e.", "see", "refer"
-        # find both abbreviation definitions and definition abbreviations
+    # User inputs (defaults may be overridden on the command line):
+    p = argparse.ArgumentParser(
+        description="Finds abbreviations and their definitions in .docx files")
+    p.add_argument("files", nargs="*", help=".docx files to scan")
+    p.add_argument("-d", "--dir", default="examples",
+                   help="where to look for the input documents")
+    p.add_argument("-k", "--key", default="example-3",
+                   help="keyword for finding the right input documents")
+    p.add_argument("-w", "--workers", type=int, default=1,
+                   help="number of worker processes")
+    p.add_argument("-p", "--partial", default=None,
+                   help="write the partial index to this JSON file")
+    p.add_argument("-m", "--merge", action="append", default=[],
+                   help="partial index JSON file to merge in (repeatable)")
+    p.add_argument("-o", "--out", default=None,
+                   help="write the table to this .csv, .json or .docx file")
+    p.add_argument("-c", "--cache", default=None,
+                   help="SQLite file for caching results between runs")
+    args = p.parse_args()
+    instrument_from_env()
+
+    my_files = args.files
+    if not my_files and not args.merge:
+        my_files = find_word_files(args.dir, args.key)
+
+    my_index = scan_corpus(my_files, args.workers, args.cache)
+    for path in args.merge:
+        my_index = merge_partials(my_index, load_partial(path))
+    for path, err in my_index['errors'].items():
+        print("FAILED {}: {}".format(path, err))
+    if args.partial:
+        save_partial(my_index, args.partial)
+
+    my_rows = partial_table(my_index)
+    if args.out:
+        write_table(my_rows, args.out)
+    else:
+        for row in my_rows:
+            print("\t".join("" if x is None else str(x) for x in row))
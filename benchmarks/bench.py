@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+#
+# bench.py
+#
+# Times the split, merge, restyle, image and style-listing paths on
+# synthetic documents of increasing size (see docx_gen.py). Each case runs
+# in its own child process so that its peak resident memory is its own.
+# Results are written to JSON, and may be compared with an earlier run.
+#
+# Example:
+#   python benchmarks/bench.py --sizes 1000 10000 --out new.json
+#   python benchmarks/bench.py --sizes 1000 10000 --compare old.json
+#
+##############################################################################
+# REQUIRED MODULES
+##############################################################################
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import docx
+from docx.enum.section import WD_SECTION
+
+from abbr_finder import scan_file
+from docx_gen import make_docx
+from docx_merger import merge_files
+from docx_merger import stream_merge_files
+from docx_parser import parse_file
+from docx_parser import split_document
+from docx_restyler import add_custom_para_style
+from docx_restyler import apply_style
+from docx_restyler import restyle_xml
+from docx_utils import list_paragraph_styles
+from docx_utils import DocxPics
+
+
+##############################################################################
+# GLOBAL VARIABLES
+##############################################################################
+STYLE_MAP = {'Heading1': 'New Head1', 'Normal': 'New Normal'}
+STYLE_DIR = os.path.join(REPO_DIR, "styles")
+
+# Benchmark cases; each is run by the function bench_<case>
+CASES = (
+    'list_styles',
+    'list_styles_stream',
+    'parse_file',
+    'split_document',
+    'merge_runs',
+    'merge_xml',
+    'merge_stream',
+    'restyle',
+    'restyle_xml',
+    'docx_pics',
+    'docx_pics_stream',
+    'abbr_scan',
+)
+
+
+##############################################################################
+# FUNCTIONS
+##############################################################################
+def bench_abbr_scan(doc, work_dir):
+    """Scans a file for abbreviations (abbr_finder.scan_file)"""
+    scan_file(doc)
+    return 1
+
+
+def bench_docx_pics(doc, work_dir):
+    """Finds the images of a file (DocxPics)"""
+    DocxPics(doc).close()
+    return 1
+
+
+def bench_docx_pics_stream(doc, work_dir):
+    """Finds the images of a file, streamed (DocxPics)"""
+    DocxPics(doc, stream=True).close()
+    return 1
+
+
+def bench_list_styles(doc, work_dir):
+    """Counts paragraph styles of an open Document"""
+    list_paragraph_styles(docx.Document(doc))
+    return 1
+
+
+def bench_list_styles_stream(doc, work_dir):
+    """Counts paragraph styles of a file, streamed"""
+    list_paragraph_styles(doc)
+    return 1
+
+
+def bench_merge_runs(doc, work_dir):
+    """Merges two copies of a file, run by run"""
+    merge_files([doc, doc], WD_SECTION.NEW_PAGE, "runs").save(
+        os.path.join(work_dir, "merged.docx"))
+    return 2
+
+
+def bench_merge_stream(doc, work_dir):
+    """Merges two copies of a file, streamed"""
+    stream_merge_files(
+        [doc, doc], os.path.join(work_dir, "merged.docx"), WD_SECTION.NEW_PAGE)
+    return 2
+
+
+def bench_merge_xml(doc, work_dir):
+    """Merges two copies of a file, by XML element"""
+    merge_files([doc, doc], WD_SECTION.NEW_PAGE, "xml").save(
+        os.path.join(work_dir, "merged.docx"))
+    return 2
+
+
+def bench_parse_file(doc, work_dir):
+    """Writes the first chapter of a file (parse_file)"""
+    os.chdir(work_dir)  # parse_file writes to the working directory
+    parse_file(doc, "Heading1", 0)
+    return 1
+
+
+def bench_restyle(doc, work_dir):
+    """Adds the custom styles, applies them and saves"""
+    d = docx.Document(doc)
+    for new_style in STYLE_MAP.values():
+        add_custom_para_style(d, new_style, STYLE_DIR)
+    apply_style(d, STYLE_MAP)
+    d.save(os.path.join(work_dir, "styled.docx"))
+    return 1
+
+
+def bench_restyle_xml(doc, work_dir):
+    """Restyles a file without python-docx (restyle_xml)"""
+    restyle_xml(doc, STYLE_MAP, os.path.join(work_dir, "styled.docx"),
+                STYLE_DIR)
+    return 1
+
+
+def bench_split_document(doc, work_dir):
+    """Writes every chapter of a file (split_document)"""
+    split_document(doc, "Heading1", work_dir)
+    return 1
+
+
+def compare_results(old, new, threshold=0.1):
+    """
+    Name:     compare_results
+    Inputs:   - dict, results of an earlier run (old)
+              - dict, results of this run (new)
+              - float, relative slow-down reported as a regression
+                (threshold)
+    Outputs:  int, number of regressions
+    Features: Prints the time and peak memory of each case in both runs
+    """
+    old_res = dict(
+        ((r['case'], r['size']), r) for r in old['results'] if not r['error'])
+    num_slower = 0
+    print("{:<24} {:>8} {:>10} {:>10} {:>7} {:>10} {:>10}".format(
+        "case", "size", "old s", "new s", "ratio", "old MB", "new MB"))
+    for r in new['results']:
+        o = old_res.get((r['case'], r['size']))
+        if o is None or r['error']:
+            continue
+        ratio = r['seconds'] / o['seconds'] if o['seconds'] else 0.0
+        flag = ""
+        if ratio > 1.0 + threshold:
+            flag = " SLOWER"
+            num_slower += 1
+        elif ratio < 1.0 - threshold:
+            flag = " faster"
+        print("{:<24} {:>8} {:>10.3f} {:>10.3f} {:>7.2f} {:>10.1f} "
+              "{:>10.1f}{}".format(
+                  r['case'], r['size'], o['seconds'], r['seconds'], ratio,
+                  o['peak_rss_kb'] / 1024.0, r['peak_rss_kb'] / 1024.0, flag))
+    print("{} regression(s) beyond {:.0%}; old revision {}, new {}.".format(
+        num_slower, threshold, old.get('revision'), new.get('revision')))
+    return num_slower
+
+
+def git_revision():
+    """
+    Name:     git_revision
+    Inputs:   None
+    Outputs:  str, the repository's current commit (None if unknown)
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_kb():
+    """
+    Name:     peak_rss_kb
+    Inputs:   None
+    Outputs:  float, peak resident memory of this process in KiB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # macOS reports bytes
+        rss /= 1024.0
+    return float(rss)
+
+
+def run_case(case, doc, work_dir, paras, timeout):
+    """
+    Name:     run_case
+    Inputs:   - str, case name (case)
+              - str, path to the synthetic document (doc)
+              - str, scratch directory for the case's output (work_dir)
+              - int, paragraphs in the document (paras)
+              - float, seconds before the case is stopped (timeout)
+    Outputs:  dict, the case's time, memory and throughput, or error
+    Features: Runs the case in a child process
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", case, doc,
+           work_dir]
+    try:
+        p = subprocess.run(cmd, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {'error': "timed out after %g s" % (timeout)}
+    if p.returncode != 0:
+        err = p.stderr.decode("utf-8", "replace").strip().splitlines()
+        return {'error': err[-1] if err else "exit %d" % (p.returncode)}
+    res = json.loads(p.stdout.decode("utf-8").strip().splitlines()[-1])
+    res['paras_per_sec'] = (
+        paras * res.pop('multiple') / res['seconds'] if res['seconds'] else 0)
+    res['error'] = None
+    return res
+
+
+def run_child(case, doc, work_dir):
+    """
+    Name:     run_child
+    Inputs:   - str, case name (case)
+              - str, path to the synthetic document (doc)
+              - str, scratch directory for the case's output (work_dir)
+    Outputs:  None
+    Features: Times one case in this process and prints its result as JSON
+    """
+    func = globals()["bench_" + case]
+    base_rss = peak_rss_kb()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            t0 = time.perf_counter()
+            multiple = func(doc, work_dir)
+            seconds = time.perf_counter() - t0
+    print(json.dumps({
+        'seconds': seconds,
+        'base_rss_kb': base_rss,
+        'peak_rss_kb': peak_rss_kb(),
+        'multiple': multiple
+    }))
+
+
+def run_sweep(sizes, cases, work_dir, repeat=1, timeout=600.0, runs=3):
+    """
+    Name:     run_sweep
+    Inputs:   - list, document sizes in paragraphs (sizes)
+              - list, case names (cases)
+              - str, directory for the documents and outputs (work_dir)
+              - int, runs of each case; the fastest is kept (repeat)
+              - float, seconds before a case is stopped (timeout)
+              - int, runs per paragraph of the documents (runs)
+    Outputs:  dict, run information and a list of results
+    Depends:  - make_docx
+              - run_case
+    """
+    results = []
+    for size in sizes:
+        doc = os.path.join(work_dir, "bench_%d.docx" % (size))
+        counts = make_docx(doc, paras=size, runs=runs,
+                           chapters=max(1, size // 100),
+                           images=size // 100, tables=size // 200)
+        for case in cases:
+            case_dir = tempfile.mkdtemp(prefix=case + "_", dir=work_dir)
+            best = None
+            for k in range(repeat):
+                res = run_case(case, doc, case_dir, size, timeout)
+                if res['error'] or best is None or (
+                        res['seconds'] < best['seconds']):
+                    best = res
+                if res['error']:
+                    break
+            best.update({'case': case, 'size': size, 'counts': counts})
+            results.append(best)
+            if best['error']:
+                print("{:<24} {:>8}  FAILED: {}".format(
+                    case, size, best['error']))
+            else:
+                print("{:<24} {:>8} {:>9.3f} s {:>9.1f} MB {:>12.0f} "
+                      "para/s".format(case, size, best['seconds'],
+                                      best['peak_rss_kb'] / 1024.0,
+                                      best['paras_per_sec']))
+    return {
+        'revision': git_revision(),
+        'date': datetime.datetime.now().isoformat(timespec="seconds"),
+        'python': platform.python_version(),
+        'python_docx': getattr(docx, "__version__", None),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': results
+    }
+
+
+##############################################################################
+# MAIN
+##############################################################################
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == "--child":
+        run_child(*sys.argv[2:])
+        sys.exit(0)
+
+    p = argparse.ArgumentParser(
+        description="Times the .docx tools on synthetic documents")
+    p.add_argument("-s", "--sizes", type=int, nargs="+",
+                   default=[1000, 5000, 20000],
+                   help="document sizes in paragraphs")
+    p.add_argument("-c", "--cases", nargs="+", choices=CASES,
+                   default=list(CASES), help="cases to run")
+    p.add_argument("-r", "--repeat", type=int, default=1,
+                   help="runs of each case; the fastest is kept")
+    p.add_argument("--runs", type=int, default=3,
+                   help="runs per paragraph of the synthetic documents")
+    p.add_argument("-t", "--timeout", type=float, default=600.0,
+                   help="seconds before a case is stopped")
+    p.add_argument("-w", "--work-dir", default=None,
+                   help="directory for documents and outputs; default is "
+                        "a new temporary directory, removed afterwards")
+    p.add_argument("-o", "--out", default=None,
+                   help="write the results to this JSON file")
+    p.add_argument("--compare", default=None,
+                   help="earlier results JSON to compare with")
+    p.add_argument("--threshold", type=float, default=0.1,
+                   help="relative slow-down reported as a regression")
+    args = p.parse_args()
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="docx_bench_")
+    else:
+        os.makedirs(work_dir, exist_ok=True)
+    try:
+        my_results = run_sweep(args.sizes, args.cases, work_dir,
+                               args.repeat, args.timeout, args.runs)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(my_results, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            my_old = json.load(f)
+        if compare_results(my_old, my_results, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+#
+# docx_gen.py
+#
+# Writes synthetic .docx files of a given size (paragraphs, runs, styles,
+# images and tables) for the benchmarks. The package is written directly,
+# on top of python-docx's default template, so that generating a large
+# document takes seconds.
+#
+##############################################################################
+# REQUIRED MODULES
+##############################################################################
+import argparse
+import io
+import struct
+from xml.sax.saxutils import escape
+from zipfile import ZIP_DEFLATED
+from zipfile import ZipFile
+import zlib
+
+import docx
+
+
+##############################################################################
+# GLOBAL VARIABLES
+##############################################################################
+DOC_NAME = "word/document.xml"
+RELS_NAME = "word/_rels/document.xml.rels"
+CT_NAME = "[Content_Types].xml"
+
+# Namespace declarations of the generated document.xml
+DOC_NS = (
+    'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/'
+    'relationships" '
+    'xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/'
+    'wordprocessingDrawing" '
+    'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture" '
+    'xmlns:w14="http://schemas.microsoft.com/office/word/2010/wordml"'
+)
+IMAGE_REL = ("http://schemas.openxmlformats.org/officeDocument/2006/"
+             "relationships/image")
+
+# Body paragraph styles used in turn (None is the default style)
+BODY_STYLES = (None, "ListBullet", None, "Heading2", None, "Quote")
+
+# Filler text; the parenthetical gives abbr_finder something to find
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+# The image inline, sized 1 x 1 inch
+DRAWING = (
+    '<w:r><w:drawing><wp:inline distT="0" distB="0" distL="0" distR="0">'
+    '<wp:extent cx="914400" cy="914400"/>'
+    '<wp:docPr id="{n}" name="Picture {n}"/>'
+    '<a:graphic><a:graphicData '
+    'uri="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<pic:pic><pic:nvPicPr><pic:cNvPr id="{n}" name="image{k}.png"/>'
+    '<pic:cNvPicPr/></pic:nvPicPr><pic:blipFill>'
+    '<a:blip r:embed="rIdImg{k}"/><a:stretch><a:fillRect/></a:stretch>'
+    '</pic:blipFill><pic:spPr><a:xfrm><a:off x="0" y="0"/>'
+    '<a:ext cx="914400" cy="914400"/></a:xfrm><a:prstGeom prst="rect"/>'
+    '</pic:spPr></pic:pic></a:graphicData></a:graphic></wp:inline>'
+    '</w:drawing></w:r>'
+)
+
+
+##############################################################################
+# FUNCTIONS
+##############################################################################
+def make_docx(out_file, paras=1000, runs=3, chapters=10, images=0,
+              tables=0, table_size=(3, 3), distinct_images=8):
+    """
+    Name:     make_docx
+    Inputs:   - str, path for the new .docx (out_file)
+              - int, number of body paragraphs (paras)
+              - int, runs per paragraph (runs)
+              - int, number of Heading 1 paragraphs, spread evenly (chapters)
+              - int, number of image paragraphs, spread evenly (images)
+              - int, number of tables, spread evenly (tables)
+              - tuple, rows and columns of each table (table_size)
+              - int, number of different image files; at least one if
+                there are images (distinct_images)
+    Outputs:  dict, counts of what was written
+    Features: Writes a .docx whose body has the given number of paragraphs
+              (including headings and image paragraphs), with runs that
+              alternate bold and italic, several paragraph styles, and
+              tables between paragraphs
+    Depends:  - make_png
+              - _paragraph_xml
+    """
+    num_images = min(images, paras)
+    num_distinct = min(distinct_images, num_images)
+    if num_images > 0:
+        # Every image paragraph needs a file to point at
+        num_distinct = max(num_distinct, 1)
+    heads = _spread(chapters, paras)
+    pics = _spread(num_images, paras, 1)
+    tbls = _spread(tables, paras)
+
+    # Start from python-docx's default template
+    my_buf = io.BytesIO()
+    docx.Document().save(my_buf)
+    with ZipFile(my_buf, 'r') as zin, \
+            ZipFile(out_file, 'w', ZIP_DEFLATED) as zout:
+        for name in zin.namelist():
+            if name in (DOC_NAME, RELS_NAME, CT_NAME):
+                continue
+            zout.writestr(name, zin.read(name))
+
+        # Images and their relationships
+        my_rels = zin.read(RELS_NAME).decode("utf-8")
+        new_rels = []
+        for k in range(num_distinct):
+            zout.writestr("word/media/image%d.png" % (k), make_png(
+                16, 16, ((40 * k) % 256, (90 * k) % 256, (150 * k) % 256)))
+            new_rels.append(
+                '<Relationship Id="rIdImg%d" Type="%s" '
+                'Target="media/image%d.png"/>' % (k, IMAGE_REL, k))
+        zout.writestr(RELS_NAME, my_rels.replace(
+            "</Relationships>", "".join(new_rels) + "</Relationships>"))
+        my_ct = zin.read(CT_NAME).decode("utf-8")
+        if num_distinct and 'Extension="png"' not in my_ct:
+            my_ct = my_ct.replace(
+                "<Default ",
+                '<Default Extension="png" ContentType="image/png"/><Default ',
+                1)
+        zout.writestr(CT_NAME, my_ct)
+
+        # Body, written a paragraph at a time
+        with zout.open(DOC_NAME, 'w') as f:
+            f.write(('<?xml version="1.0" encoding="UTF-8" '
+                     'standalone="yes"?>\n<w:document %s><w:body>' % (
+                         DOC_NS)).encode("utf-8"))
+            num_heads = 0
+            num_pics = 0
+            num_tables = 0
+            for i in range(paras):
+                if i in heads:
+                    num_heads += 1
+                    my_xml = _paragraph_xml(
+                        i, "Heading1", ["Chapter %d" % (num_heads)])
+                elif i in pics:
+                    k = num_pics % num_distinct
+                    num_pics += 1
+                    my_xml = _paragraph_xml(
+                        i, None, [], DRAWING.format(n=num_pics, k=k))
+                else:
+                    my_style = BODY_STYLES[i % len(BODY_STYLES)]
+                    texts = []
+                    for j in range(runs):
+                        w0 = (i * 7 + j * 3) % len(WORDS)
+                        texts.append(" ".join(
+                            WORDS[(w0 + x) % len(WORDS)] for x in range(6)
+                        ) + " ")
+                    if i % 5 == 0 and texts:
+                        texts[-1] += "Text Abbreviation Generator (TAG) "
+                    my_xml = _paragraph_xml(i, my_style, texts)
+                f.write(my_xml.encode("utf-8"))
+                if i in tbls:
+                    num_tables += 1
+                    f.write(_table_xml(num_tables, *table_size).encode(
+                        "utf-8"))
+            f.write(('<w:sectPr><w:pgSz w:w="12240" w:h="15840"/>'
+                     '<w:pgMar w:top="1440" w:right="1440" w:bottom="1440" '
+                     'w:left="1440" w:header="720" w:footer="720" '
+                     'w:gutter="0"/></w:sectPr></w:body></w:document>'
+                     ).encode("utf-8"))
+    return {
+        'paras': paras,
+        'runs': runs,
+        'chapters': num_heads,
+        'images': num_pics,
+        'tables': num_tables
+    }
+
+
+def make_png(width, height, rgb):
+    """
+    Name:     make_png
+    Inputs:   - int, image width in pixels (width)
+              - int, image height in pixels (height)
+              - tuple, red, green and blue values (rgb)
+    Outputs:  bytes, a single-colour PNG image
+    """
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    row = b"\x00" + bytes(rgb) * width
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(row * height)),
+        chunk(b"IEND", b"")
+    ])
+
+
+def _paragraph_xml(i, style, texts, extra=""):
+    """
+    Name:     _paragraph_xml
+    Inputs:   - int, paragraph index (i)
+              - str, paragraph style ID; None for the default (style)
+              - list, text of each run (texts)
+              - str, XML of any other runs (extra)
+    Outputs:  str, a w:p element
+    """
+    my_xml = ['<w:p w14:paraId="%08X">' % (i + 1)]
+    if style:
+        my_xml.append('<w:pPr><w:pStyle w:val="%s"/></w:pPr>' % (style))
+    for j in range(len(texts)):
+        if j % 3 == 1:
+            my_xml.append('<w:r><w:rPr><w:b/></w:rPr>')
+        elif j % 3 == 2:
+            my_xml.append('<w:r><w:rPr><w:i/></w:rPr>')
+        else:
+            my_xml.append('<w:r>')
+        my_xml.append('<w:t xml:space="preserve">%s</w:t></w:r>' % (
+            escape(texts[j])))
+    my_xml.append(extra)
+    my_xml.append('</w:p>')
+    return "".join(my_xml)
+
+
+def _spread(n, total, offset=0):
+    """
+    Name:     _spread
+    Inputs:   - int, number of positions (n)
+              - int, number of slots (total)
+              - int, position of the first (offset)
+    Outputs:  set, n positions spread evenly over the slots
+    """
+    if n <= 0 or total <= 0:
+        return set()
+    n = min(n, total)
+    return set((int(k * total / n) + offset) % total for k in range(n))
+
+
+def _table_xml(k, rows, cols):
+    """
+    Name:     _table_xml
+    Inputs:   - int, table number (k)
+              - int, number of rows (rows)
+              - int, number of columns (cols)
+    Outputs:  str, a w:tbl element
+    """
+    my_xml = ['<w:tbl><w:tblPr><w:tblW w:w="0" w:type="auto"/></w:tblPr>'
+              '<w:tblGrid>']
+    my_xml.append('<w:gridCol w:w="%d"/>' % (9360 // cols) * cols)
+    my_xml.append('</w:tblGrid>')
+    for r in range(rows):
+        my_xml.append('<w:tr>')
+        for c in range(cols):
+            my_xml.append(
+                '<w:tc><w:tcPr><w:tcW w:w="%d" w:type="dxa"/></w:tcPr>'
+                '<w:p><w:r><w:t>T%d R%d C%d</w:t></w:r></w:p></w:tc>' % (
+                    9360 // cols, k, r, c))
+        my_xml.append('</w:tr>')
+    my_xml.append('</w:tbl>')
+    return "".join(my_xml)
+
+
+##############################################################################
+# MAIN
+##############################################################################
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description="Writes a synthetic .docx")
+    p.add_argument("out_file", help="path for the new .docx")
+    p.add_argument("-p", "--paras", type=int, default=1000,
+                   help="number of body paragraphs")
+    p.add_argument("-r", "--runs", type=int, default=3,
+                   help="runs per paragraph")
+    p.add_argument("-c", "--chapters", type=int, default=10,
+                   help="number of Heading 1 paragraphs")
+    p.add_argument("-i", "--images", type=int, default=0,
+                   help="number of image paragraphs")
+    p.add_argument("-t", "--tables", type=int, default=0,
+                   help="number of tables")
+    args = p.parse_args()
+    print(make_docx(args.out_file, args.paras, args.runs, args.chapters,
+                    args.images, args.tables))
@@ -28,41 +28,926 @@
 ##############################################################################
 # REQUIRED MODULES
 ##############################################################################
+import argparse
+import copy
+import json
 import os
+import posixpath
+import re
+import shutil
+import struct
+import tempfile
+import time
+from xml.sax.saxutils import quoteattr
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+from zipfile import ZipFile
+from zipfile import ZipInfo
+import xml.etree.ElementTree as ElementTree
 
-import docx
 from docx.enum.section import WD_SECTION
+from docx.opc.constants import CONTENT_TYPE as CT
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.packuri import PackURI
+from docx.opc.part import Part
+from docx.opc.part import XmlPart
+from docx.opc.oxml import serialize_part_xml
+from docx.oxml import OxmlElement
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn
+from docx.parts.image import ImagePart
+from docx.parts.numbering import NumberingPart
 
-from docx_utils import delete_paragraph
+from docx_utils import add_count
+from docx_utils import open_docx_zip
+from docx_utils import open_document
+from docx_utils import find_main_part
+from docx_utils import find_related_part
 from docx_utils import find_word_files
+from docx_utils import get_template_cache
+from docx_utils import instrument_from_env
 from docx_utils import match_char_style
 from docx_utils import match_sect_properties
+from docx_utils import package_digest
+from docx_utils import timed
+from docx_utils import DocxPackage
+from docx_utils import COPY_CHUNK
+from docx_utils import R_NS
+from docx_utils import W_NS
+
+
+##############################################################################
+# GLOBAL VARIABLES
+##############################################################################
+R_PREFIX = "{%s}" % R_NS  # Clark prefix of relationship ID attributes
+
+# Package index names and namespaces
+CT_NAME = "[Content_Types].xml"
+CT_NS = "http://schemas.openxmlformats.org/package/2006/content-types"
+PR_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+XML_DECL = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n'
+
+# Document relationships that only the first file keeps when streaming
+SHARED_RELS = ('comments', 'commentsExtended', 'commentsExtensible',
+               'commentsIds', 'customXml', 'endnotes', 'fontTable',
+               'footnotes', 'glossaryDocument', 'numbering', 'people',
+               'settings', 'styles', 'stylesWithEffects', 'theme',
+               'webSettings')
+
+STYLE_REFS = (qn('w:pStyle'), qn('w:rStyle'), qn('w:tblStyle'))
+STYLE_LINKS = (qn('w:basedOn'), qn('w:next'), qn('w:link'))
+
+# Notes and comments copied by copy_notes and _SharedParts: relationship
+# type, content type, part name, note element and the elements that refer to
+# a note by w:id
+NOTE_PARTS = (
+    (RT.FOOTNOTES, CT.WML_FOOTNOTES, "footnotes", qn('w:footnote'),
+     (qn('w:footnoteReference'),)),
+    (RT.ENDNOTES, CT.WML_ENDNOTES, "endnotes", qn('w:endnote'),
+     (qn('w:endnoteReference'),)),
+    (RT.COMMENTS, CT.WML_COMMENTS, "comments", qn('w:comment'),
+     (qn('w:commentRangeStart'), qn('w:commentRangeEnd'),
+      qn('w:commentReference'))),
+)
+
+# Elements that refer to a note or comment, with the name of its part
+NOTE_REFS = dict(
+    (tag, name) for reltype, ctype, name, note_tag, ref_tags in NOTE_PARTS
+    for tag in ref_tags)
+
+# w:sectPr children that come before w:type
+SECT_HEAD = (qn('w:headerReference'), qn('w:footerReference'),
+             qn('w:footnotePr'), qn('w:endnotePr'))
+
+
+##############################################################################
+# CLASSES
+##############################################################################
+class _CountingWriter(object):
+    """
+    Name:     _CountingWriter
+    Features: Writable file that counts, and optionally keeps, the bytes
+              written through it
+    """
+    def __init__(self, f, keep=False):
+        self.f = f
+        self.num_bytes = 0
+        self.data = [] if keep else None
+
+    def getvalue(self):
+        return b"".join(self.data)
+
+    def write(self, data):
+        self.num_bytes += len(data)
+        if self.data is not None:
+            self.data.append(data)
+        return self.f.write(data)
+
+
+class _SharedParts(object):
+    """
+    Name:     _SharedParts
+    Features: The styles, list definitions, notes and comments of a
+              streamed merge: the first input's, plus the ones later inputs
+              use that it lacks
+    """
+    def __init__(self, src, zin):
+        """
+        Name:     _SharedParts.__init__
+        Inputs:   - str, path to (or DocxPackage of) the first input (src)
+                  - zipfile.ZipFile, the first input, open (zin)
+        Depends:  - find_main_part
+                  - _read_part
+        """
+        self.src = src
+        self.styles_name, self.styles = _read_part(zin, "styles")
+        self.numbering_name, self.numbering = _read_part(zin, "numbering")
+        self.changed = False
+        self.style_ids = set()
+        self.taken = set()   # numIds in use
+        if self.styles is not None:
+            self.style_ids.update(self.styles.xpath('./w:style/@w:styleId'))
+        if self.numbering is not None:
+            self.taken.update(self.numbering.xpath('./w:num/@w:numId'))
+        self.next_num = 1 + max([int(v) for v in self.taken] + [0])
+
+        # Notes and comments parts (member name, XML and relationships,
+        # if any) and the IDs in use, by part name
+        self.doc_dir = posixpath.dirname(find_main_part(zin))
+        self.notes = {}
+        self.note_ids = {}
+        self.next_note = {}
+        self.created = []    # relationship, part name and content type
+        for reltype, ctype, kind, note_tag, ref_tags in NOTE_PARTS:
+            name, root = _read_part(zin, kind)
+            self.note_ids[kind] = set()
+            if root is not None:
+                head, tail = posixpath.split(name)
+                try:
+                    rels = ElementTree.fromstring(zin.read(
+                        posixpath.join(head, "_rels", tail + ".rels")))
+                except KeyError:
+                    rels = None
+                self.notes[kind] = [name, root, rels]
+                for note in root.iterchildren(note_tag):
+                    self.note_ids[kind].add(note.get(qn('w:id')))
+            self.next_note[kind] = 1 + max(
+                [int(v) for v in self.note_ids[kind]] + [0])
+
+    def add(self, src, zin, refs, num_map, note_map, note_rels):
+        """
+        Name:     _SharedParts.add
+        Inputs:   - str, path to (or DocxPackage of) a later input (src)
+                  - zipfile.ZipFile, the later input, open (zin)
+                  - dict, shared parts, style IDs, numIds and notes its
+                    body refers to (refs)
+                  - dict, new numIds by its numIds (num_map)
+                  - dict, new note and comment IDs by part name and its
+                    IDs (note_map)
+                  - dict, relationships of its notes and comments, by
+                    part name and relationship ID (note_rels)
+        Outputs:  None
+        Features: Adds the styles the input uses and the output lacks,
+                  with those they are based on or linked to, the list
+                  definitions it uses, under their new numIds, and the
+                  notes and comments it refers to, under their new IDs (a
+                  part for them is made if the output has none); raises
+                  ValueError if it uses lists the output has no numbering
+                  part for
+        Depends:  - _copy_lists
+                  - _read_part
+                  - _remap_list
+        """
+        todo = sorted(refs['styles'] - self.style_ids)
+        my_styles = {}
+        if todo and self.styles is not None:
+            my_part = _read_part(zin, "styles")[1]
+            if my_part is not None:
+                for style in my_part.iterchildren(qn('w:style')):
+                    my_styles[style.get(qn('w:styleId'))] = style
+        while todo:
+            style_id = todo.pop()
+            if style_id in self.style_ids or style_id not in my_styles:
+                continue
+            style = copy.deepcopy(my_styles[style_id])
+            for node in style.iter():
+                if node.tag in STYLE_LINKS:
+                    todo.append(node.get(qn('w:val')))
+                elif node.tag == qn('w:numId'):
+                    _remap_list(node, refs, num_map)
+            self.styles.append(style)
+            self.style_ids.add(style_id)
+            self.changed = True
+
+        if refs['parts']:
+            if isinstance(src, DocxPackage):
+                src = src.path
+            raise ValueError(
+                "%s uses its own %s, which a stream merge takes from the "
+                "first input only; merge it with the 'xml' mode" % (
+                    src, " and ".join(sorted(refs['parts']))))
+        if refs['lists']:
+            _copy_lists(_read_part(zin, "numbering")[1], self.numbering, {
+                v: num_map[v] for v in sorted(refs['lists'], key=int)})
+            self.changed = True
+
+        for reltype, ctype, kind, note_tag, ref_tags in NOTE_PARTS:
+            todo = sorted([v for k, v in refs['notes'] if k == kind],
+                          key=int)
+            if not todo:
+                continue
+            src_root = _read_part(zin, kind)[1]
+            if kind not in self.notes:
+                # Start from the input's separators (the notes with a
+                # w:type)
+                my_root = copy.deepcopy(src_root)
+                for note in list(my_root):
+                    if note.get(qn('w:type')) is None:
+                        my_root.remove(note)
+                name = posixpath.join(self.doc_dir, kind + ".xml")
+                self.notes[kind] = [name, my_root, None]
+                self.created.append((
+                    {'Id': "rId" + kind, 'Type': reltype,
+                     'Target': kind + ".xml"}, "/" + name, ctype))
+            my_notes = {}
+            for note in src_root.iterchildren(note_tag):
+                my_notes[note.get(qn('w:id'))] = note
+            rid_map = {}
+            for k, attrs in note_rels.get(kind, {}).items():
+                if self.notes[kind][2] is None:
+                    self.notes[kind][2] = ElementTree.Element(
+                        "{%s}Relationships" % PR_NS)
+                ElementTree.SubElement(
+                    self.notes[kind][2], "{%s}Relationship" % PR_NS, attrs)
+                rid_map[k] = attrs['Id']
+            for v in todo:
+                note = copy.deepcopy(my_notes[v])
+                note.set(qn('w:id'), note_map[kind][v])
+                for node in note.iter():
+                    for k, rid in node.attrib.items():
+                        if k.startswith(R_PREFIX) and rid in rid_map:
+                            node.set(k, rid_map[rid])
+                self.notes[kind][1].append(note)
+            self.changed = True
+
+    def members(self):
+        """
+        Name:     _SharedParts.members
+        Inputs:   None
+        Outputs:  dict, planned member copies (input, source member,
+                  output member and data) of the styles, numbering, notes
+                  and comments (and their relationships) by member name
+        """
+        my_parts = {}
+        for name, part in ((self.styles_name, self.styles),
+                           (self.numbering_name, self.numbering)):
+            if part is not None:
+                my_parts[name] = (self.src, name, name,
+                                  serialize_part_xml(part))
+        for name, part, rels in self.notes.values():
+            my_parts[name] = (self.src, name, name, serialize_part_xml(part))
+            if rels is not None:
+                head, tail = posixpath.split(name)
+                rels_name = posixpath.join(head, "_rels", tail + ".rels")
+                my_parts[rels_name] = (self.src, rels_name, rels_name,
+                                       _package_xml(rels))
+        return my_parts
+
+    def plan_lists(self, zin):
+        """
+        Name:     _SharedParts.plan_lists
+        Inputs:   zipfile.ZipFile, a later input, open (zin)
+        Outputs:  dict, new numIds by the input's numIds; None if the input
+                  has list definitions and the output no numbering part
+        Depends:  _read_part
+        """
+        src_num = _read_part(zin, "numbering")[1]
+        if src_num is None:
+            return {}
+        num_ids = src_num.xpath('./w:num/@w:numId')
+        if self.numbering is None:
+            return None if num_ids else {}
+        num_map = {}
+        for v in num_ids:
+            num_map[v] = str(self.next_num)
+            self.next_num += 1
+        self.taken.update(num_map.values())
+        return num_map
+
+    def plan_note_rels(self, zin, src, refs, prefix, ctypes, copies,
+                       overrides, done):
+        """
+        Name:     _SharedParts.plan_note_rels
+        Inputs:   - zipfile.ZipFile, a later input, open (zin)
+                  - str, path of the input package (src)
+                  - dict, shared parts, style IDs, numIds and notes its
+                    body refers to (refs)
+                  - str, prefix for relationship IDs and part names (prefix)
+                  - tuple, input's default and override content types
+                  - list, planned member copies (copies)
+                  - dict, output's override content types (overrides)
+                  - dict, member names already planned and their copies
+                    (done)
+        Outputs:  dict, relationships (as attributes) for the output's
+                  notes and comments parts, by part name and the input's
+                  relationship IDs
+        Features: Plans the copies of the parts that the input's notes and
+                  comments parts relate to, for those its body refers to
+        Depends:  - _part_name
+                  - _plan_part
+                  - _read_part
+        """
+        note_rels = {}
+        my_names = set(zin.namelist())
+        for kind in sorted(set([k for k, v in refs['notes']])):
+            name = _read_part(zin, kind)[0]
+            head, tail = posixpath.split(name)
+            try:
+                rels = ElementTree.fromstring(zin.read(
+                    posixpath.join(head, "_rels", tail + ".rels")))
+            except KeyError:
+                continue
+            if kind in self.notes:
+                out_head = posixpath.dirname(self.notes[kind][0])
+            else:
+                out_head = self.doc_dir
+            my_rels = {}
+            for rel in rels:
+                rel_id = rel.get("Id")
+                new_rel = copy.copy(rel)
+                if rel.get("TargetMode") != "External":
+                    my_part = _part_name(head, rel.get("Target"))
+                    if my_part not in my_names:
+                        continue
+                    new_part = _plan_part(zin, src, my_part, prefix, ctypes,
+                                          copies, overrides, done)
+                    new_rel.set("Target",
+                                posixpath.relpath(new_part, out_head))
+                new_rel.set("Id", prefix + rel_id)
+                my_rels[rel_id] = dict(new_rel.attrib)
+            note_rels[kind] = my_rels
+        return note_rels
+
+    def plan_notes(self, zin):
+        """
+        Name:     _SharedParts.plan_notes
+        Inputs:   zipfile.ZipFile, a later input, open (zin)
+        Outputs:  dict, new IDs by part name and the input's note and
+                  comment IDs
+        Depends:  _read_part
+        """
+        note_map = {}
+        for reltype, ctype, kind, note_tag, ref_tags in NOTE_PARTS:
+            src_root = _read_part(zin, kind)[1]
+            if src_root is None:
+                continue
+            my_map = {}
+            for note in src_root.iterchildren(note_tag):
+                if note.get(qn('w:type')) is not None:
+                    # Separators, which the body does not refer to
+                    continue
+                my_map[note.get(qn('w:id'))] = str(self.next_note[kind])
+                self.next_note[kind] += 1
+            self.note_ids[kind].update(my_map.values())
+            note_map[kind] = my_map
+        return note_map
+
+    def reserve(self, num_map, note_map):
+        """
+        Name:     _SharedParts.reserve
+        Inputs:   - dict, numIds an earlier merge gave an input (num_map)
+                  - dict, note and comment IDs an earlier merge gave it, by
+                    part name (note_map)
+        Outputs:  bool, whether they are all still free (and now taken)
+        """
+        if num_map is None or not self.taken.isdisjoint(num_map.values()):
+            return False
+        if num_map and self.numbering is None:
+            return False
+        for kind, my_map in note_map.items():
+            if not self.note_ids[kind].isdisjoint(my_map.values()):
+                return False
+        self.taken.update(num_map.values())
+        for kind, my_map in note_map.items():
+            self.note_ids[kind].update(my_map.values())
+        return True
 
 
 ##############################################################################
 # FUNCTIONS
 ##############################################################################
-def merge_files(d_list, sbreak):
+def copy_notes(src_doc, out_doc, elements, copied, images, used, notes):
     """
-    Name:     merge_files
+    Name:     copy_notes
+    Inputs:   - docx.document.Document, document copied from (src_doc)
+              - docx.document.Document, document copied to (out_doc)
+              - list, XML elements copied into out_doc (elements)
+              - dict, parts of src_doc's package already copied (copied)
+              - dict, SHA-1 hashes and image parts of out_doc's package
+              - set, part names used in out_doc's package (used)
+              - dict, out_doc's note parts by relationship type, for the
+                whole merge (notes)
+    Outputs:  list, note and comment elements added to out_doc
+    Features: Copies the footnotes, endnotes and comments that the given
+              elements refer to into out_doc's parts (created, with the
+              source's separators, if out_doc has none) under new IDs, and
+              updates the references; the parts the notes relate to are
+              copied as well. Comment threading and authors (the
+              commentsExtended, commentsIds and people parts) are not.
+    Depends:  - copy_relationships
+              - _note_part
+              - _part_element
+    """
+    added = []
+    for reltype, ctype, name, note_tag, ref_tags in NOTE_PARTS:
+        refs = []
+        for e in elements + added:
+            for node in e.iter(*ref_tags):
+                refs.append(node)
+        if not refs:
+            continue
+        try:
+            src_part = src_doc.part.part_related_by(reltype)
+        except KeyError:
+            # Nothing to copy; the source's references were dangling too
+            continue
+        src_notes = {}
+        for note in _part_element(src_part):
+            if note.tag == note_tag:
+                src_notes[note.get(qn('w:id'))] = note
+
+        out_part = _note_part(out_doc, reltype, ctype, name, src_part, used,
+                              notes)
+        out_root = out_part.element
+        next_id = 1 + max(
+            [int(n.get(qn('w:id'), 0)) for n in out_root] + [0])
+        id_map = {}
+        for node in refs:
+            v = node.get(qn('w:id'))
+            if v in id_map or v not in src_notes:
+                continue
+            new_note = copy.deepcopy(src_notes[v])
+            new_note.set(qn('w:id'), str(next_id))
+            id_map[v] = str(next_id)
+            next_id += 1
+            copy_relationships(src_part, out_part, [new_note], copied,
+                               images, used)
+            out_root.append(new_note)
+            added.append(new_note)
+        for node in refs:
+            v = node.get(qn('w:id'))
+            if v in id_map:
+                node.set(qn('w:id'), id_map[v])
+    return added
+
+
+def copy_numbering(src_doc, out_doc, elements, num_map):
+    """
+    Name:     copy_numbering
+    Inputs:   - docx.document.Document, document copied from (src_doc)
+              - docx.document.Document, document copied to (out_doc)
+              - list, XML elements copied into out_doc (elements)
+              - dict, source numIds already copied to out_doc (num_map)
+    Outputs:  None
+    Features: Copies the list definitions (w:num and w:abstractNum) that
+              the given elements refer to and updates their numIds to the
+              new definitions in out_doc; a numbering part is added to
+              out_doc if it has none
+    Depends:  _copy_lists
+    """
+    num_nodes = []
+    for e in elements:
+        num_nodes += e.iter(qn('w:numId'))
+    if not num_nodes:
+        return
+
+    try:
+        src_num = src_doc.part.numbering_part.element
+    except NotImplementedError:
+        # No lists to copy; the source's numIds refer to nothing either
+        return
+    try:
+        out_num = out_doc.part.numbering_part.element
+    except NotImplementedError:
+        # NOTE: python-docx cannot make one; start from the source's root
+        out_num = src_num.makeelement(
+            src_num.tag, src_num.attrib, nsmap=src_num.nsmap)
+        out_doc.part.relate_to(NumberingPart(
+            PackURI("/word/numbering.xml"), CT.WML_NUMBERING, out_num,
+            out_doc.part.package), RT.NUMBERING)
+
+    next_num = 1 + max(
+        [int(v) for v in out_num.xpath('./w:num/@w:numId')] + [0])
+    new_map = {}
+    for node in num_nodes:
+        v = node.get(qn('w:val'))
+        if v == "0" or v in num_map or v in new_map:
+            # numId zero turns numbering off
+            continue
+        if src_num.xpath('./w:num[@w:numId="%s"]' % v):
+            new_map[v] = str(next_num)
+            next_num += 1
+    _copy_lists(src_num, out_num, new_map)
+    num_map.update(new_map)
+    for node in num_nodes:
+        v = node.get(qn('w:val'))
+        if v in num_map:
+            node.set(qn('w:val'), num_map[v])
+
+
+def copy_relationships(src_part, out_part, elements, copied, images,
+                       used=None):
+    """
+    Name:     copy_relationships
+    Inputs:   - docx.opc.part.Part, part copied from (src_part)
+              - docx.opc.part.Part, part copied to (out_part)
+              - list, XML elements copied into out_part (elements)
+              - dict, parts of src_part's package already copied (copied)
+              - dict, SHA-1 hashes and image parts of out_part's package
+              - set, part names used in out_part's package; pass the same
+                set for every file of a merge (used)
+    Outputs:  None
+    Features: Relates out_part to (copies of) everything the given elements
+              refer to by relationship ID (images, hyperlinks, headers,
+              footers, charts, ...) and updates the IDs in the elements.
+              Images are shared between merged files by content hash.
+    Depends:  _copy_part
+    """
+    if used is None:
+        used = {str(p.partname) for p in out_part.package.iter_parts()}
+    rid_map = {}
+    for e in elements:
+        for node in e.iter():
+            for k, v in node.attrib.items():
+                if not k.startswith(R_PREFIX):
+                    continue
+                if v not in rid_map:
+                    if v not in src_part.rels:
+                        continue
+                    rel = src_part.rels[v]
+                    if rel.is_external:
+                        rid_map[v] = out_part.relate_to(
+                            rel.target_ref, rel.reltype, is_external=True)
+                    else:
+                        rid_map[v] = out_part.relate_to(
+                            _copy_part(rel.target_part, out_part.package,
+                                       copied, images, used),
+                            rel.reltype)
+                node.set(k, rid_map[v])
+
+
+def copy_styles(src_doc, out_doc, elements):
+    """
+    Name:     copy_styles
+    Inputs:   - docx.document.Document, document copied from (src_doc)
+              - docx.document.Document, document copied to (out_doc)
+              - list, XML elements copied into out_doc (elements)
+    Outputs:  list, style elements added to out_doc
+    Features: Copies the definitions of paragraph, character and table
+              styles used by the given elements (and the styles they are
+              based on, linked to or followed by) that out_doc is missing;
+              styles already in out_doc are kept as they are
+    """
+    src_styles = src_doc.styles.element
+    out_styles = out_doc.styles.element
+    style_ids = set()
+    for e in elements:
+        for tag in ('w:pStyle', 'w:rStyle', 'w:tblStyle'):
+            for node in e.iter(qn(tag)):
+                style_ids.add(node.get(qn('w:val')))
+
+    added = []
+    todo = list(style_ids)
+    while todo:
+        style_id = todo.pop()
+        if out_styles.get_by_id(style_id) is not None:
+            continue
+        src_style = src_styles.get_by_id(style_id)
+        if src_style is None:
+            continue
+        new_style = copy.deepcopy(src_style)
+        out_styles.append(new_style)
+        added.append(new_style)
+        todo += new_style.xpath(
+            './w:basedOn/@w:val | ./w:next/@w:val | ./w:link/@w:val')
+    return added
+
+
+@timed("incremental_merge_files")
+def incremental_merge_files(d_list, out_file, sbreak, manifest=None):
+    """
+    Name:     incremental_merge_files
     Inputs:   - list, Word documents to merge (d_list)
+              - str, path for the merged .docx (out_file)
               - docx.enum.base.EnumValue, section break type btn merged docs
+              - str, path to the merge manifest; default is
+                <out_file>.manifest.json (manifest)
+    Outputs:  dict, numbers of inputs re-used and rebuilt
+    Features: Same output as stream_merge_files, but re-merging after an
+              edit only streams the inputs whose content changed. Later
+              inputs are prefixed by their content hash instead of their
+              position, so an unchanged input's body fragment is valid
+              wherever it lands; the manifest keeps each fragment's byte
+              range in the output's document.xml (stored uncompressed),
+              its section properties, relationships, content types and
+              copied members. Unchanged fragments are spliced from the
+              last output, which is replaced only once the new one is
+              complete. Inputs that a stream merge refuses (see
+              stream_merge_files) raise ValueError here too, and the
+              last output is kept.
+    Depends:  - _copy_members
+              - _copy_range
+              - _count_written
+              - find_main_part
+              - _member_offset
+              - package_digest
+              - _plan_rels
+              - _read_content_types
+              - _read_manifest
+              - _set_start_type
+              - _SharedParts
+              - _stream_body
+    """
+    if manifest is None:
+        manifest = out_file + ".manifest.json"
+    old = _read_manifest(manifest, out_file)
+    if old is None:
+        old_parts = {}
+    else:
+        old_parts = old['parts']
+    for k, v in (("w", W_NS), ("r", R_NS)):
+        ElementTree.register_namespace(k, v)
+
+    # Content-hash keys; the first file is the base package
+    digests = [package_digest(my_file) for my_file in d_list]
+    keys = []
+    for i in range(len(d_list)):
+        key = ""
+        if i > 0:
+            key = "c%s_" % (digests[i][:12])
+            n = 1
+            while key in keys:
+                key = "c%s%d_" % (digests[i][:12], n)
+                n += 1
+        keys.append(key)
+
+    new_parts = {}
+    copies = []        # (input, source member, output member, data)
+    stats = {'reused': 0, 'rebuilt': 0}
+    num_files = len(d_list)
+    if num_files == 0:
+        return stats
+    with ZipFile(d_list[0], 'r') as zin:
+        doc_name = find_main_part(zin)
+        shared = _SharedParts(d_list[0], zin)
+
+    # New numIds and note IDs go above the last output's, so that the
+    # lists and notes of a rebuilt input do not take those of an unchanged one
+    for entry in old_parts.values():
+        for v in (entry['nums'] or {}).values():
+            shared.next_num = max(shared.next_num, int(v) + 1)
+        for kind, my_map in entry['note_ids'].items():
+            for v in my_map.values():
+                shared.next_note[kind] = max(
+                    shared.next_note[kind], int(v) + 1)
+
+    my_dir = os.path.dirname(os.path.abspath(out_file))
+    fd, tmp_file = tempfile.mkstemp(suffix=".docx", dir=my_dir)
+    os.close(fd)
+    old_doc = None
+    zout = None
+    out_xml = None
+    try:
+        if old is not None:
+            old_doc = open(out_file, 'rb')
+            try:
+                old_offset = _member_offset(old_doc, old['document'])
+            except (KeyError, ValueError):
+                # Not a usable earlier output; rebuild everything
+                old_parts = {}
+        zout = ZipFile(tmp_file, 'w', ZIP_DEFLATED)
+        # Keep document.xml uncompressed so the next run can seek in it
+        doc_info = ZipInfo(doc_name, time.localtime()[:6])
+        doc_info.compress_type = ZIP_STORED
+        out_xml = _CountingWriter(zout.open(doc_info, 'w'))
+        for i in range(num_files):
+            my_file = d_list[i]
+            key = keys[i]
+            entry = old_parts.get(key)
+            if (entry is not None and entry['digest'] == digests[i] and
+                    (i > 0 or old['document'] == doc_name) and
+                    (i == 0 or
+                     shared.reserve(entry['nums'], entry['note_ids']))):
+                # Unchanged: splice the fragment from the last output
+                if i == 0:
+                    out_xml.write(old['head'].encode("utf-8"))
+                start = out_xml.num_bytes
+                _copy_range(old_doc, old_offset + entry['start'],
+                            entry['end'] - entry['start'], out_xml)
+                entry = dict(entry, file=my_file, start=start,
+                             end=out_xml.num_bytes)
+                for name in entry['members']:
+                    copies.append((out_file, name, name, None))
+                if i == 0:
+                    head = old['head']
+                stats['reused'] += 1
+            else:
+                with ZipFile(my_file, 'r') as zin:
+                    my_doc = find_main_part(zin)
+                    my_head, my_tail = posixpath.split(my_doc)
+                    my_rels = posixpath.join(
+                        my_head, "_rels", my_tail + ".rels")
+                    my_defaults, my_overrides = _read_content_types(zin)
+                    rel_et = ElementTree.Element(
+                        "{%s}Relationships" % PR_NS)
+                    if my_rels in zin.namelist():
+                        rel_et = ElementTree.fromstring(zin.read(my_rels))
+                    my_copies = []
+                    my_ct = {}
+                    refs = None
+                    num_map = {}
+                    note_map = {}
+                    note_rels = {}
+                    if i == 0:
+                        rid_map = None
+                        new_rels = list(rel_et)
+                        my_ct.update(my_overrides)
+                        for name in zin.namelist():
+                            if name not in (my_doc, my_rels, CT_NAME):
+                                my_copies.append(
+                                    (my_file, name, name, None))
+                    else:
+                        done = {}
+                        rid_map, new_rels = _plan_rels(
+                            zin, my_file, my_doc, rel_et, key,
+                            (my_defaults, my_overrides), my_copies,
+                            my_ct, doc_name, done)
+                        refs = {'parts': set(), 'styles': set(),
+                                'lists': set(), 'notes': set()}
+                        num_map = shared.plan_lists(zin)
+                        note_map = shared.plan_notes(zin)
+                    out_head = _CountingWriter(out_xml, keep=True)
+                    start = out_xml.num_bytes
+                    with zin.open(my_doc) as f:
+                        my_sect = _stream_body(
+                            f, out_xml, rid_map, i == 0, out_head, refs,
+                            num_map, note_map)
+                    if i > 0:
+                        note_rels = shared.plan_note_rels(
+                            zin, my_file, refs, key,
+                            (my_defaults, my_overrides), my_copies, my_ct,
+                            done)
+                if i == 0:
+                    head = out_head.getvalue().decode("utf-8")
+                    start += out_head.num_bytes
+                if my_sect is not None:
+                    my_sect = ElementTree.tostring(my_sect).decode(
+                        "utf-8")
+                entry = {
+                    'digest': digests[i],
+                    'file': my_file,
+                    'start': start,
+                    'end': out_xml.num_bytes,
+                    'sect': my_sect,
+                    'rels': [dict(rel.attrib) for rel in new_rels],
+                    'defaults': my_defaults if i == 0 else {},
+                    'overrides': my_ct,
+                    'members': [c[2] for c in my_copies],
+                    'nums': num_map,
+                    'note_ids': note_map,
+                    'note_rels': note_rels,
+                    'lists': [],
+                    'notes': [],
+                    'parts': [],
+                    'styles': []
+                }
+                if refs is not None:
+                    entry['lists'] = sorted(refs['lists'], key=int)
+                    entry['notes'] = sorted(refs['notes'])
+                    entry['parts'] = sorted(refs['parts'])
+                    entry['styles'] = sorted(refs['styles'])
+                copies.extend(my_copies)
+                stats['rebuilt'] += 1
+            new_parts[key] = entry
+            if i > 0:
+                # The styles, lists and notes an input uses are added for
+                # re-used fragments too, as the first input's may have changed
+                with ZipFile(my_file, 'r') as zin:
+                    shared.add(my_file, zin, {
+                        'parts': set(entry['parts']),
+                        'styles': set(entry['styles']),
+                        'lists': set(entry['lists']),
+                        'notes': set([tuple(n) for n in entry['notes']])},
+                        entry['nums'], entry['note_ids'], entry['note_rels'])
+
+            # Write the section properties of this file
+            if entry['sect'] is not None:
+                my_sect = ElementTree.fromstring(entry['sect'])
+                if i > 0:
+                    _set_start_type(my_sect, sbreak)
+                my_sect = ElementTree.tostring(my_sect)
+                if i < num_files - 1:
+                    my_sect = b"".join([
+                        b'<w:p><w:pPr>', my_sect, b'</w:pPr></w:p>'])
+                out_xml.write(my_sect)
+        out_xml.write(b'</w:body></w:document>')
+        out_xml.f.close()
+
+        # Copy the remaining parts and write the package indices; the
+        # styles, numbering, notes and comments are always rebuilt from the
+        # first input's
+        my_parts = shared.members()
+        copies = [my_parts.pop(c[2], c) for c in copies]
+        copies.extend(my_parts.values())
+        _copy_members(zout, copies)
+        out_rels = ElementTree.Element("{%s}Relationships" % PR_NS)
+        ct_defaults = dict(new_parts[""]['defaults'])
+        ct_overrides = {}
+        for key in keys:
+            for attrs in new_parts[key]['rels']:
+                ElementTree.SubElement(
+                    out_rels, "{%s}Relationship" % PR_NS, attrs)
+            ct_overrides.update(new_parts[key]['overrides'])
+        for attrs, name, ctype in shared.created:
+            ElementTree.SubElement(
+                out_rels, "{%s}Relationship" % PR_NS, attrs)
+            ct_overrides[name] = ctype
+        my_head, my_tail = posixpath.split(doc_name)
+        zout.writestr(
+            posixpath.join(my_head, "_rels", my_tail + ".rels"),
+            _package_xml(out_rels))
+        ct_et = ElementTree.Element("{%s}Types" % CT_NS)
+        for k in sorted(ct_defaults.keys()):
+            ElementTree.SubElement(ct_et, "{%s}Default" % CT_NS, {
+                'Extension': k, 'ContentType': ct_defaults[k]})
+        for k in sorted(ct_overrides.keys()):
+            ElementTree.SubElement(ct_et, "{%s}Override" % CT_NS, {
+                'PartName': k, 'ContentType': ct_overrides[k]})
+        zout.writestr(CT_NAME, _package_xml(ct_et))
+        _count_written(zout)
+        zout.close()
+    except BaseException:
+        # Close the half-written package before removing it
+        if out_xml is not None:
+            out_xml.f.close()
+        if zout is not None:
+            zout.close()
+        os.remove(tmp_file)
+        raise
+    finally:
+        if old_doc is not None:
+            old_doc.close()
+
+    os.replace(tmp_file, out_file)
+    st = os.stat(out_file)
+    with open(manifest, 'w') as f:
+        json.dump({
+            'version': 3,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'document': doc_name,
+            'head': head,
+            'parts': new_parts
+        }, f)
+    print("Re-used {} and rebuilt {} of {} inputs.".format(
+        stats['reused'], stats['rebuilt'], num_files))
+    return stats
+
+
+@timed("merge_files")
+def merge_files(d_list, sbreak, mode="runs", template=None):
+    """
+    Name:     merge_files
+    Inputs:   - list, Word documents (paths or DocxPackage) to merge (d_list)
+              - docx.enum.base.EnumValue, section break type btn merged docs
+              - str, merge engine, 'runs' or 'xml' (mode)
+              - str, path to a .docx whose styles and settings the output
+                starts from; its body is not kept (template)
     Outputs:  docx.document.Document, merged document
     Features: Concatenates word .docx files together preserving paragraph
               styles, character formatting (e.g., bold) and section properties
               (e.g., page dimensions and margins). Assumes a new page between
-              each merged document.
-    Depends:  - match_char_style
+              each merged document. The 'runs' engine rebuilds each paragraph
+              and run; the 'xml' engine copies body elements directly (see
+              merge_files_xml).
+    Depends:  - get_template_cache
+              - match_char_style
               - match_sect_properties
+              - merge_files_xml
     """
+    if mode == "xml":
+        return merge_files_xml(d_list, sbreak, template)
+    elif mode != "runs":
+        raise ValueError("Unknown merge mode '%s'" % (mode))
+
     # Initialize emtpy return document
-    out_doc = docx.Document()
+    out_doc = get_template_cache().document(template)
 
     # Iterate over each file
     num_files = len(d_list)
     for i in range(num_files):
         my_file = d_list[i]
-        my_doc = docx.Document(my_file)
+        my_doc = open_document(my_file)
 
         # Match section properties (assumes input file has only 1 section)
         out_sect = out_doc.sections[i]
@@ -70,28 +955,822 @@ def merge_files(d_list, sbreak):
         match_sect_properties(mat_sect, out_sect)
 
         # Iterate over each paragraph and append to new doc
+        num_paras = 0
+        num_runs = 0
         for para in my_doc.paragraphs:
             # Create a new empty paragraph, then iterate over paragraph runs
             # NOTE: every paragraph has at least one run
             out_p = out_doc.add_paragraph(text="", style=para.style.name)
+            num_paras += 1
             for p_run in para.runs:
                 out_r = out_p.add_run(
                     text = p_run.text, style = p_run.style.name)
                 match_char_style(p_run, out_r)
+                num_runs += 1
+        add_count("paragraphs visited", num_paras)
+        add_count("runs copied", num_runs)
         # Create a new section for each new merged file (assumes new page)
         if i < num_files - 1:
             out_doc.add_section(sbreak)
     return out_doc
 
+
+def merge_files_xml(d_list, sbreak, template=None):
+    """
+    Name:     merge_files_xml
+    Inputs:   - list, Word documents (paths or DocxPackage) to merge (d_list)
+              - docx.enum.base.EnumValue, section break type btn merged docs
+              - str, path to a .docx whose styles and settings the output
+                starts from; its body is not kept (template)
+    Outputs:  docx.document.Document, merged document
+    Features: Concatenates word .docx files by deep-copying their body
+              elements (paragraphs, tables, images and all) into the output,
+              with relationship IDs remapped to copies of the parts they
+              refer to, and missing styles and list definitions carried
+              over, as are the footnotes, endnotes and comments referred
+              to (see copy_notes). Each file keeps its own section
+              properties, with the given break type between files.
+    Depends:  - copy_notes
+              - copy_numbering
+              - copy_relationships
+              - copy_styles
+              - get_template_cache
+    Ref:      https://github.com/python-openxml/python-docx/issues/368
+    """
+    out_doc = get_template_cache().document(template)
+    out_body = out_doc.element.body
+
+    images = {}
+    for img in out_doc.part.package.image_parts:
+        images[img.sha1] = img
+    used = {str(p.partname) for p in out_doc.part.package.iter_parts()}
+    note_parts = {}
+
+    num_files = len(d_list)
+    for i in range(num_files):
+        my_doc = open_document(d_list[i])
+        my_body = my_doc.element.body
+        my_sect = my_body.sectPr
+        elements = [copy.deepcopy(e) for e in my_body if e is not my_sect]
+        if my_sect is not None:
+            my_sect = copy.deepcopy(my_sect)
+            elements.append(my_sect)
+
+        copied = {}
+        copy_relationships(
+            my_doc.part, out_doc.part, elements, copied, images, used)
+        notes = copy_notes(
+            my_doc, out_doc, elements, copied, images, used, note_parts)
+        new_styles = copy_styles(my_doc, out_doc, elements + notes)
+        copy_numbering(my_doc, out_doc, elements + notes + new_styles, {})
+
+        out_sect = out_body.sectPr
+        for e in elements:
+            if e is not my_sect:
+                out_sect.addprevious(e)
+
+        # Each file ends its own section; the last one closes the body
+        if my_sect is None:
+            my_sect = copy.deepcopy(out_sect)
+        if i > 0:
+            my_sect.start_type = sbreak
+        if i < num_files - 1:
+            sect_p = OxmlElement('w:p')
+            sect_p.get_or_add_pPr().append(my_sect)
+            out_sect.addprevious(sect_p)
+        else:
+            out_body.replace(out_sect, my_sect)
+    return out_doc
+
+
+@timed("stream_merge_files")
+def stream_merge_files(d_list, out_file, sbreak):
+    """
+    Name:     stream_merge_files
+    Inputs:   - list, Word documents (paths or DocxPackage) to merge (d_list)
+              - str, path for the merged .docx (out_file)
+              - docx.enum.base.EnumValue, section break type btn merged docs
+    Outputs:  None
+    Features: Concatenates word .docx files by streaming each input's
+              body straight into the output package's document.xml; only
+              one top-level body element is held in memory at a time, so
+              peak memory does not grow with the size of the merged book.
+              Each input's section properties (page size, orientation,
+              margins, ...) are written inline at the end of its content.
+              Settings come from the first input; its styles, list
+              definitions, footnotes, endnotes and comments are kept, with
+              the styles later inputs use and it lacks, and the lists,
+              notes and comments they use (under new IDs) added; images,
+              hyperlinks, headers, footers and other parts of later inputs
+              are carried over under new relationship IDs. Comment threads
+              and authors are the first input's only. A later input with
+              lists when the first input has no numbering part raises
+              ValueError (and no output is left behind).
+    Depends:  - _copy_members
+              - _count_written
+              - find_main_part
+              - _plan_rels
+              - _read_content_types
+              - _SharedParts
+              - _stream_body
+    """
+    ct_defaults = {}   # content types by file extension
+    ct_overrides = {}  # content types by part name
+    out_rels = None    # document relationships of the merged file
+    copies = []        # (input, source member, output member, data)
+    doc_name = None
+    shared = None      # styles and list definitions of the merged file
+
+    num_files = len(d_list)
+    zout = ZipFile(out_file, 'w', ZIP_DEFLATED)
+    out_xml = None
+    try:
+        for i in range(num_files):
+            my_file = d_list[i]
+            with open_docx_zip(my_file) as zin:
+                my_names = set(zin.namelist())
+                my_doc = find_main_part(zin)
+                my_head, my_tail = posixpath.split(my_doc)
+                my_rels = posixpath.join(my_head, "_rels", my_tail + ".rels")
+                my_defaults, my_overrides = _read_content_types(zin)
+                rel_et = ElementTree.Element("{%s}Relationships" % PR_NS)
+                if my_rels in my_names:
+                    rel_et = ElementTree.fromstring(zin.read(my_rels))
+
+                rid_map = None
+                refs = None
+                num_map = None
+                note_map = None
+                if i == 0:
+                    # The first file is the base package
+                    doc_name = my_doc
+                    ct_defaults.update(my_defaults)
+                    ct_overrides.update(my_overrides)
+                    out_rels = rel_et
+                    for name in zin.namelist():
+                        if name not in (my_doc, my_rels, CT_NAME):
+                            copies.append((my_file, name, name, None))
+                    shared = _SharedParts(my_file, zin)
+                    out_xml = zout.open(doc_name, 'w')
+                else:
+                    done = {}
+                    rid_map, new_rels = _plan_rels(
+                        zin, my_file, my_doc, rel_et, "c%d_" % (i),
+                        (my_defaults, my_overrides), copies, ct_overrides,
+                        doc_name, done)
+                    out_rels.extend(new_rels)
+                    refs = {'parts': set(), 'styles': set(), 'lists': set(),
+                            'notes': set()}
+                    num_map = shared.plan_lists(zin)
+                    note_map = shared.plan_notes(zin)
+
+                with zin.open(my_doc) as f:
+                    my_sect = _stream_body(
+                        f, out_xml, rid_map, i == 0, refs=refs,
+                        num_map=num_map, note_map=note_map)
+                if i > 0:
+                    note_rels = shared.plan_note_rels(
+                        zin, my_file, refs, "c%d_" % (i),
+                        (my_defaults, my_overrides), copies, ct_overrides,
+                        done)
+                    shared.add(my_file, zin, refs, num_map, note_map,
+                               note_rels)
+
+            # Write the section properties of this file
+            if my_sect is not None:
+                if i > 0:
+                    _set_start_type(my_sect, sbreak)
+                my_sect = ElementTree.tostring(my_sect)
+                if i < num_files - 1:
+                    my_sect = b"".join([
+                        b'<w:p><w:pPr>', my_sect, b'</w:pPr></w:p>'])
+                out_xml.write(my_sect)
+        if num_files > 0:
+            out_xml.write(b'</w:body></w:document>')
+            out_xml.close()
+
+            # Copy the remaining parts and write the package indices
+            if shared.changed:
+                my_parts = shared.members()
+                copies = [my_parts.pop(c[2], c) for c in copies]
+                copies.extend(my_parts.values())
+                for attrs, name, ctype in shared.created:
+                    ElementTree.SubElement(
+                        out_rels, "{%s}Relationship" % PR_NS, attrs)
+                    ct_overrides[name] = ctype
+            _copy_members(zout, copies)
+            my_head, my_tail = posixpath.split(doc_name)
+            zout.writestr(
+                posixpath.join(my_head, "_rels", my_tail + ".rels"),
+                _package_xml(out_rels))
+            ct_et = ElementTree.Element("{%s}Types" % CT_NS)
+            for k in sorted(ct_defaults.keys()):
+                ElementTree.SubElement(ct_et, "{%s}Default" % CT_NS, {
+                    'Extension': k, 'ContentType': ct_defaults[k]})
+            for k in sorted(ct_overrides.keys()):
+                ElementTree.SubElement(ct_et, "{%s}Override" % CT_NS, {
+                    'PartName': k, 'ContentType': ct_overrides[k]})
+            zout.writestr(CT_NAME, _package_xml(ct_et))
+        _count_written(zout)
+        zout.close()
+    except BaseException:
+        # Close the half-written package before removing it
+        if out_xml is not None:
+            out_xml.close()
+        zout.close()
+        os.remove(out_file)
+        raise
+
+
+def _copy_part(part, package, copied, images, used):
+    """
+    Name:     _copy_part
+    Inputs:   - docx.opc.part.Part, part to copy (part)
+              - docx.package.Package, package to copy into (package)
+              - dict, parts already copied into package (copied)
+              - dict, SHA-1 hashes and image parts of package (images)
+              - set, part names used in package; the copy's is added (used)
+    Outputs:  docx.opc.part.Part, the copy
+    Features: Copies a part and, recursively, the parts it relates to into
+              the given package; images reuse an existing image part with
+              the same content
+    """
+    if part in copied:
+        return copied[part]
+
+    if isinstance(part, ImagePart):
+        sha1 = part.sha1
+        if sha1 in images:
+            copied[part] = images[sha1]
+            return images[sha1]
+
+    # Reserve a free part name like the original's (e.g., /word/header%d.xml)
+    template = re.sub(r'\d*(\.\w+)$', r'%d\1',
+                      str(part.partname).replace('%', '%%'))
+    n = 1
+    while template % n in used:
+        n += 1
+    partname = PackURI(template % n)
+    used.add(partname)
+
+    if isinstance(part, ImagePart):
+        new_part = ImagePart(partname, part.content_type, part.blob)
+        package.image_parts.append(new_part)
+        images[sha1] = new_part
+    elif isinstance(part, XmlPart):
+        new_part = type(part)(partname, part.content_type,
+                              copy.deepcopy(part.element), package)
+    else:
+        new_part = Part(partname, part.content_type, part.blob, package)
+    copied[part] = new_part
+
+    # Related parts keep their relationship IDs, so the copied XML is valid
+    for rId, rel in part.rels.items():
+        if rel.is_external:
+            new_part.rels.add_relationship(
+                rel.reltype, rel.target_ref, rId, is_external=True)
+        else:
+            new_part.rels.add_relationship(
+                rel.reltype,
+                _copy_part(rel.target_part, package, copied, images, used),
+                rId)
+    return new_part
+
+
+def _copy_lists(src_num, out_num, num_map):
+    """
+    Name:     _copy_lists
+    Inputs:   - docx.oxml.numbering.CT_Numbering, numbering copied from
+                (src_num)
+              - docx.oxml.numbering.CT_Numbering, numbering copied to
+                (out_num)
+              - dict, new numIds by the numIds to copy (num_map)
+    Outputs:  None
+    Features: Copies the given list definitions (w:num) under their new
+              numIds, each with its abstract definition (w:abstractNum)
+              under a new abstractNumId
+    """
+    next_abs = 1 + max(
+        [int(v) for v in out_num.xpath('./w:abstractNum/@w:abstractNumId')]
+        + [-1])
+    abs_map = {}
+    for v, new_v in num_map.items():
+        src_n = src_num.xpath('./w:num[@w:numId="%s"]' % v)[0]
+        abs_id = src_n.xpath('./w:abstractNumId/@w:val')[0]
+        if abs_id not in abs_map:
+            src_a = src_num.xpath(
+                './w:abstractNum[@w:abstractNumId="%s"]' % abs_id)[0]
+            new_a = copy.deepcopy(src_a)
+            new_a.set(qn('w:abstractNumId'), str(next_abs))
+            out_abs = out_num.findall(qn('w:abstractNum'))
+            out_first = out_num.find(qn('w:num'))
+            if out_abs:
+                out_abs[-1].addnext(new_a)
+            elif out_first is not None:
+                out_first.addprevious(new_a)
+            else:
+                out_num.append(new_a)
+            abs_map[abs_id] = str(next_abs)
+            next_abs += 1
+        new_n = copy.deepcopy(src_n)
+        new_n.set(qn('w:numId'), new_v)
+        new_n.find(qn('w:abstractNumId')).set(qn('w:val'), abs_map[abs_id])
+        out_num._insert_num(new_n)
+
+
+def _copy_members(zout, copies):
+    """
+    Name:     _copy_members
+    Inputs:   - zipfile.ZipFile, output package open for writing (zout)
+              - list, tuples of input file, source member, output member
+                and replacement data, or None to copy the member (copies)
+    Outputs:  None
+    Features: Writes the planned members, streaming copies in chunks and
+              opening each input once
+    """
+    my_files = []
+    for c in copies:
+        if c[0] not in my_files:
+            my_files.append(c[0])
+    for my_file in my_files:
+        with open_docx_zip(my_file) as zin:
+            for src, name, new_name, data in copies:
+                if src != my_file:
+                    continue
+                if data is not None:
+                    zout.writestr(new_name, data)
+                    continue
+                info = zin.getinfo(name)
+                with zin.open(info) as f_in:
+                    with zout.open(new_name, 'w') as f_out:
+                        shutil.copyfileobj(f_in, f_out, COPY_CHUNK)
+
+
+def _count_written(zout):
+    """
+    Name:     _count_written
+    Inputs:   zipfile.ZipFile, output package open for writing (zout)
+    Outputs:  None
+    Features: Counts the bytes written to each member, uncompressed, as
+              the readers count the bytes read (see add_count)
+    """
+    for info in zout.infolist():
+        add_count("zip.write:" + info.filename, info.file_size)
+
+
+def _copy_range(f, offset, size, dst):
+    """
+    Name:     _copy_range
+    Inputs:   - file object, open for binary reading (f)
+              - int, where to start reading (offset)
+              - int, number of bytes to copy (size)
+              - file object, writable destination (dst)
+    Outputs:  None
+    """
+    f.seek(offset)
+    while size > 0:
+        chunk = f.read(min(size, COPY_CHUNK))
+        if not chunk:
+            raise ValueError("Unexpected end of file")
+        dst.write(chunk)
+        size -= len(chunk)
+
+
+def _member_offset(f, name):
+    """
+    Name:     _member_offset
+    Inputs:   - file object, a zip file open for binary reading (f)
+              - str, name of a member stored without compression (name)
+    Outputs:  int, file position of the member's data
+    """
+    with ZipFile(f, 'r') as z:
+        info = z.getinfo(name)
+    if info.compress_type != ZIP_STORED:
+        raise ValueError("%s is compressed" % (name))
+    f.seek(info.header_offset)
+    header = f.read(30)
+    if header[:4] != b"PK\x03\x04":
+        raise ValueError("Bad local header for %s" % (name))
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_len + extra_len
+
+
+def _note_part(out_doc, reltype, ctype, name, src_part, used, notes):
+    """
+    Name:     _note_part
+    Inputs:   - docx.document.Document, document copied to (out_doc)
+              - str, relationship type of the part (reltype)
+              - str, content type of the part (ctype)
+              - str, part name, e.g., 'footnotes' (name)
+              - docx.opc.part.Part, the source's part of this type
+              - set, part names used in out_doc's package (used)
+              - dict, out_doc's note parts by relationship type (notes)
+    Outputs:  docx.opc.part.XmlPart, out_doc's part of this type
+    Features: Finds out_doc's notes or comments part, parsed so that notes
+              can be added, or else makes one holding just the source's
+              separators (the notes with a w:type)
+    Depends:  _part_element
+    """
+    if reltype in notes:
+        return notes[reltype]
+    my_part = None
+    for rId, rel in list(out_doc.part.rels.items()):
+        if rel.reltype != reltype or rel.is_external:
+            continue
+        my_part = rel.target_part
+        if not isinstance(my_part, XmlPart):
+            # NOTE: python-docx keeps notes as bytes, which may be shared
+            #       with the cached template; relate a parsed copy instead
+            new_part = XmlPart(my_part.partname, my_part.content_type,
+                               _part_element(my_part), my_part.package)
+            for old_id, old_rel in my_part.rels.items():
+                new_part.rels.add_relationship(
+                    old_rel.reltype, old_rel.target_ref if
+                    old_rel.is_external else old_rel.target_part,
+                    old_id, old_rel.is_external)
+            del out_doc.part.rels[rId]
+            out_doc.part.rels.add_relationship(reltype, new_part, rId)
+            my_part = new_part
+        break
+    if my_part is None:
+        my_root = copy.deepcopy(_part_element(src_part))
+        for note in list(my_root):
+            if note.get(qn('w:type')) is None:
+                my_root.remove(note)
+        my_name = "/word/%s.xml" % (name)
+        n = 1
+        while my_name in used:
+            n += 1
+            my_name = "/word/%s%d.xml" % (name, n)
+        used.add(my_name)
+        my_part = XmlPart(PackURI(my_name), ctype, my_root,
+                          out_doc.part.package)
+        out_doc.part.relate_to(my_part, reltype)
+    notes[reltype] = my_part
+    return my_part
+
+
+def _package_xml(elem):
+    """
+    Name:     _package_xml
+    Inputs:   xml.etree.ElementTree.Element, relationships or content
+              types root (elem)
+    Outputs:  bytes, the serialized XML part
+    Features: Serializes a package index with its namespace as the default
+              namespace and its unqualified attributes
+    """
+    uri, local = elem.tag[1:].split("}")
+    my_xml = ['<%s xmlns="%s">' % (local, uri)]
+    for child in elem:
+        attrs = ['%s=%s' % (k, quoteattr(v)) for k, v in child.attrib.items()]
+        my_xml.append('<%s %s/>' % (child.tag.split("}")[1], " ".join(attrs)))
+    my_xml.append('</%s>' % (local))
+    return XML_DECL + "".join(my_xml).encode("utf-8")
+
+
+def _part_element(part):
+    """
+    Name:     _part_element
+    Inputs:   docx.opc.part.Part, an XML part (part)
+    Outputs:  lxml.etree._Element, the part's root; parsed anew unless
+              python-docx keeps it parsed
+    """
+    if isinstance(part, XmlPart):
+        return part.element
+    return parse_xml(part.blob)
+
+
+def _part_name(base, target):
+    """
+    Name:     _part_name
+    Inputs:   - str, directory of the part holding the relationship (base)
+              - str, relationship target (target)
+    Outputs:  str, zip member name of the target
+    """
+    if target.startswith("/"):
+        return target.lstrip("/")
+    return posixpath.normpath(posixpath.join(base, target))
+
+
+def _plan_part(zin, src, name, prefix, ctypes, copies, overrides, done):
+    """
+    Name:     _plan_part
+    Inputs:   - zipfile.ZipFile, open input package (zin)
+              - str, path of the input package (src)
+              - str, member name of the part to copy (name)
+              - str, prefix for the copy's file name (prefix)
+              - tuple, input's default and override content types (ctypes)
+              - list, planned member copies (copies)
+              - dict, output's override content types (overrides)
+              - dict, member names already planned and their copies (done)
+    Outputs:  str, member name of the copy
+    Features: Plans the copy of a part, and the parts it relates to, under
+              a prefixed file name; the part's relationships are rewritten
+              to point at the copies
+    """
+    if name in done:
+        return done[name]
+    head, tail = posixpath.split(name)
+    new_name = posixpath.join(head, prefix + tail)
+    done[name] = new_name
+
+    defaults, my_overrides = ctypes
+    ext = posixpath.splitext(name)[1].lstrip(".").lower()
+    if "/" + name in my_overrides:
+        overrides["/" + new_name] = my_overrides["/" + name]
+    elif ext in defaults:
+        overrides["/" + new_name] = defaults[ext]
+    copies.append((src, name, new_name, None))
+
+    rels_name = posixpath.join(head, "_rels", tail + ".rels")
+    try:
+        rels = ElementTree.fromstring(zin.read(rels_name))
+    except KeyError:
+        return new_name
+    for rel in rels:
+        if rel.get("TargetMode") == "External":
+            continue
+        target = _part_name(head, rel.get("Target"))
+        new_target = _plan_part(
+            zin, src, target, prefix, ctypes, copies, overrides, done)
+        rel.set("Target", posixpath.relpath(new_target, head))
+    copies.append((src, None,
+                   posixpath.join(head, "_rels", prefix + tail + ".rels"),
+                   _package_xml(rels)))
+    return new_name
+
+
+def _plan_rels(zin, src, doc, rel_et, prefix, ctypes, copies, overrides,
+               doc_name, done):
+    """
+    Name:     _plan_rels
+    Inputs:   - zipfile.ZipFile, open input package (zin)
+              - str, path of the input package (src)
+              - str, member name of the input's main part (doc)
+              - xml.etree.ElementTree.Element, the input's document
+                relationships (rel_et)
+              - str, prefix for relationship IDs and part names (prefix)
+              - tuple, input's default and override content types (ctypes)
+              - list, planned member copies (copies)
+              - dict, output's override content types (overrides)
+              - str, member name of the output's main part (doc_name)
+              - dict, member names already planned and their copies (done)
+    Outputs:  tuple, dict of new relationship IDs and list of relationships
+              for the output's main part
+    Features: Plans the copies of the parts a later input's body refers
+              to; parts that only the first file keeps (see SHARED_RELS)
+              are left out
+    Depends:  - _part_name
+              - _plan_part
+    """
+    rid_map = {}
+    new_rels = []
+    my_names = set(zin.namelist())
+    my_head = posixpath.dirname(doc)
+    for rel in rel_et:
+        rel_type = rel.get("Type").split("/")[-1]
+        if rel.get("TargetMode") == "External":
+            new_rel = copy.copy(rel)
+        elif rel_type in SHARED_RELS:
+            continue
+        else:
+            my_part = _part_name(my_head, rel.get("Target"))
+            if my_part not in my_names:
+                continue
+            new_part = _plan_part(
+                zin, src, my_part, prefix, ctypes, copies, overrides, done)
+            new_rel = copy.copy(rel)
+            new_rel.set("Target", posixpath.relpath(
+                new_part, posixpath.dirname(doc_name)))
+        rid_map[rel.get("Id")] = prefix + rel.get("Id")
+        new_rel.set("Id", rid_map[rel.get("Id")])
+        new_rels.append(new_rel)
+    return (rid_map, new_rels)
+
+
+def _read_content_types(zin):
+    """
+    Name:     _read_content_types
+    Inputs:   zipfile.ZipFile, open .docx (zin)
+    Outputs:  tuple, content types by extension and by part name
+    """
+    defaults = {}
+    overrides = {}
+    ct_et = ElementTree.fromstring(zin.read(CT_NAME))
+    for ct in ct_et:
+        if ct.tag == "{%s}Default" % CT_NS:
+            defaults[ct.get("Extension").lower()] = ct.get("ContentType")
+        elif ct.tag == "{%s}Override" % CT_NS:
+            overrides[ct.get("PartName")] = ct.get("ContentType")
+    return (defaults, overrides)
+
+
+def _read_manifest(manifest, out_file):
+    """
+    Name:     _read_manifest
+    Inputs:   - str, path to a merge manifest (manifest)
+              - str, path to the merged file it describes (out_file)
+    Outputs:  dict, the manifest; None if either file is missing or the
+              merged file has changed since the manifest was written
+    """
+    try:
+        with open(manifest, 'r') as f:
+            old = json.load(f)
+        st = os.stat(out_file)
+    except (OSError, ValueError):
+        return None
+    if (old.get('version') != 3 or old.get('size') != st.st_size or
+            old.get('mtime_ns') != st.st_mtime_ns):
+        return None
+    return old
+
+
+def _read_part(zin, rel_type):
+    """
+    Name:     _read_part
+    Inputs:   - zipfile.ZipFile, open .docx (zin)
+              - str, relationship type of the main part, e.g., 'styles'
+    Outputs:  tuple, member name and parsed XML of the related part; None
+              and None if there is none
+    Depends:  find_related_part
+    """
+    my_part = find_related_part(zin, find_main_part(zin), rel_type)
+    if my_part is None or my_part not in zin.namelist():
+        return (None, None)
+    return (my_part, parse_xml(zin.read(my_part)))
+
+
+def _remap_list(node, refs, num_map):
+    """
+    Name:     _remap_list
+    Inputs:   - xml.etree.ElementTree.Element, a later input's w:numId
+                (node)
+              - dict, shared parts, style IDs and numIds in use (refs)
+              - dict, new numIds by the input's numIds (num_map)
+    Outputs:  None
+    Features: Points a list reference at the input's list definition in
+              the output; one the input does not define turns numbering
+              off, as it did in the input
+    """
+    v = node.get(qn('w:val'))
+    if v == "0":
+        return
+    if num_map is None:
+        refs['parts'].add('numbering')
+    elif v in num_map:
+        refs['lists'].add(v)
+        node.set(qn('w:val'), num_map[v])
+    else:
+        node.set(qn('w:val'), "0")
+
+
+def _set_start_type(sect, sbreak):
+    """
+    Name:     _set_start_type
+    Inputs:   - xml.etree.ElementTree.Element, w:sectPr (sect)
+              - docx.enum.base.EnumValue, section break type (sbreak)
+    Outputs:  None
+    Features: Sets the section's start (break) type
+    """
+    w_type = sect.find(qn('w:type'))
+    if w_type is None:
+        # w:type follows the header/footer references and note properties
+        pos = 0
+        for child in sect:
+            if child.tag not in SECT_HEAD:
+                break
+            pos += 1
+        w_type = ElementTree.Element(qn('w:type'))
+        sect.insert(pos, w_type)
+    w_type.set(qn('w:val'), WD_SECTION.to_xml(sbreak))
+
+
+def _stream_body(f, out_xml, rid_map, is_first, out_head=None, refs=None,
+                 num_map=None, note_map=None):
+    """
+    Name:     _stream_body
+    Inputs:   - file object, an input's document.xml (f)
+              - file object, the output's document.xml (out_xml)
+              - dict, new relationship IDs; None keeps the IDs (rid_map)
+              - bool, whether to write the document start tags (is_first)
+              - file object, where to write the start tags, if not to
+                out_xml (out_head)
+              - dict, sets to collect the shared parts ('parts'), style
+                IDs ('styles'), numIds ('lists') and notes and comments
+                ('notes', as part name and ID) the body refers to (refs)
+              - dict, new numIds, if refs is given (num_map)
+              - dict, new note and comment IDs by part name, if refs is
+                given (note_map)
+    Outputs:  xml.etree.ElementTree.Element, the body's w:sectPr (or None)
+    Features: Copies the body elements of document.xml to the output one
+              at a time with iterparse, dropping each once written
+    Depends:  _remap_list
+    """
+    if out_head is None:
+        out_head = out_xml
+    depth = 0
+    body = None
+    sect = None
+    ns_uris = {}
+    for event, elem in ElementTree.iterparse(
+            f, events=('start-ns', 'start', 'end')):
+        if event == 'start-ns':
+            k, v = elem
+            ns_uris[v] = k
+            if k and not re.match(r"ns\d+$", k):
+                ElementTree.register_namespace(k, v)
+        elif event == 'start':
+            depth += 1
+            if depth == 1 and is_first:
+                out_head.write(XML_DECL)
+                out_head.write(_start_tag(elem, ns_uris).encode("utf-8"))
+            elif depth == 2:
+                body = elem
+                if is_first:
+                    out_head.write(b'<w:body>')
+        elif event == 'end':
+            depth -= 1
+            if depth == 2:
+                # Relationship IDs, including header and footer references
+                # of the section properties, point at the new relationships
+                if rid_map is not None or refs is not None:
+                    for node in elem.iter():
+                        if refs is not None:
+                            if node.tag in STYLE_REFS:
+                                refs['styles'].add(node.get(qn('w:val')))
+                            elif node.tag == qn('w:numId'):
+                                _remap_list(node, refs, num_map)
+                            elif node.tag in NOTE_REFS:
+                                kind = NOTE_REFS[node.tag]
+                                v = node.get(qn('w:id'))
+                                if v in note_map.get(kind, {}):
+                                    refs['notes'].add((kind, v))
+                                    node.set(qn('w:id'), note_map[kind][v])
+                        if rid_map is None:
+                            continue
+                        for k, v in node.attrib.items():
+                            if k.startswith(R_PREFIX) and v in rid_map:
+                                node.set(k, rid_map[v])
+                if elem.tag == qn('w:sectPr'):
+                    sect = elem
+                else:
+                    out_xml.write(ElementTree.tostring(elem))
+                body.remove(elem)
+    return sect
+
+
+def _start_tag(elem, ns_uris):
+    """
+    Name:     _start_tag
+    Inputs:   - xml.etree.ElementTree.Element, document root (elem)
+              - dict, namespace prefixes by URI (ns_uris)
+    Outputs:  str, the root's start tag with all namespace declarations
+    """
+    def prefixed(tag):
+        uri, local = tag[1:].split("}")
+        if ns_uris.get(uri):
+            return "%s:%s" % (ns_uris[uri], local)
+        return local
+
+    attrs = []
+    for uri, k in ns_uris.items():
+        if k:
+            attrs.append('xmlns:%s=%s' % (k, quoteattr(uri)))
+        else:
+            attrs.append('xmlns=%s' % (quoteattr(uri)))
+    for k, v in elem.attrib.items():
+        if k.startswith("{"):
+            k = prefixed(k)
+        attrs.append('%s=%s' % (k, quoteattr(v)))
+    return "<%s %s>" % (prefixed(elem.tag), " ".join(attrs))
+
+
 ##############################################################################
 # MAIN
 ##############################################################################
-#if __name__ == '__main__':
-    # User inputs:
-    my_dir = "."            # where to look for the input document
-    my_key = "DOCUMENT_"    # keyword for finding the right input document
+if __name__ == '__main__':
+    # User inputs (defaults may be overridden on the command line):
+    p = argparse.ArgumentParser(
+        description="Merges .docx files into a single document")
+    p.add_argument("-d", "--dir", default=".",
+                   help="where to look for the input documents")
+    p.add_argument("-k", "--key", default="DOCUMENT_",
+                   help="keyword for finding the right input documents")
+    p.add_argument("-o", "--out", default=None,
+                   help="output file; default is KEY_ALL.docx")
+    p.add_argument("-m", "--mode",
+                   choices=["runs", "xml", "stream", "incremental"],
+                   default="runs", help="merge engine")
+    p.add_argument("-t", "--template", default=None,
+                   help=".docx to take the output styles and settings from")
+    args = p.parse_args()
+    instrument_from_env()
+    my_dir = args.dir
+    my_key = args.key
     sect_break = WD_SECTION.NEW_PAGE   # section break type between merged files
-    out_file = "{}_ALL.docx".format(my_key.rstrip("_"))
+    out_file = args.out
+    if out_file is None:
+        out_file = "{}_ALL.docx".format(my_key.rstrip("_"))
 
     # Step 1: find the input word files
     my_files = find_word_files(my_dir, my_key)
@@ -100,40 +1779,13 @@ def merge_files(d_list, sbreak):
         print("Failed to find any files. "
               "Please update path and keywords and try again.")
     else:
-        cat_doc = merge_files(my_files, sect_break)
-        if os.path.isfile(out_file):
+        if os.path.isfile(out_file) and args.mode != "incremental":
             print("Warning: overwriting existing output file!")
-        cat_doc.save(out_file)
-
-
-##############################################################################
-# SANDBOX
-##############################################################################
-# Testing grounds for new development
-# STATUS: in-progress
-if False:
-    # User inputs:
-    my_dir = "."
-    my_key = "."
-    sect_break = WD_SECTION.NEW_PAGE
-
-    # Step 1: find the input word files
-    my_files = find_word_files(my_dir, my_key)
-    num_files = len(my_files)
-
-    templates = find_word_files(my_dir, "template")
-    template = templates[0]
-
-    out_doc = docx.Document(template)
-    for para in out_doc.paragraphs:
-        delete_paragraph(para)
-
-    # REf: https://github.com/python-openxml/python-docx/issues/368
-    # BUG - this does not copy images or tables
-    for my_file in my_files:
-        temp_doc = docx.Document(my_file)
-        for element in temp_doc.element.body:
-            out_doc.element.body.append(element)
-        out_doc.add_section(sect_break)
-
-    out_doc.save("MERGED_DOCUMENT.docx")
+        if args.mode == "incremental":
+            incremental_merge_files(my_files, out_file, sect_break)
+        elif args.mode == "stream":
+            stream_merge_files(my_files, out_file, sect_break)
+        else:
+            cat_doc = merge_files(
+                my_files, sect_break, args.mode, args.template)
+            cat_doc.save(out_file)
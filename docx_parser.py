@@ -25,16 +25,72 @@
 ##############################################################################
 # REQUIRED MODULES
 ##############################################################################
-import docx
+import argparse
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
 
+from docx_utils import add_count
+from docx_utils import AnalysisCache
 from docx_utils import delete_paragraph
+from docx_utils import DocxPackage
 from docx_utils import find_word_files
+from docx_utils import get_template_cache
+from docx_utils import instrument_from_env
 from docx_utils import list_paragraph_styles
+from docx_utils import open_document
+from docx_utils import ParagraphIndex
+from docx_utils import timed
+
+
+##############################################################################
+# GLOBAL VARIABLES
+##############################################################################
+_WORKER = {}  # per-process source document used by split_document workers
 
 
 ##############################################################################
 # FUNCTIONS
 ##############################################################################
+def find_chapters(d, elements, style):
+    """
+    Name:     find_chapters
+    Inputs:   - docx.document.Document, open word document (d)
+              - list, the document's body elements, less sectPr (elements)
+              - str, the .docx paragraph style ID to break on (style)
+    Outputs:  list, tuples of output title and element range (start, end)
+    Features: Finds the body element ranges between paragraphs of the given
+              style; content before the first break is not part of a chapter.
+              Titles are unique, ignoring case: a repeated one is numbered
+              (e.g., Intro.docx, Intro_2.docx).
+    Depends:  - get_title
+              - ParagraphIndex
+    """
+    my_index = ParagraphIndex(d)
+    my_breaks = {}  # break paragraph element to paragraph proxy
+    for i in my_index.find_style(style):
+        my_breaks[my_index.paragraphs[i]._p] = my_index.paragraphs[i]
+    breaks = [i for i, e in enumerate(elements) if e in my_breaks]
+
+    chapters = []
+    taken = set()  # titles in use, in lower case
+    for j, start in enumerate(breaks):
+        if j + 1 < len(breaks):
+            end = breaks[j + 1]
+        else:
+            end = len(elements)
+        title = get_title(my_breaks[elements[start]].text)
+        my_root, my_ext = os.path.splitext(title)
+        n = 1
+        while title.lower() in taken:
+            n += 1
+            title = "%s_%d%s" % (my_root, n, my_ext)
+        taken.add(title.lower())
+        chapters.append((title, start, end))
+    return chapters
+
+
 def get_title(text):
     """
     TODO: create a specialized method of handing text from break styles
@@ -43,18 +99,21 @@ def get_title(text):
     return "%s.docx" % text.replace(" ", "_")
 
 
+@timed("parse_file")
 def parse_file(doc, style, idx):
     """
     Name:     parse_file
-    Inputs:   - str, file path to .docx (doc)
+    Inputs:   - str, file path to .docx; or a DocxPackage (doc)
               - str, the .docx paragraph style ID to break on (style)
               - int, the index of style ID to parse; zero indexed (idx)
     Features: Finds paragraphs of the given style and breaks it into a
-              separate document.
+              separate document. The source is parsed once per process;
+              each call works on a copy (see TemplateCache).
     Depends:  - delete_paragraph
+              - get_template_cache
               - get_title
     """
-    d = docx.Document(doc)
+    d = get_template_cache().document(doc, keep_body=True)
     out_name = None
     para_num = len(d.paragraphs)
     j = 0      # track paragraphs with matching styles
@@ -70,23 +129,185 @@ def parse_file(doc, style, idx):
             j += 1
         elif not f:
             delete_paragraph(para)
+    add_count("paragraphs visited", para_num)
 
     if out_name is None:
         out_name = "DOCUMENT-%d.docx" % (idx)
     d.save(out_name)
 
 
+def print_worker_report(stats):
+    """
+    Name:     print_worker_report
+    Inputs:   list, tuples of worker pid, output file, number of body
+              elements and seconds spent for each chapter written (stats)
+    Outputs:  None
+    Features: Prints the chapters, elements and time handled by each worker
+    """
+    workers = {}
+    for pid, out_file, num_elem, secs in stats:
+        if pid not in workers:
+            workers[pid] = {'chapters': 0, 'elements': 0, 'seconds': 0.0}
+        workers[pid]['chapters'] += 1
+        workers[pid]['elements'] += num_elem
+        workers[pid]['seconds'] += secs
+
+    for pid in sorted(workers.keys()):
+        w = workers[pid]
+        if w['seconds'] > 0:
+            rate = w['chapters'] / w['seconds']
+        else:
+            rate = 0.0
+        print("Worker {}: {} chapters, {} elements in {:.2f} s "
+              "({:.1f} chapters/s)".format(
+                  pid, w['chapters'], w['elements'], w['seconds'], rate))
+
+
+@timed("split_document")
+def split_document(doc, style, out_dir=".", workers=1):
+    """
+    Name:     split_document
+    Inputs:   - str, file path to .docx; or a DocxPackage (doc)
+              - str, the .docx paragraph style ID to break on (style)
+              - str, directory for the output files (out_dir)
+              - int, number of worker processes for writing (workers)
+    Outputs:  list, file paths of the chapter documents written
+    Features: Breaks a document into separate files at each paragraph of the
+              given style; reads the source once and moves each chapter's
+              body elements (paragraphs and tables) into the document body
+              only while that chapter is being saved. With more than one
+              worker, the chapter ranges are computed once here and the
+              build-and-save of each chapter is spread over a process pool,
+              followed by a per-worker throughput report. Each chapter has
+              its own output file (see find_chapters), so no two workers
+              ever write the same path.
+    Depends:  - find_chapters
+              - get_title
+              - print_worker_report
+              - write_chapter
+    """
+    d = open_document(doc)
+    body = d.element.body
+    elements = [e for e in body if e is not body.sectPr]
+    chapters = find_chapters(d, elements, style)
+
+    if workers > 1 and len(chapters) > 1:
+        out_files = []
+        stats = []
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(doc,)) as pool:
+            jobs = []
+            for title, start, end in chapters:
+                out_file = os.path.join(out_dir, title)
+                out_files.append(out_file)
+                jobs.append(pool.submit(_write_chapter_job,
+                                        start, end, out_file))
+            for job in as_completed(jobs):
+                stats.append(job.result())
+        print_worker_report(stats)
+        return out_files
+
+    # Detach the whole body once; chapters are re-attached one at a time
+    for e in elements:
+        body.remove(e)
+
+    out_files = []
+    for title, start, end in chapters:
+        out_file = os.path.join(out_dir, title)
+        write_chapter(d, elements[start:end], out_file)
+        out_files.append(out_file)
+    return out_files
+
+
+@timed("write_chapter")
+def write_chapter(d, elements, out_file):
+    """
+    Name:     write_chapter
+    Inputs:   - docx.document.Document, document with a detached body (d)
+              - list, body elements of the chapter (elements)
+              - str, output file path (out_file)
+    Outputs:  None
+    Features: Temporarily attaches the given elements to the document body,
+              saves the document, then detaches them again
+    """
+    body = d.element.body
+    sect_pr = body.sectPr
+    for e in elements:
+        if sect_pr is not None:
+            sect_pr.addprevious(e)
+        else:
+            body.append(e)
+    try:
+        d.save(out_file)
+    finally:
+        for e in elements:
+            body.remove(e)
+
+
+def _init_worker(doc):
+    """
+    Name:     _init_worker
+    Inputs:   str, file path to .docx; or a DocxPackage (doc)
+    Outputs:  None
+    Features: Process pool initializer; opens the source document once per
+              worker and detaches its body for write_chapter. A package
+              (reopened in the worker) is closed once it has been read.
+    """
+    d = open_document(doc)
+    if isinstance(doc, DocxPackage):
+        doc.close()
+    body = d.element.body
+    elements = [e for e in body if e is not body.sectPr]
+    for e in elements:
+        body.remove(e)
+    _WORKER['doc'] = d
+    _WORKER['elements'] = elements
+
+
+def _write_chapter_job(start, end, out_file):
+    """
+    Name:     _write_chapter_job
+    Inputs:   - int, index of the chapter's first body element (start)
+              - int, index after the chapter's last body element (end)
+              - str, output file path (out_file)
+    Outputs:  tuple, worker pid, output file, number of elements and seconds
+    Features: Writes one chapter from the worker's copy of the source
+    Depends:  write_chapter
+    """
+    t0 = time.perf_counter()
+    write_chapter(_WORKER['doc'], _WORKER['elements'][start:end], out_file)
+    return (os.getpid(), out_file, end - start, time.perf_counter() - t0)
+
+
 ##############################################################################
 # MAIN
 ##############################################################################
 if __name__ == '__main__':
-    # User inputs:
-    my_dir = "examples"     # where to look for the input document
-    my_key = "example-1"    # keyword for finding the right input document
-    br_style = "Heading1" # the paragraph style used to parse the input document
+    # User inputs (defaults may be overridden on the command line):
+    p = argparse.ArgumentParser(
+        description="Splits a .docx into one file per break-style paragraph")
+    p.add_argument("-d", "--dir", default="examples",
+                   help="where to look for the input document")
+    p.add_argument("-k", "--key", default="example-1",
+                   help="keyword for finding the right input document")
+    p.add_argument("-s", "--style", default="Heading1",
+                   help="the paragraph style used to parse the input document")
+    p.add_argument("-o", "--out-dir", default=".",
+                   help="where to write the chapter documents")
+    p.add_argument("-w", "--workers", type=int, default=1,
+                   help="number of worker processes for writing chapters")
+    p.add_argument("-c", "--cache", default=None,
+                   help="SQLite file for caching results between runs")
+    args = p.parse_args()
+    instrument_from_env()
+    my_dir = args.dir
+    my_key = args.key
+    br_style = args.style
 
     # Step 1: find the input word file(s)
     my_files = find_word_files(my_dir, my_key)
+    my_file = None
     if len(my_files) == 1:
         my_file = my_files[0]
     elif len(my_files) > 1:
@@ -94,13 +315,15 @@ if __name__ == '__main__':
               "please use keywords to specify the one you want.")
     else:
         print("Failed to find docx. Please check and try again.")
-        my_file = None
 
     if my_file:
-        # Step 2 - Find all styles and see if break style is there
-        my_doc = docx.Document(my_file)
-        my_styles = list_paragraph_styles(my_doc)
+        # Step 2 - Find all styles and see if break style is there (streamed,
+        # without loading the document)
+        if args.cache:
+            with AnalysisCache(args.cache) as my_cache:
+                my_styles = list_paragraph_styles(my_file, my_cache)
+        else:
+            my_styles = list_paragraph_styles(my_file)
         if br_style in my_styles.keys():
-            # Step 3 - For each break style, parse:
-            for i in range(my_styles[br_style]['count']):
-                parse_file(my_file, br_style, i)
+            # Step 3 - Write every chapter in a single pass:
+            split_document(my_file, br_style, args.out_dir, args.workers)
@@ -26,23 +26,179 @@
 ##############################################################################
 # REQUIRED MODULES
 ##############################################################################
+import argparse
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
 import json
 import os
 import re
+import shutil
+import time
 import warnings
+from zipfile import ZipFile
+from zipfile import ZipInfo
 
-import docx
 from docx.dml.color import ColorFormat
 from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.opc.oxml import serialize_part_xml
+from docx.oxml import parse_xml
 from docx.shared import Inches
 from docx.shared import Pt
 from docx.shared import RGBColor
+from docx.styles.styles import Styles
 
+from docx_utils import add_count
+from docx_utils import DocxPackage
 from docx_utils import find_files
+from docx_utils import find_main_part
+from docx_utils import find_related_part
+from docx_utils import instrument_from_env
 from docx_utils import list_paragraph_styles
 from docx_utils import match_char_style
 from docx_utils import match_sect_properties
+from docx_utils import open_docx_zip
+from docx_utils import open_document
+from docx_utils import ParagraphIndex
+from docx_utils import timed
+from docx_utils import COPY_CHUNK
+from docx_utils import W_NS
+
+
+##############################################################################
+# GLOBAL VARIABLES
+##############################################################################
+_REGISTRIES = {}  # style registries by directory (see get_registry)
+
+# Tokenizer for the raw XML of document.xml (see restyle_xml); a tag is
+# matched only once its quoted attribute values are complete
+XML_TAG = re.compile(rb'<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+XML_NAME = re.compile(rb'<([^\s/>]+)')
+XML_VAL = re.compile(rb':val\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+
+##############################################################################
+# CLASSES
+##############################################################################
+class StyleRegistry(object):
+    """
+    Name:     StyleRegistry
+    Features: Class for the JSON style definitions in a directory; each
+              definition is read and compiled into a setter plan once, and
+              re-read only when its file changes
+    History:  Version 1
+    """
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Initialization
+    # ////////////////////////////////////////////////////////////////////////
+    def __init__(self, sloc='styles'):
+        """
+        Name:     StyleRegistry.__init__
+        Inputs:   str, directory for style definitions (sloc)
+        Features: Initializes the StyleRegistry class
+        """
+        self.sloc = sloc       # directory for style definitions
+        self.dir_mtime = None  # modification time of sloc when last listed
+        self.files = {}        # file path to its mtime, definition and plan
+        self.names = {}        # style name to file path
+        self.refresh()
+
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Function Definitions
+    # ////////////////////////////////////////////////////////////////////////
+    def apply(self, s, sname, bs):
+        """
+        Name:     StyleRegistry.apply
+        Inputs:   - docx.styles.style._ParagraphStyle, style object (s)
+                  - str, custom style name (sname)
+                  - docx.styles.styles.Styles, output file's styles (bs)
+        Outputs:  bool, whether a definition was found and applied
+        Depends:  - apply_plan
+                  - get
+        """
+        my_style = self.get(sname)
+        if my_style is None:
+            return False
+        apply_plan(s, my_style['plan'], bs)
+        return True
+
+    def get(self, sname):
+        """
+        Name:     StyleRegistry.get
+        Inputs:   str, custom style name (sname)
+        Outputs:  dict, the style's definition (keys 'definition' and
+                  'plan'); None if there is no single definition for it
+        Features: Finds a style by the name in its JSON file, or else by its
+                  file name (see lookup_style), among the definitions as of
+                  the last refresh; call refresh once per document or batch
+        Depends:  - load
+                  - lookup_style
+        """
+        if sname in self.names:
+            my_file = self.names[sname]
+        else:
+            my_file = lookup_style(sname, self.sloc)
+        if my_file is None:
+            return None
+        if my_file not in self.files:
+            self.load(my_file)
+        return self.files[my_file]
+
+    def load(self, my_file):
+        """
+        Name:     StyleRegistry.load
+        Inputs:   str, path to a JSON style definition (my_file)
+        Outputs:  None
+        Features: Reads, validates and compiles a style definition
+        Depends:  compile_style
+        """
+        with open(my_file, 'r') as f:
+            sdef = json.load(f)
+        self.files[my_file] = {
+            'mtime': os.stat(my_file).st_mtime,
+            'definition': sdef,
+            'plan': compile_style(sdef)
+        }
+        if isinstance(sdef, dict) and 'name' in sdef:
+            self.names[sdef['name']] = my_file
+
+    def refresh(self):
+        """
+        Name:     StyleRegistry.refresh
+        Inputs:   None
+        Outputs:  None
+        Features: Re-lists the directory if it changed and reloads the
+                  definitions whose files changed
+        Depends:  - find_files
+                  - load
+        """
+        try:
+            dir_mtime = os.stat(self.sloc).st_mtime
+        except OSError:
+            dir_mtime = None
+        if dir_mtime != self.dir_mtime:
+            self.dir_mtime = dir_mtime
+            my_files = find_files(self.sloc, "*.json")
+            for my_file in list(self.files.keys()):
+                if my_file not in my_files:
+                    del self.files[my_file]
+            self.names = {}
+            for my_file in my_files:
+                if my_file not in self.files:
+                    self.load(my_file)
+                else:
+                    sdef = self.files[my_file]['definition']
+                    if isinstance(sdef, dict) and 'name' in sdef:
+                        self.names[sdef['name']] = my_file
+
+        for my_file in list(self.files.keys()):
+            try:
+                mtime = os.stat(my_file).st_mtime
+            except OSError:
+                del self.files[my_file]
+                continue
+            if mtime != self.files[my_file]['mtime']:
+                self.load(my_file)
 
 
 ##############################################################################
@@ -55,12 +211,13 @@ def add_custom_para_style(d, sname, sloc = 'styles'):
               - str, unique custom style name (sname)
               - str, directory for style definitions (sloc)
     Outputs:  None
-    Features: Add a custom Paragraph style to a docx Document
-    Depends:  - make_style
-              - read_style
+    Features: Add a custom Paragraph style to a docx Document, as defined
+              when the style registry was last refreshed
+    Depends:  - apply_plan
+              - get_registry
     """
     doc_styles = d.styles
-    sdef = read_style(sname, sloc)
+    sdef = get_registry(sloc).get(sname)
 
     # Check that the style file exists and isn't already defined:
     if sdef and sname not in doc_styles:
@@ -68,7 +225,7 @@ def add_custom_para_style(d, sname, sloc = 'styles'):
             name = sname,
             style_type = WD_STYLE_TYPE.PARAGRAPH
         )
-        make_style(new_style, sdef, doc_styles)
+        apply_plan(new_style, sdef['plan'], doc_styles)
     elif sdef and sname in doc_styles:
         warnings.warn("{} already exists! Skipping.".format(sname))
         return 1
@@ -76,6 +233,33 @@ def add_custom_para_style(d, sname, sloc = 'styles'):
         return 1
 
 
+def apply_plan(s, plan, bs):
+    """
+    Name:     apply_plan
+    Inputs:   - docx.styles.style._ParagraphStyle, style object (s)
+              - list, compiled style definition (plan)
+              - docx.styles.styles.Styles, output file's style definitions (bs)
+    Outputs:  None
+    Features: Sets style parameters from a plan made by compile_style
+    """
+    targets = {
+        'style': s,
+        'font': s.font,
+        'color': s.font.color,
+        'paragraph_format': s.paragraph_format
+    }
+    for target, k, v in plan:
+        if target == 'styles':
+            # Styles are looked up in the output file
+            if v in bs:
+                setattr(s, k, bs[v])
+            else:
+                print("Unused key:", k)
+        else:
+            setattr(targets[target], k, v)
+
+
+@timed("apply_style")
 def apply_style(orig_doc, st_map):
     """
     Name:     apply_style
@@ -83,19 +267,23 @@ def apply_style(orig_doc, st_map):
               - dict, style map (st_map)
     Outputs:  None.
     Features: Applies new styles
-    Depends:  - match_char_style
-              - match_sect_properties
+    Depends:  ParagraphIndex
     TODO:     _ Add a section break paragraph style (if one) so as to
                 maintain section styles as the doc is being copied over
     """
+    my_index = ParagraphIndex(orig_doc)
     num_sect = len(orig_doc.sections)
-    num_para = len(orig_doc.paragraphs)
+    num_para = my_index.num_paras
     print("Copying {} sections and {} paragraphs.".format(num_sect, num_para))
 
+    # Resolve each new style once; None marks an undefined style
+    new_styles = {}
+
     # Iterate over original document
-    for para in orig_doc.paragraphs:
-        pstyle_name = para.style.name
-        pstyle_id = para.style.style_id
+    for i in range(num_para):
+        para = my_index.paragraphs[i]
+        pstyle_id = my_index.style_ids[i]
+        pstyle_name = my_index.style_names[pstyle_id]
         if pstyle_name in st_map.keys():
             new_style = st_map[pstyle_name]
         elif pstyle_id in st_map.keys():
@@ -104,43 +292,30 @@ def apply_style(orig_doc, st_map):
             # If not mapped, use the original
             new_style = pstyle_name
 
-        if new_style in orig_doc.styles:
-            para.style = new_style
+        if new_style not in new_styles:
+            if new_style in orig_doc.styles:
+                new_styles[new_style] = orig_doc.styles[new_style]
+            else:
+                new_styles[new_style] = None
+
+        if new_styles[new_style] is not None:
+            para.style = new_styles[new_style]
         else:
             print("Style {} undefined; using original".format(new_style))
+    add_count("paragraphs visited", num_para)
 
 
-def lookup_style(sname, sloc = 'styles'):
-    """
-    Name:     lookup_style
-    Inputs:   - str, custom style name (sname)
-              - str, directory for style definitions (sloc)
-    Features: Checks a directory for a given style definition file
-    """
-    r = re.compile(" ")
-    style_name = r.sub("_", sname.lower())
-    my_styles = find_files(sloc, "{}*".format(style_name))
-    num_styles = len(my_styles)
-    if num_styles == 0 or num_styles > 1:
-        warnings.warn("Found {} style matches!".format(num_styles))
-        return None
-    else:
-        return my_styles[0]
-
-
-def make_style(s, d, bs):
+def compile_style(d):
     """
-    Name:     make_style
-    Inputs:   - docx.styles.style._ParagraphStyle, style object (s)
-              - dict, paragraph style definitions (d)
-              - docx.styles.styles.Styles, output file's style definitions (bs)
-    Features: Defines style parameters based on JSON definition
+    Name:     compile_style
+    Inputs:   dict, paragraph style definitions (d)
+    Outputs:  list, tuples of target ('style', 'font', 'color',
+              'paragraph_format' or 'styles'), attribute name and value
+    Features: Converts a JSON style definition into the attribute
+              assignments that make_style and apply_plan carry out;
+              unknown keys and values are reported here, once
     """
-    # Grab the font, color and paragraph style objects
-    font_style = s.font
-    color_style = font_style.color
-    para_style = s.paragraph_format
-
+    plan = []
     if 'definition' in d.keys():
         my_def = d['definition']
         my_keys = list(my_def.keys())
@@ -155,16 +330,17 @@ def make_style(s, d, bs):
                        'subscript', 'superscript', 'underline', 'web_hidden']
             for k, v in font_def.items():
                 if k in tf_font_keys:
-                    # Execute True/False assignments
-                    exec("font_style.{} = {}".format(k, v))
+                    # True/False assignments
+                    plan.append(('font', k, _to_bool(v)))
                 else:
                     # The other params of interest are color, name and size
                     if k == 'name':
-                        font_style.name = v
+                        plan.append(('font', 'name', v))
                     elif k == 'color':
                         if isinstance(v, dict):
                             if 'hex' in v.keys():
-                                color_style.rgb = RGBColor.from_string(v['hex'])
+                                plan.append(('color', 'rgb',
+                                             RGBColor.from_string(v['hex'])))
                             else:
                                 print("Unknown color keys:", v.keys())
                         else:
@@ -172,7 +348,7 @@ def make_style(s, d, bs):
                     elif k == 'size':
                         if isinstance(v, dict):
                             if 'point' in v.keys():
-                                font_style.size = Pt(v['point'])
+                                plan.append(('font', 'size', Pt(v['point'])))
                             else:
                                 print("Unknown size keys:", v.keys())
                         else:
@@ -186,35 +362,36 @@ def make_style(s, d, bs):
             len_pf_keys = ['first_line_indent', 'left_indent',
                            'line_spacing', 'right_indent',
                            'space_before', 'space_after']
+            align = {
+                'left': WD_ALIGN_PARAGRAPH.LEFT,
+                'right': WD_ALIGN_PARAGRAPH.RIGHT,
+                'center': WD_ALIGN_PARAGRAPH.CENTER,
+                'justify': WD_ALIGN_PARAGRAPH.JUSTIFY
+            }
             for k, v in para_def.items():
                 if k in tf_pf_keys:
-                    # Execute True/False assignment
-                    exec("para_style.{} = {}".format(k, v))
+                    # True/False assignment
+                    plan.append(('paragraph_format', k, _to_bool(v)))
                 elif k in len_pf_keys:
                     # v should be a dict w/ 'point' 'inch' 'cm' or 'value'
                     if isinstance(v, dict):
                         if 'value' in v.keys():
                             # Use raw number
-                            exec("para_style.{} = {}".format(k, v['value']))
+                            plan.append(('paragraph_format', k, v['value']))
                         elif 'point' in v.keys():
                             # Create a point object
-                            exec("para_style.{} = Pt({})".format(k, v['point']))
+                            plan.append(('paragraph_format', k,
+                                         Pt(v['point'])))
                         elif 'inch' in v.keys():
-                            exec("para_style.{} = Inches({})".format(
-                                k, v['inch']))
+                            plan.append(('paragraph_format', k,
+                                         Inches(v['inch'])))
                         else:
                             print("Unknown length key:", v.keys())
                     else:
                         print("Unknown length value:", v)
                 elif k == 'alignment':
-                    if 'v' == 'left':
-                        para_style.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                    elif 'v' == 'right':
-                        para_style.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-                    elif 'v' == 'center':
-                        para_style.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                    elif 'v' == 'justify':
-                        para_style.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+                    if v in align:
+                        plan.append(('paragraph_format', k, align[v]))
                     else:
                         print("Unknown alignment:", v)
                 else:
@@ -223,16 +400,82 @@ def make_style(s, d, bs):
         tf_para_keys = ['builtin', 'hidden', 'locked', 'quick_style']
         for my_key in my_keys:
             my_val = my_def[my_key]
-            if my_key in tf_para_keys or my_key == 'priority':
-                # Execute True/False assignment
-                exec("s.{} = {}".format(my_key, my_val))
-            elif my_key == 'base_style' and my_val in bs:
-                s.base_style = bs[my_val]
-            elif my_key == 'next_paragraph_style' and my_val in bs:
-                s.next_paragraph_style = bs[my_val]
-            else:
+            if my_key in tf_para_keys:
+                # True/False assignment
+                plan.append(('style', my_key, _to_bool(my_val)))
+            elif my_key == 'priority':
+                plan.append(('style', my_key, int(my_val)))
+            elif my_key in ('base_style', 'next_paragraph_style'):
                 # NOTE: apply new next_paragraph_style later
+                plan.append(('styles', my_key, my_val))
+            else:
                 print("Unused key:", my_key)
+    return plan
+
+
+def get_registry(sloc = 'styles'):
+    """
+    Name:     get_registry
+    Inputs:   str, directory for style definitions (sloc)
+    Outputs:  StyleRegistry, the process's registry for the directory
+    Features: Returns the cached style registry for a directory
+    """
+    if sloc not in _REGISTRIES:
+        _REGISTRIES[sloc] = StyleRegistry(sloc)
+    return _REGISTRIES[sloc]
+
+
+def lookup_style(sname, sloc = 'styles'):
+    """
+    Name:     lookup_style
+    Inputs:   - str, custom style name (sname)
+              - str, directory for style definitions (sloc)
+    Features: Checks a directory for a given style definition file
+    """
+    r = re.compile(" ")
+    style_name = r.sub("_", sname.lower())
+    my_styles = find_files(sloc, "{}*".format(style_name))
+    num_styles = len(my_styles)
+    if num_styles == 0 or num_styles > 1:
+        warnings.warn("Found {} style matches!".format(num_styles))
+        return None
+    else:
+        return my_styles[0]
+
+
+def make_style(s, d, bs):
+    """
+    Name:     make_style
+    Inputs:   - docx.styles.style._ParagraphStyle, style object (s)
+              - dict, paragraph style definitions (d)
+              - docx.styles.styles.Styles, output file's style definitions (bs)
+    Features: Defines style parameters based on JSON definition
+    Depends:  - apply_plan
+              - compile_style
+    """
+    apply_plan(s, compile_style(d), bs)
+
+
+def print_batch_report(results):
+    """
+    Name:     print_batch_report
+    Inputs:   list, restyle_batch results (results)
+    Outputs:  None
+    Features: Prints the time spent on each file and a failure summary
+    """
+    num_failed = 0
+    total = 0.0
+    for res in results:
+        total += res['seconds']
+        if res['error']:
+            num_failed += 1
+            print("FAILED {} ({:.2f} s): {}".format(
+                res['file'], res['seconds'], res['error']))
+        else:
+            print("{} -> {} ({:.2f} s)".format(
+                res['file'], res['out_file'], res['seconds']))
+    print("Restyled {} of {} files in {:.2f} s; {} failed.".format(
+        len(results) - num_failed, len(results), total, num_failed))
 
 
 def read_style(sname, sloc = 'styles'):
@@ -253,32 +496,88 @@ def read_style(sname, sloc = 'styles'):
     return style
 
 
-##############################################################################
-# MAIN
-##############################################################################
-# User inputs:
-my_dir = "examples"          # where to look for the input document
-my_key = "example-1.docx"    # keyword for finding the right input document
-
-# Define the old-to-new style mapping:
-style_map = {
-    'Heading1': 'New Head1',
-    'Normal': "New Normal"
-}
+def restyle_batch(paths, style_map, workers=1, out_dir=".",
+                  sloc = 'styles', mode="docx"):
+    """
+    Name:     restyle_batch
+    Inputs:   - list, paths to .docx files (paths)
+              - dict, style map (style_map)
+              - int, number of worker processes (workers)
+              - str, directory for the restyled files (out_dir)
+              - str, directory for style definitions (sloc)
+              - str, restyle engine, 'docx' or 'xml' (mode)
+    Outputs:  list, dicts of each file's path, output path, seconds and
+              error message (None on success), in the order of paths
+    Features: Restyles many files, optionally over a process pool whose
+              workers each compile the style definitions once; a failed
+              file is recorded and the batch carries on. Inputs with the
+              same file name get numbered copies (e.g., <name>_styled-2.docx)
+              rather than overwriting one another; a file listed twice
+              raises ValueError.
+    Depends:  - print_batch_report
+              - restyle_file
+              - _out_names
+    """
+    out_names = _out_names(paths)
+    results = {}
+    if workers <= 1:
+        for my_file in paths:
+            results[my_file] = _restyle_job(
+                my_file, style_map, out_dir, sloc, mode, out_names[my_file])
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=get_registry,
+                                 initargs=(sloc,)) as pool:
+            jobs = [pool.submit(_restyle_job, my_file, style_map, out_dir,
+                                sloc, mode, out_names[my_file])
+                    for my_file in paths]
+            for job in as_completed(jobs):
+                res = job.result()
+                results[res['file']] = res
+    results = [results[my_file] for my_file in paths]
+    print_batch_report(results)
+    return results
 
-my_files = find_files(my_dir, my_key)
 
-for my_file in my_files:
+def restyle_file(my_file, style_map, out_dir=".", sloc = 'styles',
+                 mode="docx", out_name=None):
+    """
+    Name:     restyle_file
+    Inputs:   - str, path to a .docx file; or a DocxPackage (my_file)
+              - dict, style map (style_map)
+              - str, directory for the restyled file (out_dir)
+              - str, directory for style definitions (sloc)
+              - str, restyle engine, 'docx' or 'xml' (mode)
+              - str, file name for the copy (out_name)
+    Outputs:  str, path to the restyled copy
+    Features: Adds the custom styles to a document, applies the style map
+              and saves the copy as out_name, by default
+              <name>_styled.docx. The 'docx' engine
+              goes through python-docx; the 'xml' engine rewrites the
+              package directly (see restyle_xml).
+    Depends:  - add_custom_para_style
+              - apply_style
+              - get_registry
+              - restyle_xml
+    """
     # Define the output file name and location
-    out_file = "{}_styled.docx".format(
-        os.path.basename(my_file).split(".docx")[0]
-    )
+    if out_name is None:
+        out_name = "{}_styled.docx".format(_base_name(my_file))
+    out_file = os.path.join(out_dir, out_name)
+    if mode == "xml":
+        return restyle_xml(my_file, style_map, out_file, sloc)
+    elif mode != "docx":
+        raise ValueError("Unknown restyle mode '%s'" % (mode))
+
     # Open existing and new empty docx objects
-    my_doc = docx.Document(my_file)
+    my_doc = open_document(my_file)
+
+    # Pick up changed style definitions once per document
+    get_registry(sloc).refresh()
 
     # Add custom styles to new docx object
     for new_style in style_map.values():
-        add_custom_para_style(my_doc, new_style)
+        add_custom_para_style(my_doc, new_style, sloc)
 
     # TODO: add custom next_paragraph_styles after all new styles are defined.
 
@@ -287,3 +586,340 @@ for my_file in my_files:
 
     # Save the copy
     my_doc.save(out_file)
+    return out_file
+
+
+def restyle_xml(my_file, style_map, out_file, sloc = 'styles'):
+    """
+    Name:     restyle_xml
+    Inputs:   - str, path to a .docx file; or a DocxPackage (my_file)
+              - dict, style map (style_map)
+              - str, path for the restyled copy (out_file)
+              - str, directory for style definitions (sloc)
+    Outputs:  str, path to the restyled copy
+    Features: Same result as restyle_file without building the document
+              object model; only the styles part is parsed, document.xml
+              is streamed with each body paragraph's w:pStyle rewritten
+              and every other member is copied through unchanged
+    Depends:  - apply_plan
+              - find_main_part
+              - find_related_part
+              - get_registry
+              - _restyle_body
+    """
+    with open_docx_zip(my_file) as zin:
+        my_doc = find_main_part(zin)
+        my_styles = find_related_part(zin, my_doc, "styles")
+        if my_styles is None:
+            raise KeyError("No styles part in {}".format(my_file))
+        doc_styles = Styles(parse_xml(zin.read(my_styles)))
+
+        # Add custom styles, same as add_custom_para_style
+        my_registry = get_registry(sloc)
+        my_registry.refresh()
+        for new_style in set(style_map.values()):
+            sdef = my_registry.get(new_style)
+            if sdef and new_style not in doc_styles:
+                s = doc_styles.add_style(
+                    name = new_style,
+                    style_type = WD_STYLE_TYPE.PARAGRAPH
+                )
+                apply_plan(s, sdef['plan'], doc_styles)
+            elif sdef:
+                warnings.warn("{} already exists! Skipping.".format(new_style))
+
+        # Map each paragraph style ID to its new style ID
+        id_map = {}
+        for s in doc_styles:
+            if s.type != WD_STYLE_TYPE.PARAGRAPH:
+                continue
+            if s.name in style_map.keys():
+                new_style = style_map[s.name]
+            elif s.style_id in style_map.keys():
+                new_style = style_map[s.style_id]
+            else:
+                continue
+            if new_style in doc_styles:
+                new_id = doc_styles[new_style].style_id
+                if new_id != s.style_id:
+                    id_map[s.style_id] = new_id
+            else:
+                print("Style {} undefined; using original".format(new_style))
+        para_ids = set(
+            s.style_id for s in doc_styles
+            if s.type == WD_STYLE_TYPE.PARAGRAPH
+        )
+        default_style = doc_styles.default(WD_STYLE_TYPE.PARAGRAPH)
+        if default_style is not None:
+            default_id = default_style.style_id
+        else:
+            default_id = None
+
+        with ZipFile(out_file, 'w') as zout:
+            for info in zin.infolist():
+                new_info = ZipInfo(info.filename, info.date_time)
+                new_info.compress_type = info.compress_type
+                new_info.external_attr = info.external_attr
+                if info.filename == my_styles:
+                    zout.writestr(new_info,
+                                  serialize_part_xml(doc_styles.element))
+                    continue
+                with zin.open(info) as f_in:
+                    with zout.open(new_info, 'w') as f_out:
+                        if info.filename == my_doc:
+                            _restyle_body(
+                                f_in, f_out, id_map, para_ids, default_id)
+                        else:
+                            shutil.copyfileobj(f_in, f_out, COPY_CHUNK)
+    return out_file
+
+
+def _base_name(my_file):
+    """
+    Name:     _base_name
+    Inputs:   str, path to a .docx file; or a DocxPackage (my_file)
+    Outputs:  str, the file name without the .docx extension
+    """
+    my_path = my_file
+    if isinstance(my_file, DocxPackage):
+        my_path = my_file.path
+    return os.path.basename(my_path).split(".docx")[0]
+
+
+def _out_names(paths):
+    """
+    Name:     _out_names
+    Inputs:   list, paths to .docx files; or DocxPackages (paths)
+    Outputs:  dict, each input and the file name of its restyled copy
+    Features: Names the copies <name>_styled.docx, numbering the later
+              ones whose names are taken (<name>_styled-2.docx, ...);
+              raises ValueError for a file that is listed twice
+    Depends:  _base_name
+    """
+    my_names = {}
+    seen = set()
+    taken = set()
+    for my_file in paths:
+        my_path = my_file
+        if isinstance(my_file, DocxPackage):
+            my_path = my_file.path
+        my_path = os.path.realpath(my_path)
+        if my_path in seen:
+            raise ValueError("File %s is listed more than once" % (my_path))
+        seen.add(my_path)
+
+        base = _base_name(my_file)
+        my_name = "{}_styled.docx".format(base)
+        n = 1
+        while os.path.normcase(my_name) in taken:
+            n += 1
+            my_name = "{}_styled-{}.docx".format(base, n)
+        taken.add(os.path.normcase(my_name))
+        my_names[my_file] = my_name
+    return my_names
+
+
+def _pstyle_xml(prefix, style_id, with_ppr):
+    """
+    Name:     _pstyle_xml
+    Inputs:   - bytes, prefix of the WordprocessingML namespace (prefix)
+              - str, paragraph style ID (style_id)
+              - bool, whether to wrap it in a w:pPr element (with_ppr)
+    Outputs:  bytes, a w:pStyle element
+    """
+    val = style_id.replace("&", "&amp;").replace('"', "&quot;")
+    val = val.replace("<", "&lt;").encode("utf-8")
+    my_xml = b"<" + prefix + b':pStyle ' + prefix + b':val="' + val + b'"/>'
+    if with_ppr:
+        my_xml = (b"<" + prefix + b":pPr>" + my_xml +
+                  b"</" + prefix + b":pPr>")
+    return my_xml
+
+
+def _restyle_body(f_in, f_out, id_map, para_ids, default_id):
+    """
+    Name:     _restyle_body
+    Inputs:   - file object, document.xml of the original (f_in)
+              - file object, document.xml of the copy (f_out)
+              - dict, paragraph style IDs to their new IDs (id_map)
+              - set, paragraph style IDs defined in the styles part
+                (para_ids)
+              - str, ID of the default paragraph style (default_id)
+    Outputs:  None
+    Features: Tokenizes the XML a chunk at a time and rewrites, or adds,
+              the w:pStyle of each paragraph directly under w:body (same
+              paragraphs as Document.paragraphs); pStyle values that are
+              not paragraph styles count as the default style; all other
+              bytes are written unchanged
+    """
+    new_default = id_map.get(default_id)
+    prefix = None
+    depth = 0
+    state = 0    # 1: after a body <w:p>; 2: after its <w:pPr>
+    tail = b""
+    while True:
+        chunk = f_in.read(COPY_CHUNK)
+        buf = tail + chunk
+        out = []
+        pos = 0
+        for m in XML_TAG.finditer(buf):
+            tag = m.group(0)
+            out.append(buf[pos:m.start()])
+            pos = m.end()
+            if tag[1:2] in (b"?", b"!"):
+                out.append(tag)
+                continue
+            if tag[1:2] == b"/":
+                depth -= 1
+                if state and new_default is not None:
+                    out.append(_pstyle_xml(prefix, new_default, state == 1))
+                state = 0
+                out.append(tag)
+                continue
+            if prefix is None:
+                # Find the prefix of the WordprocessingML namespace on the
+                # root element
+                m_ns = re.search(
+                    rb'xmlns:([^\s=]+)\s*=\s*["\']' +
+                    re.escape(W_NS.encode()) + rb'["\']', tag)
+                if m_ns is None:
+                    raise ValueError("No WordprocessingML namespace found")
+                prefix = m_ns.group(1)
+                p_tag = prefix + b":p"
+                ppr_tag = prefix + b":pPr"
+                pstyle_tag = prefix + b":pStyle"
+            name = XML_NAME.match(tag).group(1)
+            closed = tag.endswith(b"/>")
+            if state == 1:
+                if name == ppr_tag and closed:
+                    if new_default is not None:
+                        tag = _pstyle_xml(prefix, new_default, True)
+                    state = 0
+                elif name == ppr_tag:
+                    state = 2
+                else:
+                    if new_default is not None:
+                        out.append(_pstyle_xml(prefix, new_default, True))
+                    state = 0
+            elif state == 2:
+                if name == pstyle_tag:
+                    m_val = XML_VAL.search(tag)
+                    if m_val is None:
+                        old_id = None
+                    else:
+                        old_id = (m_val.group(1) or
+                                  m_val.group(2) or b"").decode("utf-8")
+                    if old_id not in para_ids:
+                        old_id = default_id
+                    if old_id in id_map:
+                        tag = _pstyle_xml(prefix, id_map[old_id], False)
+                elif new_default is not None:
+                    out.append(_pstyle_xml(prefix, new_default, False))
+                state = 0
+            elif depth == 2 and name == p_tag:
+                if not closed:
+                    state = 1
+                elif new_default is not None:
+                    # Empty paragraph, e.g., <w:p/>
+                    out.append(tag[:-2].rstrip() + b">")
+                    out.append(_pstyle_xml(prefix, new_default, True))
+                    tag = b"</" + p_tag + b">"
+            out.append(tag)
+            if not closed:
+                depth += 1
+        tail = buf[pos:]
+        f_out.write(b"".join(out))
+        if not chunk:
+            break
+    f_out.write(tail)
+
+
+def _restyle_job(my_file, style_map, out_dir, sloc, mode, out_name=None):
+    """
+    Name:     _restyle_job
+    Inputs:   - str, path to a .docx file (my_file)
+              - dict, style map (style_map)
+              - str, directory for the restyled file (out_dir)
+              - str, directory for style definitions (sloc)
+              - str, restyle engine (mode)
+              - str, file name for the copy (out_name)
+    Outputs:  dict, the file's path, output path, seconds and error
+    Features: Times one restyle_file call and catches its failure
+    Depends:  restyle_file
+    """
+    t0 = time.perf_counter()
+    out_file = None
+    error = None
+    try:
+        out_file = restyle_file(
+            my_file, style_map, out_dir, sloc, mode, out_name)
+    except Exception as e:
+        # NOTE: a damaged package can fail in many ways (BadZipFile,
+        #       zlib.error, EOFError, PackageNotFoundError, ...); none
+        #       stops the batch
+        error = str(e) or type(e).__name__
+    return {
+        'file': my_file,
+        'out_file': out_file,
+        'seconds': time.perf_counter() - t0,
+        'error': error
+    }
+
+
+def _to_bool(v):
+    """
+    Name:     _to_bool
+    Inputs:   bool or str, JSON on/off value, e.g., "True" (v)
+    Outputs:  bool; None for "None" (or null), which inherits the value
+    """
+    if v is None:
+        return None
+    if isinstance(v, str):
+        v = v.strip().lower()
+        if v == "none":
+            return None
+        return v == "true"
+    return bool(v)
+
+
+##############################################################################
+# MAIN
+##############################################################################
+if __name__ == '__main__':
+    # User inputs (defaults may be overridden on the command line):
+    p = argparse.ArgumentParser(
+        description="Writes copies of .docx files with custom styles")
+    p.add_argument("files", nargs="*", help=".docx files to restyle")
+    p.add_argument("-d", "--dir", default="examples",
+                   help="where to look for the input documents")
+    p.add_argument("-k", "--key", default="example-1.docx",
+                   help="keyword for finding the right input documents")
+    p.add_argument("-m", "--map", action="append", default=None,
+                   metavar="OLD=NEW",
+                   help="style mapping (repeatable); default maps Heading1 "
+                        "and Normal to New Head1 and New Normal")
+    p.add_argument("-s", "--styles", default="styles",
+                   help="directory for style definitions")
+    p.add_argument("-o", "--out-dir", default=".",
+                   help="where to write the restyled documents")
+    p.add_argument("-w", "--workers", type=int, default=1,
+                   help="number of worker processes")
+    p.add_argument("-e", "--engine", choices=["docx", "xml"], default="docx",
+                   help="restyle through python-docx or rewrite the XML")
+    args = p.parse_args()
+    instrument_from_env()
+
+    # Define the old-to-new style mapping:
+    style_map = {
+        'Heading1': 'New Head1',
+        'Normal': "New Normal"
+    }
+    if args.map:
+        style_map = dict(m.split("=", 1) for m in args.map)
+
+    my_files = args.files
+    if not my_files:
+        my_files = find_files(args.dir, args.key)
+
+    restyle_batch(my_files, style_map, args.workers, args.out_dir,
+                  args.styles, args.engine)
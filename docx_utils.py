@@ -25,29 +25,491 @@
 ##############################################################################
 # REQUIRED MODULES
 ##############################################################################
+from contextlib import contextmanager
+from contextlib import nullcontext
+import copy
+import cProfile
+from functools import cached_property
+import functools
+import json
+import mmap
+import multiprocessing.util
 import os
 import glob
+import hashlib
+import pickle
+import posixpath
 import re
+import sqlite3
+import struct
+import sys
+import time
+from zipfile import ZIP_STORED
 from zipfile import ZipFile
 import xml.etree.ElementTree as ElementTree
 
 
+##############################################################################
+# GLOBAL VARIABLES
+##############################################################################
+# Clark-notation tags for the WordprocessingML and DrawingML elements
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+A_NS = "http://schemas.openxmlformats.org/drawingml/2006/main"
+R_NS = ("http://schemas.openxmlformats.org/officeDocument/2006/"
+        "relationships")
+W14_NS = "http://schemas.microsoft.com/office/word/2010/wordml"
+V_NS = "urn:schemas-microsoft-com:vml"
+MC_NS = "http://schemas.openxmlformats.org/markup-compatibility/2006"
+W_P = "{%s}p" % W_NS
+W_R = "{%s}r" % W_NS
+W_DRAWING = "{%s}drawing" % W_NS
+W_RSTYLE = "{%s}rStyle" % W_NS
+W_BODY = "{%s}body" % W_NS
+W_HYPERLINK = "{%s}hyperlink" % W_NS
+W_PPR = "{%s}pPr" % W_NS
+W_PSTYLE = "{%s}pStyle" % W_NS
+W_STYLE = "{%s}style" % W_NS
+W_NAME = "{%s}name" % W_NS
+W_T = "{%s}t" % W_NS
+W_BR = "{%s}br" % W_NS
+W_VAL = "{%s}val" % W_NS
+W_TYPE = "{%s}type" % W_NS
+W_DEFAULT = "{%s}default" % W_NS
+W_STYLE_ID = "{%s}styleId" % W_NS
+W14_PARA_ID = "{%s}paraId" % W14_NS
+A_BLIP = "{%s}blip" % A_NS
+R_EMBED = "{%s}embed" % R_NS
+R_LINK = "{%s}link" % R_NS
+R_ID = "{%s}id" % R_NS
+V_IMAGEDATA = "{%s}imagedata" % V_NS
+W_TBL = "{%s}tbl" % W_NS
+W_TXBX = "{%s}txbxContent" % W_NS
+MC_FALLBACK = "{%s}Fallback" % MC_NS
+
+# Relationship type of images (see LazyDocxPics.imagemap)
+IMAGE_REL = R_NS + "/image"
+
+# Relationship types of the story parts besides the main document (see
+# find_package_images)
+STORY_RELS = ("header", "footer", "footnotes", "endnotes", "comments")
+
+# Table elements that may hold paragraphs (see iter_paragraphs)
+W_TABLE_TAGS = set("{%s}%s" % (W_NS, t) for t in ("tbl", "tr", "tc"))
+
+# Text of the run elements other than w:t and w:br, same as python-docx
+W_RUN_TEXT = {
+    "{%s}tab" % W_NS: "\t",
+    "{%s}ptab" % W_NS: "\t",
+    "{%s}cr" % W_NS: "\n",
+    "{%s}noBreakHyphen" % W_NS: "-",
+}
+
+# Bytes copied at a time when streaming zip members
+COPY_CHUNK = 64 * 1024
+
+# Default size limit of the results kept by AnalysisCache
+CACHE_BYTES = 64 * 1024 * 1024
+
+# Default size limit of the templates kept by TemplateCache, counted as
+# their uncompressed package size
+TEMPLATE_BYTES = 32 * 1024 * 1024
+
+# Process-wide TemplateCache (see get_template_cache)
+_TEMPLATES = {}
+
+# Instrumentation state (see enable_instrumentation); off by default
+_INSTRUMENT = {
+    'on': False,       # whether timers and counters are recorded
+    'start': None,     # time instrumentation was enabled
+    'stages': {},      # stage name to number of calls and seconds
+    'counters': {},    # counter name to total
+    'profile': None,   # cProfile.Profile, if profiling
+    'patched': {},     # python-docx functions replaced while enabled
+}
+
+# Font properties copied by match_char_style, by font class (see
+# _font_properties)
+_FONT_PROPS = {}
+
+
 ##############################################################################
 # CLASSES
 ##############################################################################
+class AnalysisCache(object):
+    """
+    Name:     AnalysisCache
+    Features: Class for keeping per-document analysis results (e.g., style
+              histograms, image maps, abbreviation indexes) in an SQLite
+              file; results are keyed by a content hash of the package, and
+              a file whose size and mtime are unchanged is not re-hashed;
+              the least recently used results are evicted beyond a size
+              limit
+    History:  Version 1
+    """
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Initialization
+    # ////////////////////////////////////////////////////////////////////////
+    def __init__(self, db_path=".docx_cache.sqlite", max_bytes=CACHE_BYTES):
+        """
+        Name:     AnalysisCache.__init__
+        Inputs:   - str, path to the SQLite file (db_path)
+                  - int, size limit of the stored results (max_bytes)
+        Features: Initializes the AnalysisCache class
+        """
+        self.db_path = db_path      # path to the SQLite file
+        self.max_bytes = max_bytes  # size limit of the stored results
+        self.hits = 0               # results found in the cache
+        self.misses = 0             # results computed and stored
+        self.evictions = 0          # results removed for space
+        self.atimes = {}            # access times not yet written
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+            "digest TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "digest TEXT, name TEXT, value BLOB, nbytes INTEGER, "
+            "atime REAL, PRIMARY KEY (digest, name))")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_atime ON results (atime)")
+        self.conn.commit()
+        self.total = self._stored_bytes()  # size of the stored results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Function Definitions
+    # ////////////////////////////////////////////////////////////////////////
+    def close(self):
+        """
+        Name:     AnalysisCache.close
+        Inputs:   None
+        Outputs:  None
+        Depends:  flush
+        """
+        if self.conn is not None:
+            self.flush()
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+    def digest(self, path):
+        """
+        Name:     AnalysisCache.digest
+        Inputs:   str, path to a .docx file (path)
+        Outputs:  str, the file's content hash
+        Features: Uses the stored hash if the file's size and mtime are
+                  unchanged; otherwise hashes the file and stores it
+        Depends:  package_digest
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        row = self.conn.execute(
+            "SELECT size, mtime, digest FROM files WHERE path = ?",
+            (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+        my_digest = package_digest(path)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (path, st.st_size, st.st_mtime_ns, my_digest))
+        self.conn.commit()
+        return my_digest
+
+    def evict(self):
+        """
+        Name:     AnalysisCache.evict
+        Inputs:   None
+        Outputs:  int, number of results removed
+        Features: Removes the least recently used results until the stored
+                  results fit within max_bytes; the stored size is kept
+                  as a running total, and only re-read (as other
+                  processes may share the file) once it is over the limit
+        Depends:  flush
+        """
+        num_evicted = 0
+        if self.total <= self.max_bytes:
+            return num_evicted
+        total = self._stored_bytes()
+        if total > self.max_bytes:
+            self.flush()
+            rows = self.conn.execute(
+                "SELECT digest, name, nbytes FROM results "
+                "ORDER BY atime").fetchall()
+            for my_digest, name, nbytes in rows:
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute(
+                    "DELETE FROM results WHERE digest = ? AND name = ?",
+                    (my_digest, name))
+                total -= nbytes
+                num_evicted += 1
+            self.conn.execute(
+                "DELETE FROM files WHERE digest NOT IN "
+                "(SELECT digest FROM results)")
+            self.conn.commit()
+        self.total = total
+        self.evictions += num_evicted
+        return num_evicted
+
+    def flush(self):
+        """
+        Name:     AnalysisCache.flush
+        Inputs:   None
+        Outputs:  None
+        Features: Writes the access times of the results found since the
+                  last flush in one transaction
+        """
+        if self.atimes:
+            self.conn.executemany(
+                "UPDATE results SET atime = ? WHERE digest = ? AND name = ?",
+                [(t, k[0], k[1]) for k, t in self.atimes.items()])
+            self.conn.commit()
+            self.atimes = {}
+
+    def get_or_compute(self, path, name, func):
+        """
+        Name:     AnalysisCache.get_or_compute
+        Inputs:   - str, path to a .docx file (path)
+                  - str, name of the analysis, e.g., 'styles' (name)
+                  - function, computes the result from the path (func)
+        Outputs:  object, the cached or newly computed result
+        Features: Returns the stored result for the file's content, or
+                  else computes, stores and returns it; results must be
+                  picklable. Access times of hits are kept in memory
+                  until the next flush (at the latest, on close).
+        Depends:  - digest
+                  - evict
+        """
+        my_digest = self.digest(path)
+        row = self.conn.execute(
+            "SELECT value FROM results WHERE digest = ? AND name = ?",
+            (my_digest, name)).fetchone()
+        if row is not None:
+            self.hits += 1
+            self.atimes[(my_digest, name)] = time.time()
+            return pickle.loads(row[0])
+
+        self.misses += 1
+        value = func(path)
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+            (my_digest, name, sqlite3.Binary(blob), len(blob), time.time()))
+        self.conn.commit()
+        self.total += len(blob)
+        self.evict()
+        return value
+
+    def print_report(self):
+        """
+        Name:     AnalysisCache.print_report
+        Inputs:   None
+        Outputs:  None
+        Depends:  report
+        """
+        my_report = self.report()
+        print("Cache {}: {} hits, {} misses ({:.0%} hit rate); {} results "
+              "in {} bytes; {} evicted.".format(
+                  self.db_path, my_report['hits'], my_report['misses'],
+                  my_report['hit_rate'], my_report['entries'],
+                  my_report['bytes'], my_report['evictions']))
+
+    def report(self):
+        """
+        Name:     AnalysisCache.report
+        Inputs:   None
+        Outputs:  dict, hits, misses, hit rate and evictions of this session
+                  and the number and size of the stored results
+        """
+        entries, nbytes = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM results"
+        ).fetchone()
+        num_calls = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / num_calls if num_calls else 0.0,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': nbytes
+        }
+
+    def _stored_bytes(self):
+        """
+        Name:     AnalysisCache._stored_bytes
+        Inputs:   None
+        Outputs:  int, size of the stored results
+        """
+        return self.conn.execute(
+            "SELECT COALESCE(SUM(nbytes), 0) FROM results").fetchone()[0]
+
+
+class DocxPackage(object):
+    """
+    Name:     DocxPackage
+    Features: Read-only .docx package that is opened once and memory-mapped,
+              so that repeated reads do not go back to the file system.
+              Only members stored without compression (ZIP_STORED) can be
+              viewed without copying (see view); Word deflates most parts,
+              which are read as decompressed streams. Everything else
+              (read, and readers of fileobj such as python-docx) gets
+              copies of the bytes. Accepted in place of a file path by the
+              parser, merger, restyler and image locator.
+    History:  Version 1
+    """
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Initialization
+    # ////////////////////////////////////////////////////////////////////////
+    def __init__(self, path):
+        """
+        Name:     DocxPackage.__init__
+        Inputs:   str, path to a .docx file (path)
+        Features: Opens and maps the file and indexes its members
+        """
+        self.path = path      # path to the .docx
+        self.file = None      # open file object
+        self.mmap = None      # read-only memory map of the file
+        self.zip = None       # ZipFile reading from the memory map
+        self.members = {}     # member names and their ZipInfo
+        self.offsets = {}     # member names and the positions of their data
+
+        if not os.path.isfile(path):
+            raise OSError("File %s does not exist!" % (path))
+        self.file = open(path, 'rb')
+        try:
+            self.mmap = mmap.mmap(
+                self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.zip = ZipFile(self.fileobj(), 'r')
+        except Exception:
+            self.close()
+            raise
+        for info in self.zip.infolist():
+            self.members[info.filename] = info
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __reduce__(self):
+        # Worker processes reopen the file rather than copy the map
+        return (DocxPackage, (self.path,))
+
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Function Definitions
+    # ////////////////////////////////////////////////////////////////////////
+    def close(self):
+        """
+        Name:     DocxPackage.close
+        Inputs:   None
+        Outputs:  None
+        Features: Closes the zip, the memory map and the file; any views
+                  must be released first
+        """
+        if self.zip is not None:
+            self.zip.close()
+            self.zip = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def fileobj(self):
+        """
+        Name:     DocxPackage.fileobj
+        Inputs:   None
+        Outputs:  file object, a new read-only cursor over the whole file
+        Features: Lets python-docx and zipfile read the package from the
+                  memory map (e.g., docx.Document(pkg.fileobj()))
+        """
+        return _MmapFile(self.mmap)
+
+    def namelist(self):
+        """
+        Name:     DocxPackage.namelist
+        Inputs:   None
+        Outputs:  list, member names in archive order
+        """
+        return list(self.members.keys())
+
+    def open(self, name):
+        """
+        Name:     DocxPackage.open
+        Inputs:   str, member name (name)
+        Outputs:  file object, the member's decompressed content
+        """
+        return self.zip.open(self.members[name])
+
+    def read(self, name):
+        """
+        Name:     DocxPackage.read
+        Inputs:   str, member name (name)
+        Outputs:  bytes, the member's decompressed content
+        Depends:  view
+        """
+        my_data = None
+        if self.members[name].compress_type == ZIP_STORED:
+            with self.view(name) as v:
+                my_data = v.tobytes()
+        else:
+            my_data = self.zip.read(self.members[name])
+        add_count("zip.read:" + name, len(my_data))
+        return my_data
+
+    def view(self, name):
+        """
+        Name:     DocxPackage.view
+        Inputs:   str, name of a member stored without compression (name)
+        Outputs:  memoryview, the member's bytes within the memory map
+        Features: Zero-copy access to a ZIP_STORED member; raises
+                  ValueError for a compressed one (use open or read).
+                  Release the view (or use it in a with statement) before
+                  closing.
+        """
+        info = self.members[name]
+        if info.compress_type != ZIP_STORED:
+            raise ValueError("%s is compressed" % (name))
+        if name not in self.offsets:
+            header = self.mmap[info.header_offset:info.header_offset + 30]
+            if header[:4] != b"PK\x03\x04":
+                raise ValueError("Bad local header for %s" % (name))
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            self.offsets[name] = (
+                info.header_offset + 30 + name_len + extra_len)
+        start = self.offsets[name]
+        return memoryview(self.mmap)[start:start + info.file_size]
+
+
 class DocxPics(object):
     """
     Name:     DocxPics
     Features: Class for organizing references to images found within a .docx
-    History:  Version 1
+    History:  Version 3
+              - streaming scan of document.xml (stream=True)
+              - image extraction over a shared zip handle
+              - indexed blip and relationship lookup
     """
     # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
     # Class Initialization
     # ////////////////////////////////////////////////////////////////////////
-    def __init__(self, doc_path):
+    def __init__(self, doc_path, stream=False):
         """
         Name:     DocxPics.__init__
-        Inputs:   str, path to a docx document
+        Inputs:   - str, path to a docx document; or a DocxPackage
+                    (doc_path)
+                  - bool, whether to stream document.xml rather than hold
+                    it in memory (stream)
         Features: Initializes the DocxPics class
         """
         # Initialize the class parameters
@@ -62,81 +524,221 @@ class DocxPics(object):
         self.relet = None      # ElementTree of document.xml.rel
         self.namespace = {}    # namespace dictionary
         self.imagemap = {}     # map between relationship IDs and image paths
-        self.imID = None       # temporary image ID
+        self.blip_ids = set()  # image relationship IDs used by a:blip
+        self.targets = {}      # relationship IDs and their targets
+        self.external = set()  # relationship IDs of external targets
+        self.zip = None        # open ZipFile shared by image extraction
+        self.doc_member = None  # zip member name of document.xml
 
         # Check that input document is valid
-        if os.path.isfile(doc_path):
+        if isinstance(doc_path, DocxPackage) or os.path.isfile(doc_path):
             self.docx = doc_path
-            self.open_docxml()
-            self.get_docx_namespace()
-            self.find_images()
+            if stream:
+                self.scan_docxml()
+            else:
+                self.open_docxml()
+                self.get_docx_namespace()
+                self.find_images()
         else:
             self.docx = None
             raise OSError("File %s does not exist!" % (doc_path))
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
     # Class Function Definitions
     # ////////////////////////////////////////////////////////////////////////
+    def add_image(self, rec):
+        """
+        Name:     DocxPics.add_image
+        Inputs:   dict, an image record from para_images (rec)
+        Outputs:  None
+        Features: Adds an image record to the paragraph summaries
+        """
+        i = rec['para']
+        j = rec['run']
+        self.num_images += 1
+        if rec['draw'] == 0:
+            self.paralist.append(i)
+            self.paraIdList.append(rec['paraId'])
+        if i in self.paras.keys():
+            self.paras[i]['num_images'] += 1
+            self.paras[i]['runs'][j] = {
+                'imgID': rec['imgID'],
+                "imgPath": rec['imgPath']
+            }
+        else:
+            self.paras[i] = {
+                'paraId': rec['paraId'],
+                'num_run': rec['num_run'],
+                'num_images': 1,
+                'runs': {
+                    j: {
+                        'imgID': rec['imgID'],
+                        'imgPath': rec['imgPath']
+                    }
+                }
+            }
+
+    def close(self):
+        """
+        Name:     DocxPics.close
+        Inputs:   None
+        Outputs:  None
+        Features: Closes the zip handle used for image extraction
+        """
+        if self.zip is not None:
+            self.zip.close()
+            self.zip = None
+
+    def extract_image(self, img, dest, chunk_size=COPY_CHUNK):
+        """
+        Name:     DocxPics.extract_image
+        Inputs:   - str, image relationship ID or path (img)
+                  - str, output file path; or a writable file object; or a
+                    writable buffer (e.g., bytearray) to fill (dest)
+                  - int, number of bytes copied at a time (chunk_size)
+        Outputs:  int, number of bytes written
+        Features: Streams an image out of the .docx in chunks without
+                  loading the whole image into memory
+        Depends:  - find_media
+                  - open_zip
+        """
+        my_zip = self.open_zip()
+        num_bytes = 0
+        with my_zip.open(self.find_media(img)) as src:
+            if isinstance(dest, str):
+                with open(dest, 'wb') as dst:
+                    num_bytes = self._copy_stream(src, dst, chunk_size)
+            elif hasattr(dest, 'write'):
+                num_bytes = self._copy_stream(src, dest, chunk_size)
+            else:
+                # Read straight into the caller's buffer
+                view = memoryview(dest).cast('B')
+                while num_bytes < len(view):
+                    n = src.readinto(
+                        view[num_bytes:num_bytes + chunk_size])
+                    if not n:
+                        break
+                    num_bytes += n
+        return num_bytes
+
+    def extract_images(self, out_dir, first=None, last=None):
+        """
+        Name:     DocxPics.extract_images
+        Inputs:   - str, directory to write images to (out_dir)
+                  - int, index of the first paragraph to include (first)
+                  - int, index of the last paragraph to include (last)
+        Outputs:  dict, image relationship IDs and their extracted paths
+        Features: Extracts the images referenced by paragraphs first..last
+                  (inclusive; default is all paragraphs); linked (external)
+                  images are skipped. Media with identical content is only
+                  written once: a member whose CRC and size match one
+                  already written is hashed first, without writing it.
+        Depends:  - extract_image
+                  - find_media
+                  - open_zip
+        """
+        my_files = {}    # media member to extracted path
+        my_digests = {}  # content hash to extracted path
+        my_sums = set()  # CRCs and sizes of the media written
+        extracted = {}
+        for i in sorted(self.paras.keys()):
+            if (first is not None and i < first) or (
+                    last is not None and i > last):
+                continue
+            for run in self.paras[i]['runs'].values():
+                img_id = run['imgID']
+                if (img_id in extracted or img_id not in self.imagemap or
+                        img_id in self.external):
+                    continue
+                member = self.find_media(img_id)
+                if member not in my_files:
+                    info = self.open_zip().getinfo(member)
+                    out_path = None
+                    if (info.CRC, info.file_size) in my_sums:
+                        my_hash = _HashingWriter(None)
+                        with my_hash:
+                            self.extract_image(img_id, my_hash)
+                        out_path = my_digests.get(my_hash.hexdigest())
+                    if out_path is None:
+                        out_path = os.path.join(
+                            out_dir, posixpath.basename(member))
+                        my_hash = _HashingWriter(out_path)
+                        with my_hash:
+                            self.extract_image(img_id, my_hash)
+                        my_digests[my_hash.hexdigest()] = out_path
+                        my_sums.add((info.CRC, info.file_size))
+                    my_files[member] = out_path
+                extracted[img_id] = my_files[member]
+        return extracted
+
+    def find_docxml(self, my_zip):
+        """
+        Name:     DocxPics.find_docxml
+        Inputs:   zipfile.ZipFile, the open .docx (my_zip)
+        Returns:  tuple, member names of document.xml and its .rels
+        Features: Finds the document.xml and document.xml.rels members
+        """
+        my_doc = ""
+        my_rel = ""
+        for zc in my_zip.namelist():
+            if "document.xml" in zc and zc.endswith('rels'):
+                my_rel = zc
+            if "document.xml" in zc and not zc.endswith('rels'):
+                my_doc = zc
+        return (my_doc, my_rel)
+
     def find_images(self):
         """
         Name:     DocxPics.count_paragraphs
         Inputs:   None
         Outputs:  None
         Features: Finds and counts paragraphs, runs, and images in .docx
-        Depends:  - map_images
-                  - search_for_attr
-        """
-        self.map_images()
-        self.paralist = []
-        self.paraIdList = []
-        self.paras = {}
-        self.num_images = 0
-        if self.xmlet:
-            my_paras = self.xmlet[0].findall("w:p", self.namespace)
-            self.num_paras = len(my_paras)
-            for i in range(self.num_paras):
-                para = my_paras[i]
-                # Get paragraph ID:
-                para_id = ''
-                for k, v in para.attrib.items():
-                    if 'paraId' in k:
-                        para_id = v
-
-                # Find all runs in paragraph
-                runs = para.findall("w:r", self.namespace)
-                num_runs = len(runs)
-                for j in range(num_runs):
-                    run = runs[j]
-                    draws = run.findall("w:drawing", self.namespace)
-                    num_draws = len(draws)
-                    self.num_images += num_draws
-                    if num_draws > 0:
-                        self.paralist.append(i)
-                        self.paraIdList.append(para_id)
-                        for draw in draws:
-                            self.imID = None
-                            self.search_for_attr(draw, 'embed')
-                            draw_path = ""
-                            if self.imID in self.imagemap.keys():
-                                draw_path = self.imagemap[self.imID]
-                            if i in self.paras.keys():
-                                self.paras[i]['num_images'] += 1
-                                self.paras[i]['runs'][j] = {
-                                    'imgID': str(self.imID),
-                                    "imgPath": draw_path
-                                }
-                            else:
-                                self.paras[i] = {
-                                    'paraId': para_id,
-                                    'num_run': num_runs,
-                                    'num_images': 1,
-                                    'runs': {
-                                        j: {
-                                            'imgID': str(self.imID),
-                                            'imgPath': draw_path
-                                        }
-                                    }
-                                }
+        Depends:  - add_image
+                  - map_images
+                  - para_images
+        """
+        with stage("DocxPics.find_images"):
+            self.map_images()
+            self.paralist = []
+            self.paraIdList = []
+            self.paras = {}
+            self.num_images = 0
+            if self.xmlet:
+                my_paras = self.xmlet[0].findall("w:p", self.namespace)
+                self.num_paras = len(my_paras)
+                for i in range(self.num_paras):
+                    for rec in self.para_images(
+                            i, my_paras[i], self.imagemap):
+                        self.add_image(rec)
+                add_count("paragraphs visited", self.num_paras)
+
+    def find_media(self, img):
+        """
+        Name:     DocxPics.find_media
+        Inputs:   str, image relationship ID or path (img)
+        Outputs:  str, the image's member name within the .docx
+        Features: Resolves an image path (relative to document.xml) to its
+                  zip member name; raises ValueError for a linked image
+                  (TargetMode="External"), which is not in the .docx
+        Depends:  - find_docxml
+                  - open_zip
+        """
+        if img in self.external:
+            raise ValueError("Image %s is external (%s)" % (
+                img, self.targets.get(img)))
+        my_path = self.imagemap.get(img, img)
+        if my_path.startswith("/"):
+            return my_path.lstrip("/")
+        if self.doc_member is None:
+            self.doc_member, my_rel = self.find_docxml(self.open_zip())
+        return posixpath.normpath(
+            posixpath.join(posixpath.dirname(self.doc_member), my_path))
 
     def get_docx_namespace(self):
         """
@@ -152,28 +754,94 @@ class DocxPics(object):
                 k, v = ns
                 self.namespace[k] = v
 
+    def iter_images(self):
+        """
+        Name:     DocxPics.iter_images
+        Inputs:   None
+        Outputs:  generator, image records (see para_images)
+        Features: Streams document.xml from the .docx with iterparse and
+                  yields a record for each image drawing as its paragraph is
+                  read; each top-level element is dropped once processed,
+                  so memory use does not grow with the document. Fills the
+                  paragraph count, namespaces and image map as it goes.
+        Depends:  - find_docxml
+                  - para_images
+        """
+        self.num_paras = 0
+        self.namespace = {}
+        self.imagemap = {}
+        self.blip_ids = set()
+        self.targets = {}
+        self.external = set()
+        if not self.docx:
+            return
+
+        with open_docx_zip(self.docx) as my_zip:
+            my_doc, my_rel = self.find_docxml(my_zip)
+            if my_rel != "":
+                with my_zip.open(my_rel) as f:
+                    for my_r in ElementTree.parse(f).getroot():
+                        if 'Id' in my_r.attrib:
+                            self.targets[my_r.attrib['Id']] = my_r.get(
+                                'Target')
+                            if my_r.get('TargetMode') == "External":
+                                self.external.add(my_r.attrib['Id'])
+            if my_doc == "":
+                return
+
+            with my_zip.open(my_doc) as f:
+                depth = 0
+                body = None
+                for event, elem in ElementTree.iterparse(
+                        f, events=('start-ns', 'start', 'end')):
+                    if event == 'start-ns':
+                        k, v = elem
+                        if k:
+                            self.namespace[k] = v
+                    elif event == 'start':
+                        depth += 1
+                        if depth == 2:
+                            body = elem
+                        elif elem.tag == A_BLIP:
+                            img_id = elem.get(R_EMBED)
+                            self.blip_ids.add(img_id)
+                            if img_id in self.targets:
+                                self.imagemap[img_id] = self.targets[img_id]
+                    else:
+                        depth -= 1
+                        if depth == 2:
+                            if elem.tag == W_P:
+                                for rec in self.para_images(
+                                        self.num_paras, elem, self.imagemap):
+                                    yield rec
+                                self.num_paras += 1
+                            body.remove(elem)
+
     def map_images(self):
         """
         Name:     DocxPics.map_images
         Inputs:   None
         Outputs:  None
-        Features: Maps image relationship IDs to their paths within .docx
-        Depends:  re
+        Features: Maps image relationship IDs to their paths within .docx;
+                  indexes the blip IDs of document.xml and the targets of
+                  its relationships, so each lookup is a single hash
         """
         self.imagemap = {}
-        if self.xml:
-            my_blips = re.findall('a:blip r:embed="(\S+)"', self.xml)
+        self.blip_ids = set()
+        self.targets = {}
+        self.external = set()
+        if self.xmlet is not None:
+            for blip in self.xmlet.iter(A_BLIP):
+                self.blip_ids.add(blip.get(R_EMBED))
+        if self.relet is not None:
             for my_rel in self.relet:
-                is_img = False
-                img_id = ""
-                img_path = ""
-                for k, v in my_rel.attrib.items():
-                    if k == "Id" and v in my_blips:
-                        is_img = True
-                        img_id = v
-                if is_img:
-                    img_path = my_rel.attrib['Target']
-                    self.imagemap[img_id] = img_path
+                if 'Id' in my_rel.attrib:
+                    self.targets[my_rel.attrib['Id']] = my_rel.get('Target')
+                    if my_rel.get('TargetMode') == "External":
+                        self.external.add(my_rel.attrib['Id'])
+        for img_id, img_path in self.targets.items():
+            if img_id in self.blip_ids:
+                self.imagemap[img_id] = img_path
 
     def open_docxml(self):
         """
@@ -183,53 +851,611 @@ class DocxPics(object):
         Features: Reads the XML from document.xml within a .docx and creates
                   ElementTree objects from string
         Depends:  - ElementTree
+                  - find_docxml
                   - zipfile.ZipFile
         """
         self.xml = ""
         self.rel = ""
         if self.docx:
-            my_doc = ""
-            my_rel = ""
-            my_zip = ZipFile(self.docx, 'r')
-            for zc in my_zip.namelist():
-                if "document.xml" in zc and zc.endswith('rels'):
-                    my_rel = zc
-                if "document.xml" in zc and not zc.endswith('rels'):
-                    my_doc = zc
-
-            if my_doc != "":
-                with my_zip.open(my_doc) as f:
-                    for d in f:
-                        self.xml = "".join([self.xml, d.decode("utf-8")])
-                self.xmlet = ElementTree.fromstring(self.xml)
+            with stage("DocxPics.open_docxml"), \
+                    open_docx_zip(self.docx) as my_zip:
+                my_doc, my_rel = self.find_docxml(my_zip)
+                if my_doc != "":
+                    my_data = my_zip.read(my_doc)
+                    add_count("zip.read:" + my_doc, len(my_data))
+                    self.xml = my_data.decode("utf-8")
+                    self.xmlet = ElementTree.fromstring(self.xml)
 
-            if my_rel != "":
-                with my_zip.open(my_rel) as f:
-                    for d in f:
-                        self.rel = "".join([self.rel, d.decode("utf-8")])
-                self.relet = ElementTree.fromstring(self.rel)
+                if my_rel != "":
+                    my_data = my_zip.read(my_rel)
+                    add_count("zip.read:" + my_rel, len(my_data))
+                    self.rel = my_data.decode("utf-8")
+                    self.relet = ElementTree.fromstring(self.rel)
+
+    def open_zip(self):
+        """
+        Name:     DocxPics.open_zip
+        Inputs:   None
+        Returns:  zipfile.ZipFile, the open .docx
+        Features: Opens the .docx once for image extraction and keeps the
+                  handle until close; a DocxPackage's own handle is used
+                  as is (and left open)
+        """
+        if isinstance(self.docx, DocxPackage):
+            return self.docx.zip
+        if self.zip is None:
+            self.zip = ZipFile(self.docx, 'r')
+        return self.zip
 
-    def search_for_attr(self, my_et, my_attr, is_found=False):
+    def package_images(self):
+        """
+        Name:     DocxPics.package_images
+        Inputs:   None
+        Outputs:  dict, image members and their locations
+        Features: Finds the images in every story part of the .docx over
+                  the shared zip handle (see find_package_images)
+        Depends:  - find_package_images
+                  - open_zip
+        """
+        return find_package_images(self.open_zip())
+
+    def para_images(self, i, para, imagemap):
+        """
+        Name:     DocxPics.para_images
+        Inputs:   - int, paragraph index (i)
+                  - xml.etree.ElementTree.Element, paragraph (para)
+                  - dict, image relationship IDs and paths (imagemap)
+        Outputs:  generator, dict records with the paragraph index and
+                  paraId, number of runs, run index, drawing index within
+                  the run, image relationship ID and image path
+        Features: Finds the image drawings in the runs of a paragraph; each
+                  drawing's image is its first a:blip
+        """
+        # Get paragraph ID:
+        para_id = ''
+        for k, v in para.attrib.items():
+            if 'paraId' in k:
+                para_id = v
+
+        # Find all runs in paragraph
+        runs = para.findall(W_R)
+        num_runs = len(runs)
+        for j in range(num_runs):
+            draws = runs[j].findall(W_DRAWING)
+            for n in range(len(draws)):
+                img_id = None
+                blip = draws[n].find(".//" + A_BLIP)
+                if blip is not None:
+                    img_id = blip.get(R_EMBED)
+                draw_path = imagemap.get(img_id, "")
+                yield {
+                    'para': i,
+                    'paraId': para_id,
+                    'num_run': num_runs,
+                    'run': j,
+                    'draw': n,
+                    'imgID': str(img_id),
+                    'imgPath': draw_path
+                }
+
+    def scan_docxml(self):
+        """
+        Name:     DocxPics.scan_docxml
+        Inputs:   None
+        Returns:  None
+        Features: Finds and counts paragraphs, runs, and images in .docx
+                  by streaming document.xml; the XML is not kept
+        Depends:  - add_image
+                  - iter_images
+        """
+        with stage("DocxPics.scan_docxml"):
+            self.paralist = []
+            self.paraIdList = []
+            self.paras = {}
+            self.num_images = 0
+            for rec in self.iter_images():
+                self.add_image(rec)
+            add_count("paragraphs visited", self.num_paras)
+
+    def search_for_attr(self, my_et, my_attr):
         """
         Name:     DocxPics.search_for_attr
         Inputs:   - xml.etree.ElementTree.Element
                   - str, attribute name (my_attr)
-                  - bool, if attribute has been found
-        Outputs:  str, value of the search attribute
-        Features: Recursive search of ET until element is found with attribute
+        Outputs:  str, value of the search attribute; None if not found
+        Features: Searches the descendants of an element, in document
+                  order, and stops at the first with the attribute
+        """
+        for elem in my_et.iter():
+            if elem is my_et:
+                continue
+            for k, v in elem.attrib.items():
+                if my_attr in k:
+                    return v
+        return None
+
+    def _copy_stream(self, src, dst, chunk_size):
+        """
+        Name:     DocxPics._copy_stream
+        Inputs:   - file object, readable source (src)
+                  - file object, writable destination (dst)
+                  - int, number of bytes copied at a time (chunk_size)
+        Outputs:  int, number of bytes copied
+        """
+        num_bytes = 0
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            dst.write(chunk)
+            num_bytes += len(chunk)
+        return num_bytes
+
+
+class LazyDocxPics(DocxPics):
+    """
+    Name:     LazyDocxPics
+    Features: DocxPics that reads nothing until it is asked; each property
+              is worked out on first access and kept. The image map comes
+              from the .rels part alone, so has_images does not read
+              document.xml.
+    History:  Version 1
+    """
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Initialization
+    # ////////////////////////////////////////////////////////////////////////
+    def __init__(self, doc_path):
+        """
+        Name:     LazyDocxPics.__init__
+        Inputs:   str, path to a docx document; or a DocxPackage (doc_path)
+        Features: Initializes the LazyDocxPics class; only checks that the
+                  file exists
+        """
+        self.zip = None        # open ZipFile shared by all reads
+        self.docx = None
+        if not isinstance(doc_path, DocxPackage) and not os.path.isfile(
+                doc_path):
+            raise OSError("File %s does not exist!" % (doc_path))
+        self.docx = doc_path
+
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Property Definitions
+    # ////////////////////////////////////////////////////////////////////////
+    @cached_property
+    def blip_ids(self):
+        """Image relationship IDs used by a:blip in document.xml"""
+        if self.xmlet is None:
+            return set()
+        return set(blip.get(R_EMBED) for blip in self.xmlet.iter(A_BLIP))
+
+    @cached_property
+    def doc_member(self):
+        """Zip member name of document.xml"""
+        return self._members[0]
+
+    @cached_property
+    def external(self):
+        """Relationship IDs of document.xml with external targets"""
+        my_ids = set()
+        if self.relet is not None:
+            for my_r in self.relet:
+                if my_r.get('TargetMode') == "External":
+                    my_ids.add(my_r.get('Id'))
+        return my_ids
+
+    @cached_property
+    def imagemap(self):
+        """Image relationship IDs and their paths, from the .rels part"""
+        my_map = {}
+        if self.relet is not None:
+            for my_r in self.relet:
+                if my_r.get('Type') == IMAGE_REL and 'Id' in my_r.attrib:
+                    my_map[my_r.attrib['Id']] = my_r.get('Target')
+        return my_map
+
+    @cached_property
+    def namespace(self):
+        """Namespace prefixes and URIs declared in document.xml"""
+        self.get_docx_namespace()
+        return self.__dict__.get('namespace', {})
+
+    @cached_property
+    def num_images(self):
+        """Number of images in document.xml"""
+        return self._scanned('num_images')
+
+    @cached_property
+    def num_paras(self):
+        """Number of paragraphs in document.xml"""
+        return self._scanned('num_paras')
+
+    @cached_property
+    def paraIdList(self):
+        """The paraIds of the paragraphs containing an image"""
+        return self._scanned('paraIdList')
+
+    @cached_property
+    def paralist(self):
+        """Indices of the paragraphs containing an image"""
+        return self._scanned('paralist')
+
+    @cached_property
+    def paras(self):
+        """Paragraph image information (see DocxPics.add_image)"""
+        return self._scanned('paras')
+
+    @cached_property
+    def rel(self):
+        """document.xml.rels as string"""
+        return self._read(self._members[1])
+
+    @cached_property
+    def relet(self):
+        """ElementTree of document.xml.rels"""
+        if self.rel:
+            return ElementTree.fromstring(self.rel)
+        return None
+
+    @cached_property
+    def targets(self):
+        """Relationship IDs of document.xml and their targets"""
+        my_targets = {}
+        if self.relet is not None:
+            for my_r in self.relet:
+                if 'Id' in my_r.attrib:
+                    my_targets[my_r.attrib['Id']] = my_r.get('Target')
+        return my_targets
+
+    @cached_property
+    def xml(self):
+        """document.xml as string"""
+        return self._read(self._members[0])
+
+    @cached_property
+    def xmlet(self):
+        """ElementTree of document.xml"""
+        if self.xml:
+            return ElementTree.fromstring(self.xml)
+        return None
+
+    @cached_property
+    def _members(self):
+        """Member names of document.xml and its .rels"""
+        return self.find_docxml(self.open_zip())
+
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Function Definitions
+    # ////////////////////////////////////////////////////////////////////////
+    def has_images(self):
         """
-        if not is_found:
-            for child in my_et:
-                for k, v in child.attrib.items():
-                    if my_attr in k:
-                        is_found = True
-                        self.imID = v
-                self.search_for_attr(child, my_attr, is_found)
+        Name:     LazyDocxPics.has_images
+        Inputs:   None
+        Outputs:  bool, whether document.xml has image relationships
+        Features: Answers from the .rels part alone; document.xml is not
+                  read
+        """
+        return len(self.imagemap) > 0
+
+    def map_images(self):
+        """
+        Name:     LazyDocxPics.map_images
+        Inputs:   None
+        Outputs:  None
+        Features: Keeps the image map read from the .rels part
+        """
+        self.imagemap
+
+    def _read(self, member):
+        """
+        Name:     LazyDocxPics._read
+        Inputs:   str, zip member name; may be empty (member)
+        Outputs:  str, the member's text
+        """
+        if not member:
+            return ""
+        my_data = self.open_zip().read(member)
+        add_count("zip.read:" + member, len(my_data))
+        return my_data.decode("utf-8")
+
+    def _scanned(self, name):
+        """
+        Name:     LazyDocxPics._scanned
+        Inputs:   str, attribute set by find_images (name)
+        Outputs:  the attribute's value
+        Features: Runs find_images once; it sets all of the paragraph and
+                  image attributes, which then hide these properties
+        """
+        self.find_images()
+        return self.__dict__.get(name, 0)
+
+
+class ParagraphIndex(object):
+    """
+    Name:     ParagraphIndex
+    Features: Class for looking up the paragraphs of an open .docx document
+              by position, style and text; the paragraph proxies and their
+              style IDs are built once per document
+    History:  Version 1
+    """
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Initialization
+    # ////////////////////////////////////////////////////////////////////////
+    def __init__(self, d):
+        """
+        Name:     ParagraphIndex.__init__
+        Inputs:   docx.document.Document, open word document (d)
+        Features: Initializes the ParagraphIndex class
+        """
+        # NOTE: each access to d.paragraphs rebuilds the proxy list
+        self.paragraphs = d.paragraphs  # paragraph proxies
+        self.num_paras = len(self.paragraphs)  # number of paragraphs
+        self.style_ids = []    # style ID of each paragraph
+        self.style_names = {}  # style ID to style name
+        self.positions = {}    # style ID to list of paragraph indices
+        self._texts = None     # paragraph text, read on first request
+
+        # Resolve each distinct w:pStyle value once (unknown ids fall back
+        # to the default paragraph style, same as python-docx)
+        resolved = {}
+        for i in range(self.num_paras):
+            para = self.paragraphs[i]
+            p_style = para._p.style
+            if p_style not in resolved:
+                my_style = para.style
+                resolved[p_style] = my_style.style_id
+                self.style_names[my_style.style_id] = my_style.name
+            style_id = resolved[p_style]
+            self.style_ids.append(style_id)
+            if style_id in self.positions:
+                self.positions[style_id].append(i)
+            else:
+                self.positions[style_id] = [i]
+
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Function Definitions
+    # ////////////////////////////////////////////////////////////////////////
+    def find_style(self, style_id):
+        """
+        Name:     ParagraphIndex.find_style
+        Inputs:   str, paragraph style ID (style_id)
+        Outputs:  list, indices of paragraphs with the given style
+        """
+        return self.positions.get(style_id, [])
+
+    def histogram(self):
+        """
+        Name:     ParagraphIndex.histogram
+        Inputs:   None
+        Outputs:  dict, style_id (keys) with name and counts (keys) found
+        Features: Counts the paragraphs of each style, in order of first use
+        """
+        style_dict = {}
+        for style_id, idx in self.positions.items():
+            style_dict[style_id] = {
+                'name': self.style_names[style_id],
+                'count': len(idx)
+            }
+        return style_dict
+
+    def text(self, i):
+        """
+        Name:     ParagraphIndex.text
+        Inputs:   int, paragraph index (i)
+        Outputs:  str, the paragraph's text
+        """
+        return self.texts()[i]
+
+    def texts(self):
+        """
+        Name:     ParagraphIndex.texts
+        Inputs:   None
+        Outputs:  list, text of each paragraph
+        Features: Reads the text of all paragraphs once and keeps it
+        """
+        if self._texts is None:
+            self._texts = [para.text for para in self.paragraphs]
+        return self._texts
+
+
+class TemplateCache(object):
+    """
+    Name:     TemplateCache
+    Features: Class for handing out new documents built on a template. Each
+              template is read and parsed once, and its body emptied once;
+              every document handed out is a copy whose XML parts (body,
+              styles, numbering, settings, headers, ...) are cloned from
+              the parsed tree while its binary parts (theme, fonts, media)
+              are shared, so nothing is parsed again. The cache is bounded
+              by number of templates and by their total size.
+    History:  Version 1
+    """
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Initialization
+    # ////////////////////////////////////////////////////////////////////////
+    def __init__(self, max_entries=8, max_bytes=TEMPLATE_BYTES):
+        """
+        Name:     TemplateCache.__init__
+        Inputs:   - int, number of parsed templates to keep (max_entries)
+                  - int, total uncompressed size of the templates to keep
+                    (max_bytes)
+        Features: Initializes the TemplateCache class
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.masters = {}   # template key to its parsed Document
+        self.sizes = {}     # template key to its uncompressed size
+        self.total = 0      # sum of sizes
+        self.hits = 0       # copies made from a parsed template
+        self.misses = 0     # templates parsed
+
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Function Definitions
+    # ////////////////////////////////////////////////////////////////////////
+    def clear(self):
+        """
+        Name:     TemplateCache.clear
+        Inputs:   None
+        Outputs:  None
+        Features: Forgets the parsed templates
+        """
+        self.masters = {}
+        self.sizes = {}
+        self.total = 0
+
+    def document(self, template=None, keep_body=False):
+        """
+        Name:     TemplateCache.document
+        Inputs:   - str, path to a .docx; or a DocxPackage; or None for
+                    the python-docx default template (template)
+                  - bool, whether to keep the template's body (keep_body)
+        Outputs:  docx.document.Document, a new document that may be
+                  changed and saved without affecting the cache
+        Features: Parses the template on first use (again if the file has
+                  changed); by default its body is emptied, except for the
+                  section properties. The least recently used templates
+                  are dropped when the cache is full; a template larger
+                  than max_bytes is handed out as parsed and not kept.
+        Depends:  - open_document
+                  - _clone_document
+                  - _size
+        """
+        key = self._key(template, keep_body)
+        if key in self.masters:
+            self.hits += 1
+            master = self.masters.pop(key)
+        else:
+            self.misses += 1
+            size = self._size(template)
+            master = open_document(template)
+            if not keep_body:
+                body = master.element.body
+                for e in list(body):
+                    if e is not body.sectPr:
+                        body.remove(e)
+            if size > self.max_bytes > 0:
+                return master
+            while self.masters and (
+                    len(self.masters) >= self.max_entries > 0 or
+                    self.total + size > self.max_bytes > 0):
+                old_key = next(iter(self.masters))
+                self.masters.pop(old_key)
+                self.total -= self.sizes.pop(old_key)
+            self.sizes[key] = size
+            self.total += size
+        self.masters[key] = master
+        return _clone_document(master)
+
+    def _key(self, template, keep_body):
+        """
+        Name:     TemplateCache._key
+        Inputs:   - str, DocxPackage or None, template (template)
+                  - bool, whether the body is kept (keep_body)
+        Outputs:  tuple, the template's path, modification time and size;
+                  a DocxPackage is its own key, as it is parsed from its
+                  memory map rather than from the file
+        """
+        if isinstance(template, DocxPackage):
+            return (template, keep_body)
+        if template is None:
+            return (None, 0, 0, keep_body)
+        st = os.stat(template)
+        return (os.path.abspath(template), st.st_mtime_ns, st.st_size,
+                keep_body)
+
+    def _size(self, template):
+        """
+        Name:     TemplateCache._size
+        Inputs:   str, DocxPackage or None, template (template)
+        Outputs:  int, uncompressed size of the template's members, as a
+                  measure of its parsed size; 0 for the default template
+        Depends:  open_docx_zip
+        """
+        if template is None:
+            return 0
+        with open_docx_zip(template) as my_zip:
+            return sum(info.file_size for info in my_zip.infolist())
+
+
+class _HashingWriter(object):
+    """
+    Name:     _HashingWriter
+    Features: Writable file that hashes the content written to it; with
+              no path, the content is only hashed
+    """
+    def __init__(self, path):
+        self.f = None
+        if path is not None:
+            self.f = open(path, 'wb')
+        self.hash = hashlib.sha256()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.f is not None:
+            self.f.close()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def write(self, data):
+        self.hash.update(data)
+        if self.f is not None:
+            return self.f.write(data)
+        return len(data)
+
+
+class _MmapFile(object):
+    """
+    Name:     _MmapFile
+    Features: Seekable, read-only file object over a memory map, each with
+              its own position (see DocxPackage.fileobj); read returns a
+              copy of the mapped bytes, as a file's read would
+    """
+    def __init__(self, my_map):
+        self.mmap = my_map
+        self.pos = 0
+
+    def read(self, n=-1):
+        end = len(self.mmap)
+        if n is not None and n >= 0:
+            end = min(end, self.pos + n)
+        my_data = self.mmap[self.pos:end]
+        self.pos += len(my_data)
+        return my_data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.mmap)
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
 
 
 ##############################################################################
 # FUNCTIONS
 ##############################################################################
+def add_count(name, n=1):
+    """
+    Name:     add_count
+    Inputs:   - str, counter name, e.g., 'paragraphs visited' (name)
+              - int, amount to add (n)
+    Outputs:  None
+    Features: Adds to a counter while instrumentation is enabled; call it
+              once per batch rather than once per item in hot loops
+    """
+    if _INSTRUMENT['on']:
+        counters = _INSTRUMENT['counters']
+        counters[name] = counters.get(name, 0) + n
+
+
 def delete_paragraph(paragraph):
     """
     Ref: abdul mutal (StackOverflow)
@@ -240,6 +1466,45 @@ def delete_paragraph(paragraph):
     p._p = p._element = None
 
 
+def disable_instrumentation():
+    """
+    Name:     disable_instrumentation
+    Inputs:   None
+    Outputs:  None
+    Features: Stops recording and restores the python-docx functions; the
+              results are kept for instrument_report
+    """
+    _INSTRUMENT['on'] = False
+    if _INSTRUMENT['profile'] is not None:
+        _INSTRUMENT['profile'].disable()
+    for (owner, attr), func in _INSTRUMENT['patched'].items():
+        setattr(owner, attr, func)
+    _INSTRUMENT['patched'] = {}
+
+
+def enable_instrumentation(profile=False):
+    """
+    Name:     enable_instrumentation
+    Inputs:   bool, whether to run cProfile as well (profile)
+    Outputs:  None
+    Features: Clears and starts the stage timers and counters; opening
+              and saving python-docx documents are timed too. May also be
+              turned on with the DOCX_INSTRUMENT environment variable
+              (see instrument_from_env).
+    Depends:  _patch_docx
+    """
+    disable_instrumentation()
+    _INSTRUMENT['stages'] = {}
+    _INSTRUMENT['counters'] = {}
+    _INSTRUMENT['start'] = time.perf_counter()
+    _INSTRUMENT['profile'] = None
+    if profile:
+        _INSTRUMENT['profile'] = cProfile.Profile()
+        _INSTRUMENT['profile'].enable()
+    _INSTRUMENT['on'] = True
+    _patch_docx()
+
+
 def find_files(d, k=""):
     """
     Name:     find_files
@@ -252,6 +1517,98 @@ def find_files(d, k=""):
     return sorted(my_files)
 
 
+def find_main_part(my_zip):
+    """
+    Name:     find_main_part
+    Inputs:   zipfile.ZipFile, an open .docx (my_zip)
+    Outputs:  str, member name of the main document part
+    Features: Follows the package relationships to document.xml
+    """
+    try:
+        rels = ElementTree.fromstring(my_zip.read("_rels/.rels"))
+    except KeyError:
+        return "word/document.xml"
+    for rel in rels:
+        if rel.get("Type", "").endswith("/officeDocument"):
+            return rel.get("Target").lstrip("/")
+    return "word/document.xml"
+
+
+def find_package_images(doc):
+    """
+    Name:     find_package_images
+    Inputs:   str, path to a .docx; or an open zipfile.ZipFile or
+              DocxPackage (doc)
+    Outputs:  dict, image member names (or external targets) and a list of
+              where each is used: the part and its story type (document,
+              header, footer, footnotes, endnotes or comments), paragraph
+              index within the part (counting nested paragraphs, e.g., in
+              table cells, in document order) and paraId, whether it is in
+              a table
+              or text box, the relationship ID and the reference kind
+              ('blip' for DrawingML, 'imagedata' for VML)
+    Features: Audits a whole package in one pass: the main document and
+              each story part related to it are streamed once, along with
+              their relationships, over a single zip handle. Images in
+              table cells and text boxes are included; the VML fallback of
+              a text box is skipped, so its images are not counted twice.
+    Depends:  - find_main_part
+              - _read_rels
+              - _scan_part_images
+    """
+    if isinstance(doc, DocxPackage):
+        doc = doc.zip
+    if not isinstance(doc, ZipFile):
+        with ZipFile(doc, 'r') as my_zip:
+            return find_package_images(my_zip)
+
+    my_images = {}
+    main_part = find_main_part(doc)
+    my_parts = [(main_part, "document")]
+    for rel_type, target, external in _read_rels(doc, main_part).values():
+        story = rel_type.split("/")[-1]
+        if story in STORY_RELS and not external:
+            my_parts.append((target, story))
+
+    names = set(doc.namelist())
+    for part, story in my_parts:
+        if part not in names:
+            continue
+        my_rels = _read_rels(doc, part)
+        for loc in _scan_part_images(doc, part):
+            rel_type, target, external = my_rels.get(
+                loc['relId'], ("", "", False))
+            loc['story'] = story
+            loc['external'] = external
+            my_images.setdefault(target, []).append(loc)
+    return my_images
+
+
+def find_related_part(my_zip, part, rel_type):
+    """
+    Name:     find_related_part
+    Inputs:   - zipfile.ZipFile, an open .docx (my_zip)
+              - str, member name of the source part (part)
+              - str, relationship type, e.g., 'styles' (rel_type)
+    Outputs:  str, member name of the first related part of the given
+              type; None if there is none
+    """
+    head, tail = posixpath.split(part)
+    try:
+        rels = ElementTree.fromstring(
+            my_zip.read(posixpath.join(head, "_rels", tail + ".rels")))
+    except KeyError:
+        return None
+    for rel in rels:
+        if (rel.get("Type", "").split("/")[-1] == rel_type and
+                rel.get("TargetMode") != "External"):
+            target = rel.get("Target")
+            if target.startswith("/"):
+                return target.lstrip("/")
+            return posixpath.normpath(posixpath.join(head, target))
+    return None
+
+
 def find_word_files(d, k=""):
     """
     Name:     find_word_files
@@ -265,24 +1622,152 @@ def find_word_files(d, k=""):
     return sorted(my_files)
 
 
-def list_paragraph_styles(d):
+def get_template_cache():
+    """
+    Name:     get_template_cache
+    Inputs:   None
+    Outputs:  TemplateCache, the process's template cache
+    """
+    if 'cache' not in _TEMPLATES:
+        _TEMPLATES['cache'] = TemplateCache()
+    return _TEMPLATES['cache']
+
+
+def instrument_from_env(*args):
+    """
+    Name:     instrument_from_env
+    Inputs:   None (also called after a fork, with the module)
+    Outputs:  None
+    Features: Enables instrumentation if DOCX_INSTRUMENT is set: '1'
+              prints the JSON report at exit; a file path writes it there
+              (a '.prof' path writes a cProfile dump). Called by each
+              command-line script; nothing is enabled on import. Forked
+              worker processes start afresh and add their process ID to
+              the path.
+    Depends:  - enable_instrumentation
+              - _instrument_exit
+    """
+    my_out = os.environ.get("DOCX_INSTRUMENT", "")
+    if my_out in ("", "0") or (_INSTRUMENT['on'] and not args):
+        # NOTE: a second call in the same process would report twice
+        return
+    my_pid = str(os.getpid())
+    is_worker = os.environ.setdefault("DOCX_INSTRUMENT_PID", my_pid) != my_pid
+    enable_instrumentation(profile=my_out.endswith(".prof"))
+    if is_worker and my_out != "1":
+        root, ext = os.path.splitext(my_out)
+        my_out = "%s.%s%s" % (root, my_pid, ext)
+    elif not is_worker:
+        multiprocessing.util.register_after_fork(
+            sys.modules[__name__], instrument_from_env)
+
+    # NOTE: pool workers skip atexit, but run multiprocessing finalizers
+    multiprocessing.util.Finalize(
+        None, _instrument_exit, args=(my_out,), exitpriority=0)
+
+
+def instrument_report():
+    """
+    Name:     instrument_report
+    Inputs:   None
+    Outputs:  dict, seconds since instrumentation was enabled, stages
+              (calls and inclusive seconds, slowest first) and counters
+    """
+    if _INSTRUMENT['start'] is None:
+        return {'seconds': 0.0, 'stages': {}, 'counters': {}}
+    stages = sorted(_INSTRUMENT['stages'].items(),
+                    key=lambda x: x[1]['seconds'], reverse=True)
+    return {
+        'seconds': time.perf_counter() - _INSTRUMENT['start'],
+        'stages': dict((k, dict(v)) for k, v in stages),
+        'counters': dict(sorted(_INSTRUMENT['counters'].items()))
+    }
+
+
+def iter_paragraphs(path, tables=False):
+    """
+    Name:     iter_paragraphs
+    Inputs:   - str, path to a .docx file; or a DocxPackage (path)
+              - bool, whether to include paragraphs in tables (tables)
+    Outputs:  generator, tuples of paragraph index, paraId (None if
+              missing), style ID and text
+    Features: Streams document.xml without building python-docx objects;
+              style IDs are resolved the same way as paragraph.style (IDs
+              that are not paragraph styles give the default style) and
+              the text is that of paragraph.text. Without tables, the
+              paragraphs are those of Document.paragraphs; with tables,
+              table cell paragraphs (including nested tables) are counted
+              in document order.
+    Depends:  - find_main_part
+              - _paragraph_text
+              - _read_paragraph_styles
+    """
+    with open_docx_zip(path) as my_zip:
+        my_doc = find_main_part(my_zip)
+        style_names, default_id = _read_paragraph_styles(my_zip, my_doc)
+        with my_zip.open(my_doc) as f:
+            i = 0
+            tags = []
+            body = None
+            for event, elem in ElementTree.iterparse(f, ('start', 'end')):
+                if event == 'start':
+                    tags.append(elem.tag)
+                    if elem.tag == W_BODY and len(tags) == 2:
+                        body = elem
+                    continue
+                tags.pop()
+                if elem.tag == W_P and len(tags) > 1 and tags[1] == W_BODY:
+                    if len(tags) == 2 or (tables and all(
+                            t in W_TABLE_TAGS for t in tags[2:])):
+                        style_id = None
+                        ppr = elem.find(W_PPR)
+                        if ppr is not None:
+                            pstyle = ppr.find(W_PSTYLE)
+                            if pstyle is not None:
+                                style_id = pstyle.get(W_VAL)
+                        if style_id not in style_names:
+                            style_id = default_id
+                        yield (i, elem.get(W14_PARA_ID), style_id,
+                               _paragraph_text(elem))
+                        i += 1
+                if len(tags) == 2 and body is not None:
+                    # Done with this body element
+                    body.remove(elem)
+
+
+def list_paragraph_styles(d, cache=None):
     """
     Name:     list_paragraph_styles
-    Inputs:   docx.document.Document, open word document
+    Inputs:   - docx.document.Document, open word document, or str, path to
+                a .docx file, or a DocxPackage (d)
+              - AnalysisCache, where to keep the result of a file (cache)
     Output:   dict, style_id (keys) with name and counts (keys) found
-    Features: Returns a list of all the paragraph styles found in given doc
+    Features: Returns a list of all the paragraph styles found in given doc;
+              given a path, the document is streamed (see iter_paragraphs),
+              or its result taken from the cache if given
+    Depends:  - iter_paragraphs
+              - ParagraphIndex
     """
+    if not isinstance(d, (str, DocxPackage)):
+        return ParagraphIndex(d).histogram()
+    if cache is not None:
+        my_path = d.path if isinstance(d, DocxPackage) else d
+        return cache.get_or_compute(
+            my_path, "list_paragraph_styles",
+            lambda p: list_paragraph_styles(d))
+
+    with open_docx_zip(d) as my_zip:
+        style_names = _read_paragraph_styles(
+            my_zip, find_main_part(my_zip))[0]
     style_dict = {}
-    para_num = len(d.paragraphs)
-    for i in range(para_num):
-        para = d.paragraphs[i]
-        if para.style.style_id not in style_dict:
-            style_dict[para.style.style_id] = {
-                'name': para.style.name,
+    for i, para_id, style_id, text in iter_paragraphs(d):
+        if style_id in style_dict:
+            style_dict[style_id]['count'] += 1
+        else:
+            style_dict[style_id] = {
+                'name': style_names.get(style_id),
                 'count': 1
             }
-        else:
-            style_dict[para.style.style_id]['count'] += 1
     return style_dict
 
 
@@ -296,24 +1781,47 @@ def match_char_style(a, b):
               - bold, italic, underline
               - all_caps, small_caps, strike, double_strike, outline,
               - superscript, subscript
-    TODO:     - does not handle color, highlight color, or size
+              - color, highlight color and size
+              When the new run has no direct formatting other than its
+              character style, the original run properties (w:rPr) are
+              copied wholesale instead.
+    Depends:  _font_properties
 
     References:
     - https://python-docx.readthedocs.io/en/latest/api/text.html#font-objects
     """
-    # Second pass, go into the font styles
-    # grab all settable properties from font class,
-    # extract the value (allow AttributeError to pass)
-    # use execute to set a's parameter value to b
-    properties = [i for i in dir(a.font) if not i.startswith("_")]
-    for p in properties:
-        try:
-            v = eval("a.font.{}".format(p))
-        except AttributeError:
-            pass
-        else:
-            if isinstance(v, bool):
-                exec("b.font.{} = {}".format(p, v))
+    a_rpr = a._r.rPr
+    if a_rpr is None:
+        return
+
+    b_rpr = b._r.rPr
+    if b_rpr is None or all(c.tag == W_RSTYLE for c in b_rpr):
+        # Copy the run properties whole, keeping b's character style
+        new_rpr = copy.deepcopy(a_rpr)
+        for c in new_rpr.findall(W_RSTYLE):
+            new_rpr.remove(c)
+        if b_rpr is not None:
+            for c in b_rpr.findall(W_RSTYLE):
+                new_rpr.insert(0, c)
+            b._r.remove(b_rpr)
+        b._r.insert(0, new_rpr)
+        return
+
+    a_font = a.font
+    b_font = b.font
+    for p in _font_properties(type(a_font)):
+        v = getattr(a_font, p)
+        if v is not None:
+            setattr(b_font, p, v)
+    if a_font.color.type is not None:
+        if a_font.color.rgb is not None:
+            b_font.color.rgb = a_font.color.rgb
+        if a_font.color.theme_color is not None:
+            b_font.color.theme_color = a_font.color.theme_color
+    if a_font.highlight_color is not None:
+        b_font.highlight_color = a_font.highlight_color
+    if a_font.size is not None:
+        b_font.size = a_font.size
 
 
 def match_sect_properties(a, b):
@@ -334,3 +1842,395 @@ def match_sect_properties(a, b):
     b.top_margin = a.top_margin
     b.right_margin = a.right_margin
     b.bottom_margin = a.bottom_margin
+
+
+def open_document(doc=None):
+    """
+    Name:     open_document
+    Inputs:   str, path to a .docx; or a DocxPackage; or None for the
+              python-docx default template (doc)
+    Outputs:  docx.document.Document
+    Features: Opens a python-docx Document, reading a DocxPackage from its
+              memory map
+    """
+    import docx
+    if isinstance(doc, DocxPackage):
+        return docx.Document(doc.fileobj())
+    return docx.Document(doc)
+
+
+def open_docx_zip(doc):
+    """
+    Name:     open_docx_zip
+    Inputs:   str, path to a .docx; or a DocxPackage (doc)
+    Outputs:  context manager giving a zipfile.ZipFile of the package
+    Features: Opens a path as a new ZipFile, closed on exit; a DocxPackage
+              gives its own ZipFile, which is left open
+    """
+    if isinstance(doc, DocxPackage):
+        return nullcontext(doc.zip)
+    return ZipFile(doc, 'r')
+
+
+def stage(name):
+    """
+    Name:     stage
+    Inputs:   str, stage name (name)
+    Outputs:  context manager timing its block as the named stage
+    """
+    if _INSTRUMENT['on']:
+        return _timed_block(name)
+    return nullcontext()
+
+
+def timed(name):
+    """
+    Name:     timed
+    Inputs:   str, stage name (name)
+    Outputs:  function decorator
+    Features: Times each call of the decorated function as the named stage
+              while instrumentation is enabled; otherwise the only cost is
+              one dictionary lookup per call
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _INSTRUMENT['on']:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _add_stage(name, time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
+
+def write_instrument_report(path):
+    """
+    Name:     write_instrument_report
+    Inputs:   str, output path; '.prof' for a cProfile dump (path)
+    Outputs:  None
+    Features: Writes the per-stage breakdown as JSON, or the profile
+              statistics (readable with pstats or snakeviz)
+    Depends:  instrument_report
+    """
+    if path.endswith(".prof"):
+        if _INSTRUMENT['profile'] is None:
+            raise ValueError("Profiling was not enabled")
+        _INSTRUMENT['profile'].disable()
+        _INSTRUMENT['profile'].dump_stats(path)
+    else:
+        with open(path, 'w') as f:
+            json.dump(instrument_report(), f, indent=2)
+
+
+def _add_stage(name, seconds):
+    """
+    Name:     _add_stage
+    Inputs:   - str, stage name (name)
+              - float, time spent (seconds)
+    Outputs:  None
+    """
+    stages = _INSTRUMENT['stages']
+    if name not in stages:
+        stages[name] = {'calls': 0, 'seconds': 0.0}
+    stages[name]['calls'] += 1
+    stages[name]['seconds'] += seconds
+
+
+def _clone_document(doc):
+    """
+    Name:     _clone_document
+    Inputs:   docx.document.Document, a parsed document (doc)
+    Outputs:  docx.document.Document, a copy in a new package
+    Features: Deep-copies the XML of each XML part (no re-parsing) and
+              shares the binary parts, which are never changed in place;
+              relationships are rebuilt with the same IDs
+    """
+    from docx.opc.part import XmlPart
+
+    old_pkg = doc.part.package
+    new_pkg = type(old_pkg)()
+    clones = {}
+    for part in old_pkg.iter_parts():
+        if isinstance(part, XmlPart):
+            clones[part] = type(part)(part.partname, part.content_type,
+                                      copy.deepcopy(part.element), new_pkg)
+
+    my_rels = [(old_pkg, new_pkg)] + list(clones.items())
+    for src, dst in my_rels:
+        for rel in src.rels.values():
+            if rel.is_external:
+                target = rel.target_ref
+            else:
+                target = clones.get(rel.target_part, rel.target_part)
+            dst.rels.add_relationship(
+                rel.reltype, target, rel.rId, rel.is_external)
+
+    # Index the shared images, as opening the package would
+    new_pkg.after_unmarshal()
+    return clones[doc.part].document
+
+
+def _instrument_exit(out):
+    """
+    Name:     _instrument_exit
+    Inputs:   str, DOCX_INSTRUMENT output path, or '1' (out)
+    Outputs:  None
+    Features: Writes the report when the process exits; '1' prints the
+              JSON report to standard error
+    Depends:  - instrument_report
+              - write_instrument_report
+    """
+    if out == "1":
+        print(json.dumps(instrument_report(), indent=2), file=sys.stderr)
+    else:
+        write_instrument_report(out)
+
+
+def _paragraph_text(p):
+    """
+    Name:     _paragraph_text
+    Inputs:   xml.etree.ElementTree.Element, a w:p element (p)
+    Outputs:  str, the paragraph's text, same as python-docx paragraph.text
+              (runs directly in the paragraph or in its hyperlinks)
+    """
+    my_text = []
+    for child in p:
+        if child.tag == W_R:
+            runs = (child,)
+        elif child.tag == W_HYPERLINK:
+            runs = child.findall(W_R)
+        else:
+            continue
+        for r in runs:
+            for e in r:
+                if e.tag == W_T:
+                    my_text.append(e.text or "")
+                elif e.tag == W_BR:
+                    if e.get(W_TYPE, "textWrapping") == "textWrapping":
+                        my_text.append("\n")
+                elif e.tag in W_RUN_TEXT:
+                    my_text.append(W_RUN_TEXT[e.tag])
+    return "".join(my_text)
+
+
+def _patch_docx():
+    """
+    Name:     _patch_docx
+    Inputs:   None
+    Outputs:  None
+    Features: Times docx.Document (opening and building the package) and
+              Document.save, and counts the bytes saved to a path, until
+              disable_instrumentation puts them back
+    """
+    import docx
+    import docx.document
+
+    my_open = docx.Document
+    my_save = docx.document.Document.save
+
+    def document(*args, **kwargs):
+        with _timed_block("docx.Document"):
+            return my_open(*args, **kwargs)
+
+    def save(self, path_or_stream):
+        with _timed_block("Document.save"):
+            my_save(self, path_or_stream)
+        if isinstance(path_or_stream, str):
+            add_count("bytes saved", os.path.getsize(path_or_stream))
+
+    _INSTRUMENT['patched'][(docx, "Document")] = my_open
+    _INSTRUMENT['patched'][(docx.document.Document, "save")] = my_save
+    docx.Document = document
+    docx.document.Document.save = save
+
+
+def _read_rels(my_zip, part):
+    """
+    Name:     _read_rels
+    Inputs:   - zipfile.ZipFile, an open .docx (my_zip)
+              - str, member name of the source part (part)
+    Outputs:  dict, relationship IDs and tuples of their type, target
+              (a member name, unless external) and whether it is external
+    """
+    head, tail = posixpath.split(part)
+    my_name = posixpath.join(head, "_rels", tail + ".rels")
+    try:
+        my_data = my_zip.read(my_name)
+    except KeyError:
+        return {}
+    add_count("zip.read:" + my_name, len(my_data))
+
+    my_rels = {}
+    for rel in ElementTree.fromstring(my_data):
+        target = rel.get("Target", "")
+        external = rel.get("TargetMode") == "External"
+        if not external:
+            if target.startswith("/"):
+                target = target.lstrip("/")
+            else:
+                target = posixpath.normpath(posixpath.join(head, target))
+        my_rels[rel.get("Id")] = (rel.get("Type", ""), target, external)
+    return my_rels
+
+
+def _read_paragraph_styles(my_zip, part):
+    """
+    Name:     _read_paragraph_styles
+    Inputs:   - zipfile.ZipFile, an open .docx (my_zip)
+              - str, member name of the main document part (part)
+    Outputs:  tuple, dict of paragraph style ID to style name and the ID
+              of the default paragraph style (None if there is none)
+    Features: Reads the styles part the way python-docx looks styles up:
+              the first style with an ID decides its type, a missing type
+              means a paragraph style, and the last paragraph style marked
+              default is the default; the name of the default style may be
+              missing if its ID is taken by an earlier style
+    """
+    # NOTE: python-docx shows built-in styles by their UI names
+    from docx.styles import BabelFish
+
+    style_names = {}
+    default_id = None
+    my_styles = find_related_part(my_zip, part, "styles")
+    if my_styles is None:
+        return (style_names, default_id)
+    seen = set()
+    for s in ElementTree.fromstring(my_zip.read(my_styles)).iter(W_STYLE):
+        if s.get(W_TYPE, "paragraph") != "paragraph":
+            seen.add(s.get(W_STYLE_ID))
+            continue
+        style_id = s.get(W_STYLE_ID)
+        if s.get(W_DEFAULT) in ("1", "true", "on"):
+            default_id = style_id
+        if style_id in seen or not style_id:
+            continue
+        seen.add(style_id)
+        name = s.find(W_NAME)
+        if name is not None and name.get(W_VAL) is not None:
+            style_names[style_id] = BabelFish.internal2ui(name.get(W_VAL))
+        else:
+            style_names[style_id] = None
+    return (style_names, default_id)
+
+
+def _scan_part_images(my_zip, part):
+    """
+    Name:     _scan_part_images
+    Inputs:   - zipfile.ZipFile, an open .docx (my_zip)
+              - str, member name of a story part (part)
+    Outputs:  generator, dict records of each image reference in the part
+              (see find_package_images), without the story type
+    Features: Streams the part with iterparse, keeping track of the
+              enclosing paragraph, tables and text boxes; elements are
+              cleared once read
+    """
+    para = -1          # index of the current paragraph
+    para_ids = []      # paraIds of the open (possibly nested) paragraphs
+    tables = 0         # number of open tables
+    boxes = 0          # number of open text boxes
+    fallback = 0       # number of open mc:Fallback elements
+    num_bytes = my_zip.getinfo(part).file_size
+    with my_zip.open(part) as f:
+        for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == MC_FALLBACK:
+                    fallback += 1
+                elif fallback:
+                    continue
+                elif tag == W_P:
+                    para += 1
+                    para_ids.append(elem.get(W14_PARA_ID, ""))
+                elif tag == W_TBL:
+                    tables += 1
+                elif tag == W_TXBX:
+                    boxes += 1
+                elif tag == A_BLIP or tag == V_IMAGEDATA:
+                    if tag == A_BLIP:
+                        my_ids = (elem.get(R_EMBED), elem.get(R_LINK))
+                    else:
+                        my_ids = (elem.get(R_ID),)
+                    for rel_id in my_ids:
+                        if rel_id:
+                            yield {
+                                'part': part,
+                                'para': para,
+                                'paraId': para_ids[-1] if para_ids else "",
+                                'table': tables > 0,
+                                'textbox': boxes > 0,
+                                'relId': rel_id,
+                                'kind': (
+                                    "blip" if tag == A_BLIP else "imagedata")
+                            }
+            else:
+                if tag == MC_FALLBACK:
+                    fallback -= 1
+                elif fallback:
+                    pass
+                elif tag == W_P:
+                    para_ids.pop()
+                elif tag == W_TBL:
+                    tables -= 1
+                elif tag == W_TXBX:
+                    boxes -= 1
+                elem.clear()
+    add_count("zip.read:" + part, num_bytes)
+
+
+@contextmanager
+def _timed_block(name):
+    """
+    Name:     _timed_block
+    Inputs:   str, stage name (name)
+    Outputs:  context manager adding its run time to the named stage
+    Depends:  _add_stage
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_stage(name, time.perf_counter() - t0)
+
+
+
+def package_digest(path):
+    """
+    Name:     package_digest
+    Inputs:   str, path to a .docx file (path)
+    Outputs:  str, SHA-256 hex digest
+    Features: Hashes the content of the main document part, plus the name,
+              CRC and size of every other member (from the zip directory,
+              without decompressing them), so that edits to styles,
+              relationships or media change the digest too
+    Depends:  find_main_part
+    """
+    my_hash = hashlib.sha256()
+    with open_docx_zip(path) as my_zip:
+        my_doc = find_main_part(my_zip)
+        with my_zip.open(my_doc) as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+                my_hash.update(chunk)
+        for info in sorted(my_zip.infolist(), key=lambda x: x.filename):
+            if info.filename != my_doc:
+                my_hash.update("\0{}\0{}\0{}".format(
+                    info.filename, info.CRC, info.file_size).encode("utf-8"))
+    return my_hash.hexdigest()
+
+
+def _font_properties(font_cls):
+    """
+    Name:     _font_properties
+    Inputs:   type, python-docx font class (font_cls)
+    Outputs:  tuple, names of the font's on/off (tri-state) properties
+    Features: Lists the settable font properties once per process; color,
+              highlight color, name and size are not on/off properties
+    """
+    if font_cls not in _FONT_PROPS:
+        _FONT_PROPS[font_cls] = tuple(
+            k for k, v in vars(font_cls).items()
+            if isinstance(v, property) and v.fset is not None
+            and k not in ('color', 'highlight_color', 'name', 'size'))
+    return _FONT_PROPS[font_cls]
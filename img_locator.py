@@ -8,213 +8,36 @@
 # associated paragraphs that contain an image and the related image path
 # within the .docx (e.g., /media/image1.png)
 #
-#
-# TODO: create a "get_image" function that unzips an image from the .docx
-#       and puts it in the temporary directory, and returns the path to the
-#       extracted image; to be used in Python's docx run.add_picture()
-#
 ##############################################################################
 # IMPORT NECESSARY MODULES
 ##############################################################################
+import argparse
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+import csv
+import json
+import multiprocessing.util
 import os
 import re
-from zipfile import ZipFile
-import xml.etree.ElementTree as ElementTree
+import sys
+import tempfile
+
+from docx_utils import AnalysisCache
+from docx_utils import DocxPics
+from docx_utils import find_package_images
+from docx_utils import DocxPackage
+from docx_utils import find_word_files
+from docx_utils import instrument_from_env
+from docx_utils import LazyDocxPics
+from docx_utils import open_docx_zip
 
 
 ##############################################################################
-# CLASSES
+# GLOBAL VARIABLES
 ##############################################################################
-class DocxPics(object):
-    """
-    Name:     DocxPics
-    Features: Class for organizing references to images found within a .docx
-    History:  Version 1
-    """
-    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
-    # Class Initialization
-    # ////////////////////////////////////////////////////////////////////////
-    def __init__(self, doc_path):
-        """
-        Name:     DocxPics.__init__
-        Inputs:   str, path to a docx document
-        Features: Initializes the DocxPics class
-        """
-        # Initialize the class parameters
-        self.num_paras = 0     # number of paragraphs in .docx
-        self.num_images = 0    # number of images in .docx
-        self.paralist = []     # list of paragraph indices containing an image
-        self.paraIdList = []   # the paraIds associated with paragraphs above
-        self.paras = {}        # dictionary containing paragraph information
-        self.xml = None        # documant.xml as string
-        self.xmlet = None      # ElementTree of document.xml
-        self.rel = None        # document.xml.rel as string
-        self.relet = None      # ElementTree of document.xml.rel
-        self.namespace = {}    # namespace dictionary
-        self.imagemap = {}     # map between relationship IDs and image paths
-        self.imID = None       # temporary image ID
-
-        # Check that input document is valid
-        if os.path.isfile(doc_path):
-            self.docx = doc_path
-            self.open_docxml()
-            self.get_docx_namespace()
-            self.find_images()
-        else:
-            self.docx = None
-            raise OSError("File %s does not exist!" % (doc_path))
-
-    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
-    # Class Function Definitions
-    # ////////////////////////////////////////////////////////////////////////
-    def find_images(self):
-        """
-        Name:     DocxPics.count_paragraphs
-        Inputs:   None
-        Outputs:  None
-        Features: Finds and counts paragraphs, runs, and images in .docx
-        Depends:  - map_images
-                  - search_for_attr
-        """
-        self.map_images()
-        self.paralist = []
-        self.paraIdList = []
-        self.paras = {}
-        self.num_images = 0
-        if self.xmlet:
-            my_paras = self.xmlet[0].findall("w:p", self.namespace)
-            self.num_paras = len(my_paras)
-            for i in range(self.num_paras):
-                para = my_paras[i]
-                # Get paragraph ID:
-                para_id = ''
-                for k, v in para.attrib.items():
-                    if 'paraId' in k:
-                        para_id = v
-
-                # Find all runs in paragraph
-                runs = para.findall("w:r", self.namespace)
-                num_runs = len(runs)
-                for j in range(num_runs):
-                    run = runs[j]
-                    draws = run.findall("w:drawing", self.namespace)
-                    num_draws = len(draws)
-                    self.num_images += num_draws
-                    if num_draws > 0:
-                        self.paralist.append(i)
-                        self.paraIdList.append(para_id)
-                        for draw in draws:
-                            self.imID = None
-                            self.search_for_attr(draw, 'embed')
-                            draw_path = ""
-                            if self.imID in self.imagemap.keys():
-                                draw_path = self.imagemap[self.imID]
-                            if i in self.paras.keys():
-                                self.paras[i]['num_images'] += 1
-                                self.paras[i]['runs'][j] = {
-                                    'imgID': str(self.imID),
-                                    "imgPath": draw_path
-                                }
-                            else:
-                                self.paras[i] = {
-                                    'paraId': para_id,
-                                    'num_run': num_runs,
-                                    'num_images': 1,
-                                    'runs': {
-                                        j: {
-                                            'imgID': str(self.imID),
-                                            'imgPath': draw_path
-                                        }
-                                    }
-                                }
-
-    def get_docx_namespace(self):
-        """
-        Name:     DocxPics.get_docx_namespace
-        Inputs:   None
-        Returns:  None
-        Features: Creates a dictionary of namespaces from an .docx XML
-        """
-        if self.xml:
-            self.namespace = {}
-            my_ns = re.findall(r'xmlns:(\S+)="(\S+)"', self.xml)
-            for ns in my_ns:
-                k, v = ns
-                self.namespace[k] = v
-
-    def map_images(self):
-        """
-        Name:     DocxPics.map_images
-        Inputs:   None
-        Outputs:  None
-        Features: Maps image relationship IDs to their paths within .docx
-        Depends:  re
-        """
-        self.imagemap = {}
-        if self.xml:
-            my_blips = re.findall('a:blip r:embed="(\S+)"', self.xml)
-            for my_rel in self.relet:
-                is_img = False
-                img_id = ""
-                img_path = ""
-                for k, v in my_rel.attrib.items():
-                    if k == "Id" and v in my_blips:
-                        is_img = True
-                        img_id = v
-                if is_img:
-                    img_path = my_rel.attrib['Target']
-                    self.imagemap[img_id] = img_path
-
-    def open_docxml(self):
-        """
-        Name:     DocxPics.open_docxml
-        Inputs:   None
-        Returns:  None
-        Features: Reads the XML from document.xml within a .docx and creates
-                  ElementTree objects from string
-        Depends:  - ElementTree
-                  - zipfile.ZipFile
-        """
-        self.xml = ""
-        self.rel = ""
-        if self.docx:
-            my_doc = ""
-            my_rel = ""
-            my_zip = ZipFile(self.docx, 'r')
-            for zc in my_zip.namelist():
-                if "document.xml" in zc and zc.endswith('rels'):
-                    my_rel = zc
-                if "document.xml" in zc and not zc.endswith('rels'):
-                    my_doc = zc
-
-            if my_doc != "":
-                with my_zip.open(my_doc) as f:
-                    for d in f:
-                        self.xml = "".join([self.xml, d.decode("utf-8")])
-                self.xmlet = ElementTree.fromstring(self.xml)
-
-            if my_rel != "":
-                with my_zip.open(my_rel) as f:
-                    for d in f:
-                        self.rel = "".join([self.rel, d.decode("utf-8")])
-                self.relet = ElementTree.fromstring(self.rel)
-
-    def search_for_attr(self, my_et, my_attr, is_found=False):
-        """
-        Name:     DocxPics.search_for_attr
-        Inputs:   - xml.etree.ElementTree.Element
-                  - str, attribute name (my_attr)
-                  - bool, if attribute has been found
-        Outputs:  str, value of the search attribute
-        Features: Recursive search of ET until element is found with attribute
-        """
-        if not is_found:
-            for child in my_et:
-                for k, v in child.attrib.items():
-                    if my_attr in k:
-                        is_found = True
-                        self.imID = v
-                self.search_for_attr(child, my_attr, is_found)
+# Per-process analysis cache of the batch workers (see _init_worker)
+_CACHE = {}
 
 
 ##############################################################################
@@ -237,53 +60,296 @@ def get_docx_namespace(doc_path):
     return ns_dict
 
 
+def get_image(doc_path, img, out_dir=None):
+    """
+    Name:     get_image
+    Inputs:   - str, path to a .docx file (doc_path)
+              - str, image relationship ID or path, e.g., media/image1.png
+              - str, directory to extract to; default is a new temporary
+                directory (out_dir)
+    Returns:  str, path to the extracted image (e.g., for run.add_picture)
+    Features: Streams a single image out of a .docx
+    Depends:  DocxPics
+    """
+    if out_dir is None:
+        out_dir = tempfile.mkdtemp()
+    with DocxPics(doc_path, stream=True) as dp:
+        out_path = os.path.join(out_dir, os.path.basename(dp.find_media(img)))
+        dp.extract_image(img, out_path)
+    return out_path
+
+
+def locate_images(doc_path, quick=False, all_parts=False, cache=None):
+    """
+    Name:     locate_images
+    Inputs:   - str, path to a .docx file; or a DocxPackage (doc_path)
+              - bool, whether to only check for images (quick)
+              - bool, whether to search headers, footers, notes and
+                comments as well as the document body (all_parts)
+              - AnalysisCache, where to keep the results of a file (cache)
+    Returns:  dict, the file's path, paragraph and image counts, paragraph
+              image information and image map; or its path and an error
+              message if the file could not be read. A quick check returns
+              the path, whether it has images and the image map; a search
+              of all parts returns the path and each image's locations.
+    Features: Runs a streaming DocxPics analysis of one file, or takes its
+              result from the cache if given; a quick check reads only the
+              document's relationships (see LazyDocxPics)
+    Depends:  _locate
+    """
+    try:
+        if cache is None:
+            my_result = _locate(doc_path, quick, all_parts)
+        else:
+            my_mode = "all_parts" if all_parts else (
+                "quick" if quick else "images")
+            my_path = doc_path
+            if isinstance(doc_path, DocxPackage):
+                my_path = doc_path.path
+            my_result = cache.get_or_compute(
+                my_path, "img_locator." + my_mode,
+                lambda p: _locate(doc_path, quick, all_parts))
+    except Exception as e:
+        # NOTE: a damaged package can fail in many ways (BadZipFile,
+        #       zlib.error, EOFError, ParseError, ...); none stops the run
+        return {'file': doc_path, 'error': str(e) or type(e).__name__}
+
+    # Cached results are stored without the file name
+    my_images = {'file': doc_path}
+    my_images.update(my_result)
+    return my_images
+
+
+def locate_images_batch(paths, workers=1, quick=False, all_parts=False,
+                        cache_path=None):
+    """
+    Name:     locate_images_batch
+    Inputs:   - list, paths to .docx files (paths)
+              - int, number of worker processes (workers)
+              - bool, whether to only check for images (quick)
+              - bool, whether to search all story parts (all_parts)
+              - str, SQLite file for caching results between runs
+                (cache_path)
+    Returns:  generator, locate_images results in order of completion
+    Features: Fans DocxPics analysis out across a process pool, keeping a
+              bounded number of files in flight; unreadable files are
+              reported with an error rather than stopping the run
+    Depends:  - _init_worker
+              - _locate_job
+    """
+    if workers <= 1:
+        _init_worker(cache_path)
+        try:
+            for my_path in paths:
+                yield _locate_job(my_path, quick, all_parts)
+        finally:
+            if cache_path:
+                _CACHE.pop('cache').close()
+        return
+
+    max_pending = 4 * workers
+    my_paths = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(cache_path,)) as pool:
+        pending = set()
+        for my_path in my_paths:
+            pending.add(pool.submit(
+                _locate_job, my_path, quick, all_parts))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for job in done:
+                    yield job.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for job in done:
+                yield job.result()
+
+
 def open_docxml(doc_path, isrel=False):
     """
     Name:     open_docxml
-    Inputs:   - str, path to a valid .docx file
+    Inputs:   - str, path to a valid .docx file; or a DocxPackage
               - bool, whether to search for the document.xml.rel
     Returns:  str, XML of the file's contents
     Features: Returns the XML from the document.xml within a .docx as a string
     """
     my_doc = ""
     my_xml = ""
-    my_zip = None
-    if os.path.isfile(doc_path):
-        my_zip = ZipFile(doc_path, 'r')
-        for zc in my_zip.namelist():
-            if isrel:
-                if "document.xml" in zc and zc.endswith('rels'):
-                    my_doc = zc
-            else:
-                if "document.xml" in zc and not zc.endswith('rels'):
-                    my_doc = zc
-    if my_doc != "" and my_zip:
-        with my_zip.open(my_doc) as f:
-            for d in f:
-                my_xml = "".join([my_xml, d.decode("utf-8")])
+    if isinstance(doc_path, DocxPackage) or os.path.isfile(doc_path):
+        with open_docx_zip(doc_path) as my_zip:
+            for zc in my_zip.namelist():
+                if isrel:
+                    if "document.xml" in zc and zc.endswith('rels'):
+                        my_doc = zc
+                else:
+                    if "document.xml" in zc and not zc.endswith('rels'):
+                        my_doc = zc
+            if my_doc != "":
+                my_xml = my_zip.read(my_doc).decode("utf-8")
     return my_xml
 
 
-def search_for_attr(my_et, my_attr, is_found=False):
+def search_for_attr(my_et, my_attr):
+    """
+    Features: Search of ET until an element is found with attribute; prints
+              and returns the first value found
+    """
+    for child in my_et.iter():
+        if child is my_et:
+            continue
+        for k, v in child.attrib.items():
+            if my_attr in k:
+                print(v)
+                return v
+    return None
+
+
+def write_image_report(results, f, fmt="jsonl"):
     """
-    Features: Recursive search of ET until element is found with attribute
+    Name:     write_image_report
+    Inputs:   - iterable, locate_images results (results)
+              - file object, open text file for the report (f)
+              - str, report format, 'jsonl' or 'csv' (fmt)
+    Returns:  tuple, number of files reported and number of failures
+    Features: Writes each result as it arrives; JSON Lines gets one object
+              per file, CSV gets one row per image (or per failed file);
+              the part column is only filled for searches of all parts
     """
-    if not is_found:
-        for child in my_et:
-            for k, v in child.attrib.items():
-                if my_attr in k:
-                    is_found = True
-                    print(v)
-            search_for_attr(child, my_attr, is_found)
+    num_files = 0
+    num_errors = 0
+    if fmt == "csv":
+        writer = csv.writer(f)
+        writer.writerow(
+            ['file', 'para', 'paraId', 'run', 'imgID', 'imgPath', 'error',
+             'part'])
+    for res in results:
+        num_files += 1
+        if 'error' in res:
+            num_errors += 1
+        if fmt == "csv":
+            if 'error' in res:
+                writer.writerow([res['file'], '', '', '', '', '',
+                                 res['error'], ''])
+            for i in sorted(res.get('paras', {}).keys()):
+                para = res['paras'][i]
+                for j in sorted(para['runs'].keys()):
+                    run = para['runs'][j]
+                    writer.writerow([res['file'], i, para['paraId'], j,
+                                     run['imgID'], run['imgPath'], '', ''])
+            for img_path in sorted(res.get('images', {}).keys()):
+                for loc in res['images'][img_path]:
+                    writer.writerow([res['file'], loc['para'], loc['paraId'],
+                                     '', loc['relId'], img_path, '',
+                                     loc['part']])
+        else:
+            f.write(json.dumps(res, sort_keys=True))
+            f.write("\n")
+        f.flush()
+    return (num_files, num_errors)
 
 
+
+def _init_worker(cache_path):
+    """
+    Name:     _init_worker
+    Inputs:   str, SQLite file for caching results, if any (cache_path)
+    Outputs:  None
+    Features: Opens the worker's analysis cache; it is closed, writing its
+              access times, when the worker exits
+    """
+    if cache_path:
+        _CACHE['cache'] = AnalysisCache(cache_path)
+        # NOTE: pool workers skip atexit, but run multiprocessing finalizers
+        multiprocessing.util.Finalize(
+            None, _CACHE['cache'].close, exitpriority=0)
+
+
+def _locate(doc_path, quick, all_parts):
+    """
+    Name:     _locate
+    Inputs:   - str, path to a .docx file; or a DocxPackage (doc_path)
+              - bool, whether to only check for images (quick)
+              - bool, whether to search all story parts (all_parts)
+    Returns:  dict, the locate_images result, without the file's path
+    Depends:  - DocxPics
+              - find_package_images
+              - LazyDocxPics
+    """
+    if all_parts:
+        return {'images': find_package_images(doc_path)}
+    if quick:
+        with LazyDocxPics(doc_path) as dp:
+            return {
+                'has_images': dp.has_images(),
+                'imagemap': dp.imagemap
+            }
+    with DocxPics(doc_path, stream=True) as dp:
+        return {
+            'num_paras': dp.num_paras,
+            'num_images': dp.num_images,
+            'paras': dp.paras,
+            'imagemap': dp.imagemap
+        }
+
+
+def _locate_job(doc_path, quick, all_parts):
+    """
+    Name:     _locate_job
+    Inputs:   - str, path to a .docx file (doc_path)
+              - bool, whether to only check for images (quick)
+              - bool, whether to search all story parts (all_parts)
+    Returns:  dict, the locate_images result, using the worker's cache
+    Depends:  locate_images
+    """
+    return locate_images(doc_path, quick, all_parts, _CACHE.get('cache'))
+
 ##############################################################################
 # MAIN
 ##############################################################################
 if __name__ == '__main__':
-    import json
-    docx_file = "example-2.docx"
-    docx_path = os.path.join("examples", docx_file)
-    dp = DocxPics(docx_path)
-    #print(json.dumps(dp.paras, sort_keys=True, indent=2))
-    print(json.dumps(dp.imagemap, indent=2))
+    # User inputs (defaults may be overridden on the command line):
+    p = argparse.ArgumentParser(
+        description="Locates the images in one or more .docx files")
+    p.add_argument("files", nargs="*", help=".docx files to search")
+    p.add_argument("-d", "--dir", default="examples",
+                   help="where to look for input documents")
+    p.add_argument("-k", "--key", default="example-2",
+                   help="keyword for finding input documents")
+    p.add_argument("-w", "--workers", type=int, default=1,
+                   help="number of worker processes")
+    p.add_argument("-o", "--out", default=None,
+                   help="report file (.csv or .jsonl); default is stdout")
+    p.add_argument("-f", "--format", choices=["jsonl", "csv"], default=None,
+                   help="report format; default is from the file extension")
+    p.add_argument("-q", "--quick", action="store_true",
+                   help="only check whether each file has images")
+    p.add_argument("-a", "--all-parts", action="store_true",
+                   help="also search headers, footers, notes and comments")
+    p.add_argument("-c", "--cache", default=None,
+                   help="SQLite file for caching results between runs")
+    args = p.parse_args()
+    instrument_from_env()
+
+    my_files = args.files
+    if not my_files:
+        my_files = find_word_files(args.dir, args.key)
+
+    my_fmt = args.format
+    if my_fmt is None:
+        if args.out and args.out.lower().endswith(".csv"):
+            my_fmt = "csv"
+        else:
+            my_fmt = "jsonl"
+
+    my_results = locate_images_batch(
+        my_files, args.workers, args.quick, args.all_parts, args.cache)
+    if args.out:
+        with open(args.out, 'w', newline='') as my_out:
+            num_files, num_errors = write_image_report(
+                my_results, my_out, my_fmt)
+    else:
+        num_files, num_errors = write_image_report(
+            my_results, sys.stdout, my_fmt)
+    print("Searched {} files; {} could not be read.".format(
+        num_files, num_errors), file=sys.stderr)
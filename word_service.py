@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+#
+# word_service.py
+#
+# Tyler W. Davis
+#
+# Runs the docx tools as a long-running local service. A pool of worker
+# processes is started once, each with python-docx imported, the template
+# parsed and the style definitions compiled, so that a request only pays
+# for its own document. Requests are JSON posted over HTTP on localhost
+# (or a Unix socket), e.g.:
+#
+#   curl -d '{"file": "examples/example-2.docx"}' localhost:8765/images
+#
+# Endpoints (POST): /split, /merge, /restyle and /images (see _run_job);
+# GET /health reports the pool and queue. Paths, in requests and replies,
+# are relative to the service's root directory (by default, the one it was
+# started in), and requests for paths outside it are refused. When the queue is full,
+# requests are turned away with 503 so that callers can back off and retry.
+#
+##############################################################################
+# IMPORT NECESSARY MODULES
+##############################################################################
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import functools
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import os
+from socketserver import ThreadingMixIn
+from socketserver import UnixStreamServer
+import stat
+import threading
+import time
+
+from docx.enum.section import WD_SECTION
+
+from docx_merger import incremental_merge_files
+from docx_merger import merge_files
+from docx_merger import stream_merge_files
+from docx_parser import split_document
+from docx_restyler import get_registry
+from docx_restyler import restyle_file
+from docx_utils import get_template_cache
+from docx_utils import instrument_from_env
+from img_locator import locate_images
+
+
+##############################################################################
+# GLOBAL VARIABLES
+##############################################################################
+TEMPLATE = os.path.join("templates", "template-1.docx")
+STYLES = "styles"
+
+# Request parameters that are paths, resolved within the service's root
+PATHS = ('file', 'files', 'out', 'out_dir', 'template')
+
+# Request parameters each job needs (see _run_job)
+REQUIRED = {
+    'split': ('file',),
+    'merge': ('files', 'out'),
+    'restyle': ('file',),
+    'images': ('file',),
+}
+
+_WORKER = {}  # per-process state (see _init_worker)
+
+
+##############################################################################
+# CLASSES
+##############################################################################
+class WordService(object):
+    """
+    Name:     WordService
+    Features: Class for a warm pool of document workers with a bounded
+              number of jobs in flight
+    History:  Version 1
+    """
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Initialization
+    # ////////////////////////////////////////////////////////////////////////
+    def __init__(self, workers=2, queue=32, template=TEMPLATE, sloc=STYLES,
+                 root="."):
+        """
+        Name:     WordService.__init__
+        Inputs:   - int, number of worker processes (workers)
+                  - int, number of jobs that may wait for a worker (queue)
+                  - str, path to the .docx used as the merge template
+                  - str, directory for style definitions (sloc)
+                  - str, directory the request paths must be within (root)
+        Features: Starts the workers and waits until each is warm
+        Depends:  _init_worker
+        """
+        self.root = os.path.realpath(root)
+        self.workers = workers
+        self.template = template
+        self.sloc = sloc
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.lock = threading.Lock()
+        self.stats = {'accepted': 0, 'rejected': 0, 'failed': 0,
+                      'in_flight': 0, 'restarts': 0}
+        self.pool = self._new_pool()
+
+        # Start every worker now, rather than on the first requests
+        for job in [self.pool.submit(time.sleep, 0.1)
+                    for i in range(workers)]:
+            job.result()
+
+    # \\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
+    # Class Function Definitions
+    # ////////////////////////////////////////////////////////////////////////
+    def close(self):
+        """
+        Name:     WordService.close
+        Inputs:   None
+        Outputs:  None
+        Features: Waits for the jobs in flight and stops the workers
+        """
+        self.pool.shutdown(wait=True)
+
+    def health(self):
+        """
+        Name:     WordService.health
+        Inputs:   None
+        Outputs:  dict, number of workers and the job counts
+        """
+        with self.lock:
+            my_health = dict(self.stats)
+        my_health['workers'] = self.workers
+        return my_health
+
+    def relative(self, res):
+        """
+        Name:     WordService.relative
+        Inputs:   dict, a job's result (res)
+        Outputs:  dict, the result with its paths relative to the root
+        """
+        my_res = dict(res)
+        if isinstance(my_res.get('file'), str):
+            my_res['file'] = os.path.relpath(my_res['file'], self.root)
+        if isinstance(my_res.get('files'), list):
+            my_res['files'] = [
+                os.path.relpath(f, self.root) for f in my_res['files']]
+        return my_res
+
+    def submit(self, op, params):
+        """
+        Name:     WordService.submit
+        Inputs:   - str, job name, e.g., 'merge' (op)
+                  - dict, job parameters (params)
+        Outputs:  concurrent.futures.Future, the job's result; None if the
+                  queue is full
+        Features: Submits the job to the pool, with its paths resolved
+                  within the root (raises ValueError for a path outside
+                  it); a pool broken by a worker that died is replaced
+                  (see _rebuild)
+        Depends:  - _rebuild
+                  - _resolve
+                  - _run_job
+        """
+        params = self._resolve(params)
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.stats['rejected'] += 1
+            return None
+        with self.lock:
+            self.stats['accepted'] += 1
+            self.stats['in_flight'] += 1
+            pool = self.pool
+        try:
+            try:
+                job = pool.submit(_run_job, op, params)
+            except BrokenProcessPool:
+                # A worker died since the last job; start over once
+                pool = self._rebuild(pool)
+                job = pool.submit(_run_job, op, params)
+            except RuntimeError:
+                # The pool was replaced meanwhile (or the service closed)
+                if pool is self.pool:
+                    raise
+                pool = self.pool
+                job = pool.submit(_run_job, op, params)
+        except BaseException:
+            with self.lock:
+                self.stats['in_flight'] -= 1
+                self.stats['failed'] += 1
+            self.slots.release()
+            raise
+        job.add_done_callback(functools.partial(self._done, pool))
+        return job
+
+    def _path(self, value):
+        """
+        Name:     WordService._path
+        Inputs:   str, a request path, relative to the root (value)
+        Outputs:  str, the absolute path, with symbolic links resolved
+        Features: Raises ValueError for a path outside the root
+        """
+        if not isinstance(value, str):
+            raise ValueError("Expected a path, got %r" % (value,))
+        my_path = os.path.realpath(os.path.join(self.root, value))
+        if os.path.commonpath([self.root, my_path]) != self.root:
+            raise ValueError("Path %s is outside %s" % (value, self.root))
+        return my_path
+
+    def _done(self, pool, job):
+        """
+        Name:     WordService._done
+        Inputs:   - concurrent.futures.ProcessPoolExecutor, the pool the
+                    job ran in (pool)
+                  - concurrent.futures.Future, a finished job (job)
+        Outputs:  None
+        Features: Frees the job's queue slot; replaces the pool if the job
+                  was lost with a worker that died
+        Depends:  _rebuild
+        """
+        my_error = None
+        if not job.cancelled():
+            my_error = job.exception()
+        with self.lock:
+            self.stats['in_flight'] -= 1
+            if job.cancelled() or my_error is not None:
+                self.stats['failed'] += 1
+        if isinstance(my_error, BrokenProcessPool):
+            self._rebuild(pool)
+        self.slots.release()
+
+    def _new_pool(self):
+        """
+        Name:     WordService._new_pool
+        Inputs:   None
+        Outputs:  concurrent.futures.ProcessPoolExecutor, a new pool
+        Depends:  _init_worker
+        """
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   initializer=_init_worker,
+                                   initargs=(self.template, self.sloc))
+
+    def _rebuild(self, pool):
+        """
+        Name:     WordService._rebuild
+        Inputs:   concurrent.futures.ProcessPoolExecutor, a broken pool
+        Outputs:  concurrent.futures.ProcessPoolExecutor, the pool to use
+        Features: Replaces the broken pool with a new one, unless that was
+                  done already (e.g., for another job lost with it)
+        Depends:  _new_pool
+        """
+        with self.lock:
+            if pool is not self.pool:
+                return self.pool
+            self.pool = self._new_pool()
+            self.stats['restarts'] += 1
+            my_pool = self.pool
+        pool.shutdown(wait=False)
+        return my_pool
+
+    def _resolve(self, params):
+        """
+        Name:     WordService._resolve
+        Inputs:   dict, job parameters (params)
+        Outputs:  dict, job parameters with absolute paths
+        Features: Raises ValueError for a path outside the root; output
+                  goes to the root unless out_dir says otherwise
+        Depends:  _path
+        """
+        my_params = dict(params)
+        my_params.setdefault('out_dir', ".")
+        for k in PATHS:
+            v = my_params.get(k)
+            if v is None or v is True:
+                # e.g., template true for the service's template
+                continue
+            if k == 'files':
+                if not isinstance(v, list):
+                    raise ValueError("Expected a list of paths for files")
+                my_params[k] = [self._path(x) for x in v]
+            else:
+                my_params[k] = self._path(v)
+        return my_params
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    Name:     _RequestHandler
+    Features: Answers the service's HTTP requests with JSON
+    """
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/health":
+            self._reply(200, self.server.service.health())
+        else:
+            self._reply(404, {'error': "Unknown path %s" % (self.path)})
+
+    def do_POST(self):
+        op = self.path.strip("/")
+        if op not in REQUIRED:
+            self._reply(404, {'error': "Unknown path %s" % (self.path)})
+            return
+        try:
+            size = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(size) or b"{}")
+        except ValueError as e:
+            self._reply(400, {'error': "Bad request: %s" % (e)})
+            return
+        if not isinstance(params, dict):
+            self._reply(400, {'error': "Bad request: expected an object"})
+            return
+        missing = [k for k in REQUIRED[op] if k not in params]
+        if missing:
+            self._reply(400, {'error': "Missing %s" % (", ".join(missing))})
+            return
+
+        try:
+            job = self.server.service.submit(op, params)
+        except ValueError as e:
+            self._reply(400, {'error': "Bad request: %s" % (e)})
+            return
+        except BrokenProcessPool:
+            self._reply(503, {'error': "A worker died; the pool was "
+                              "restarted"}, {'Retry-After': "1"})
+            return
+        if job is None:
+            self._reply(503, {'error': "Queue is full"}, {'Retry-After': "1"})
+            return
+        try:
+            self._reply(200, self.server.service.relative(
+                job.result(timeout=self.server.timeout_s)))
+        except TimeoutError:
+            self._reply(504, {'error': "Timed out; the job carries on"})
+        except BrokenProcessPool:
+            # The pool is replaced (see WordService._done); try again
+            self._reply(503, {'error': "A worker died; the pool was "
+                              "restarted"}, {'Retry-After': "1"})
+        except Exception as e:
+            self._reply(500, {'error': "%s: %s" % (type(e).__name__, e)})
+
+    def _reply(self, code, body, headers={}):
+        my_data = json.dumps(body, sort_keys=True).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(my_data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(my_data)
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """
+    Name:     _UnixHTTPServer
+    Features: Threaded HTTP server on a Unix socket
+    """
+    daemon_threads = True
+
+
+##############################################################################
+# FUNCTIONS
+##############################################################################
+def serve(service, host="127.0.0.1", port=8765, socket_path=None,
+          timeout=300):
+    """
+    Name:     serve
+    Inputs:   - WordService, the worker pool (service)
+              - str, address to listen on (host)
+              - int, port to listen on (port)
+              - str, Unix socket to listen on instead (socket_path)
+              - float, seconds to wait for a job before replying 504
+    Outputs:  None
+    Features: Answers requests until interrupted, one thread per
+              connection; the work itself is done by the pool. The Unix
+              socket is only for its owner (mode 0600); a stale socket is
+              replaced, but any other file in its place is an error.
+    Depends:  _remove_socket
+    """
+    if socket_path:
+        _remove_socket(socket_path)
+        old_mask = os.umask(0o177)
+        try:
+            server = _UnixHTTPServer(socket_path, _RequestHandler)
+        finally:
+            os.umask(old_mask)
+        os.chmod(socket_path, 0o600)
+        where = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), _RequestHandler)
+        where = "http://%s:%d" % (host, server.server_address[1])
+    server.service = service
+    server.timeout_s = timeout
+    print("Serving on %s with %d workers" % (where, service.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path:
+            _remove_socket(socket_path)
+
+
+def _init_worker(template, sloc):
+    """
+    Name:     _init_worker
+    Inputs:   - str, path to the .docx used as the merge template (template)
+              - str, directory for style definitions (sloc)
+    Outputs:  None
+    Features: Process pool initializer; parses the template into the
+              worker's template cache and compiles the style definitions
+              once per worker, and parses python-docx's own default
+              template too
+    """
+    get_template_cache().document()
+    _WORKER['template'] = None
+    if template and os.path.isfile(template):
+        _WORKER['template'] = template
+        get_template_cache().document(template)
+    _WORKER['sloc'] = sloc
+    get_registry(sloc)
+
+
+def _remove_socket(socket_path):
+    """
+    Name:     _remove_socket
+    Inputs:   str, path of a Unix socket (socket_path)
+    Outputs:  None
+    Features: Removes the socket, if there is one; raises OSError if the
+              path is some other kind of file
+    """
+    try:
+        st = os.lstat(socket_path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise OSError("%s exists and is not a socket" % (socket_path))
+    os.remove(socket_path)
+
+
+def _run_job(op, params):
+    """
+    Name:     _run_job
+    Inputs:   - str, job name (op)
+              - dict, job parameters (params)
+    Outputs:  dict, the job's result and the seconds it took
+    Features: Runs one request in a worker:
+              split   - file, style ('Heading1'), out_dir ('.');
+                        returns the chapter files (see split_document)
+              merge   - files, out, mode ('runs'), template (true for the
+                        service's template); returns the output file
+              restyle - file, map ({}), out_dir ('.'), engine ('docx');
+                        returns the restyled file
+              images  - file, quick (false), all_parts (false); returns
+                        the locate_images result
+    Depends:  - incremental_merge_files
+              - locate_images
+              - merge_files
+              - restyle_file
+              - split_document
+              - stream_merge_files
+    """
+    t0 = time.perf_counter()
+    if op == "split":
+        res = {'files': split_document(
+            params['file'], params.get('style', "Heading1"),
+            params.get('out_dir', "."))}
+    elif op == "merge":
+        my_mode = params.get('mode', "runs")
+        sbreak = WD_SECTION.NEW_PAGE
+        if my_mode == "stream":
+            stream_merge_files(params['files'], params['out'], sbreak)
+        elif my_mode == "incremental":
+            incremental_merge_files(params['files'], params['out'], sbreak)
+        else:
+            my_template = params.get('template')
+            if my_template is True:
+                my_template = _WORKER['template']
+            merge_files(params['files'], sbreak, my_mode,
+                        my_template).save(params['out'])
+        res = {'file': params['out']}
+    elif op == "restyle":
+        res = {'file': restyle_file(
+            params['file'], params.get('map', {}),
+            params.get('out_dir', "."), _WORKER['sloc'],
+            params.get('engine', "docx"))}
+    elif op == "images":
+        res = locate_images(params['file'], params.get('quick', False),
+                            params.get('all_parts', False))
+    else:
+        raise ValueError("Unknown job '%s'" % (op))
+    res['seconds'] = time.perf_counter() - t0
+    return res
+
+
+##############################################################################
+# MAIN
+##############################################################################
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(
+        description="Serves the docx tools from a warm worker pool")
+    p.add_argument("--host", default="127.0.0.1",
+                   help="address to listen on")
+    p.add_argument("-p", "--port", type=int, default=8765,
+                   help="port to listen on")
+    p.add_argument("-s", "--socket", default=None,
+                   help="Unix socket to listen on instead of a port")
+    p.add_argument("-w", "--workers", type=int, default=2,
+                   help="number of worker processes")
+    p.add_argument("-q", "--queue", type=int, default=32,
+                   help="number of requests that may wait for a worker")
+    p.add_argument("-t", "--template", default=TEMPLATE,
+                   help="template .docx for merges")
+    p.add_argument("--styles", default=STYLES,
+                   help="directory for style definitions")
+    p.add_argument("--timeout", type=float, default=300,
+                   help="seconds to wait for a job before replying 504")
+    p.add_argument("-r", "--root", default=".",
+                   help="directory the request paths must be within")
+    args = p.parse_args()
+    instrument_from_env()
+
+    my_service = WordService(args.workers, args.queue, args.template,
+                             args.styles, args.root)
+    try:
+        serve(my_service, args.host, args.port, args.socket, args.timeout)
+    finally:
+        my_service.close()